@@ -0,0 +1,781 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# This module is executed as a standalone script on the local and on the remote host (via
+# "python3 -c SOURCE OPERATION ARGUMENTS...").  Thus it may only use the standard library.
+
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+
+
+HASH_NAME = "md5"
+MANIFEST_VERSION = 1
+# number of blocks hashed in advance per thread
+PREFETCH_BLOCKS = 4
+# the format of bdsync patches (see "bdsync_manager.patch")
+PATCH_VERSION = "0.3"
+BLOCK_HEADER = struct.Struct("!QI")
+# checksums of archived patches (see "bdsync_manager.archive")
+CHECKSUM_NAME = "sha256"
+# size of the blocks of a dumped file
+DUMP_BLOCK_SIZE = 1024 * 1024
+# adjacent blocks of a patch are combined into writes of up to this size
+COALESCE_SIZE = 8 * 1024 * 1024
+# number of regions listed by the inspection of a patch
+MAX_REPORTED_REGIONS = 100
+# stored patches starting with these bytes are decompressed (see "bdsync_manager.compression")
+COMPRESSION_MAGIC = ((b"\x1f\x8b", ["gzip", "--decompress", "--stdout"]),
+                     (b"\xfd7zXZ\x00", ["xz", "--decompress", "--stdout"]),
+                     (b"\x28\xb5\x2f\xfd", ["zstd", "--decompress", "--stdout", "--quiet"]),
+                     (b"\x04\x22\x4d\x18", ["lz4", "--decompress", "--stdout", "--quiet"]))
+# deduplicated patches (see "bdsync_manager.dedup"): the length field of a block header marks
+# blocks to be stored ("DEDUP_STORE") or taken from the store ("DEDUP_REFERENCE").  Both are
+# followed by the real length and the digest of the block.
+DEDUP_STORE = 0xFFFFFFFF
+DEDUP_REFERENCE = 0xFFFFFFFE
+DEDUP_RECORD = struct.Struct("!I32s")
+DEDUP_MISSING_MESSAGE = "missing block in dedup store"
+# handling of different sizes of the target and the patch (see "bdsync --diffsize")
+DIFFSIZE_MODES = ("strict", "resize", "minsize")
+# flags of "fallocate" (see "linux/falloc.h") for punching holes into files
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def _hash_block(fd, offset, size):
+    # reading and hashing release the GIL: the threads of the pool work in parallel
+    return hashlib.new(HASH_NAME, os.pread(fd, size, offset)).digest()
+
+
+def iter_block_hashes(fd, block_size, indexes, threads):
+    """ yield the index and the digest of the given blocks (in the given order)
+
+        The items of "indexes" are either block indexes (the block is hashed) or tuples of a
+        block index and a digest (the digest is passed through).
+    """
+    threads = threads or os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = collections.deque()
+        for item in indexes:
+            if isinstance(item, tuple):
+                pending.append(item)
+            else:
+                pending.append((item, executor.submit(_hash_block, fd, item * block_size,
+                                                      block_size)))
+            while len(pending) > threads * PREFETCH_BLOCKS:
+                index, result = pending.popleft()
+                yield index, result if isinstance(result, bytes) else result.result()
+        while pending:
+            index, result = pending.popleft()
+            yield index, result if isinstance(result, bytes) else result.result()
+
+
+def get_block_indexes(block_count, region_blocks=0, region_step=1):
+    """ return the indexes of the blocks to be processed
+
+        All blocks are processed by default.  A sample consists of every "region_step"-th region
+        of "region_blocks" consecutive blocks.  Both hosts compute the same sequence.
+    """
+    if not region_blocks:
+        return range(block_count)
+    return (index for start in range(0, block_count, region_blocks * region_step)
+            for index in range(start, min(start + region_blocks, block_count)))
+
+
+def load_manifest(filename, block_size, size):
+    """ read the digests of the blocks of a manifest file (an empty list: missing or outdated)
+
+        The manifest consists of a header line (JSON) followed by the digests of all blocks.
+    """
+    try:
+        with open(filename, "rb") as manifest:
+            header = json.loads(manifest.readline().decode())
+            digests = manifest.read()
+    except (OSError, ValueError):
+        return []
+    if (header.get("version") != MANIFEST_VERSION) or (header.get("hash") != HASH_NAME) \
+            or (header.get("block_size") != block_size):
+        return []
+    digest_size = hashlib.new(HASH_NAME).digest_size
+    result = [digests[offset:offset + digest_size]
+              for offset in range(0, len(digests) - digest_size + 1, digest_size)]
+    if (header.get("size") != size) and (header.get("size", 0) % block_size != 0):
+        # the last (partial) block of the manifest is outdated
+        result = result[:-1]
+    return result
+
+
+def save_manifest(filename, block_size, size, digests):
+    temp_filename = filename + ".new"
+    with open(temp_filename, "wb") as manifest:
+        manifest.write(json.dumps({"version": MANIFEST_VERSION, "hash": HASH_NAME,
+                                   "block_size": block_size, "size": size}).encode() + b"\n")
+        manifest.write(b"".join(digests))
+    os.replace(temp_filename, filename)
+
+
+def _get_size(fd):
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def run_hash(filename, block_size, threads, region_blocks=0, region_step=1):
+    """ write the size of a file or blockdevice and the digests (hex) of its blocks
+
+        All blocks are hashed unless a sample is specified (see "get_block_indexes").
+    """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = _get_size(fd)
+        output = sys.stdout
+        output.write("size {0:d}\n".format(size))
+        block_count = -(-size // block_size)
+        indexes = get_block_indexes(block_count, region_blocks, region_step)
+        for index, digest in iter_block_hashes(fd, block_size, indexes, threads):
+            output.write(digest.hex() + "\n")
+    finally:
+        os.close(fd)
+    output.flush()
+
+
+def run_verify(filename, block_size, threads, manifest_filename, full, region_blocks=0,
+               region_step=1):
+    """ compare the blocks of a file or blockdevice with the digests read from stdin
+
+        The input is the output of "run_hash" for the source.  Blocks with a digest equal to
+        the digest stored in the manifest are not read (unless "full" is enabled): the source
+        did not change since the last verification, thus the synchronization did not touch the
+        block.  The manifest is updated afterwards.  Mismatching blocks and a summary are
+        written to stdout.
+        A sample of the blocks (see "get_block_indexes") is compared without using the
+        manifest.
+    """
+    source_size = int(sys.stdin.readline().split()[1])
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = _get_size(fd)
+        block_count = -(-size // block_size)
+        if region_blocks:
+            manifest_filename = None
+        manifest = [] if (full or not manifest_filename) \
+            else load_manifest(manifest_filename, block_size, size)
+        source_digests = {}
+        counters = collections.Counter()
+
+        def get_work():
+            source_count = -(-source_size // block_size)
+            indexes = get_block_indexes(source_count, region_blocks, region_step)
+            for index, line in zip(indexes, sys.stdin):
+                digest = bytes.fromhex(line.strip())
+                source_digests[index] = digest
+                if index >= block_count:
+                    continue
+                if (index < len(manifest)) and (manifest[index] == digest):
+                    counters["reused"] += 1
+                    yield (index, digest)
+                else:
+                    counters["hashed"] += 1
+                    yield index
+
+        digests = []
+        for index, digest in iter_block_hashes(fd, block_size, get_work(), threads):
+            counters["compared"] += 1
+            digests.append(digest)
+            if digest != source_digests.pop(index):
+                counters["mismatches"] += 1
+                sys.stdout.write("mismatch {0:d}\n".format(index))
+    finally:
+        os.close(fd)
+    if manifest_filename and (len(digests) == block_count):
+        save_manifest(manifest_filename, block_size, size, digests)
+    sys.stdout.write("summary size={0:d} source_size={1:d} blocks={2:d} compared={3:d} "
+                     "hashed={4:d} reused={5:d} mismatches={6:d}\n".format(
+                         size, source_size, block_count, counters["compared"],
+                         counters["hashed"], counters["reused"], counters["mismatches"]))
+    sys.stdout.flush()
+
+
+class _ChecksumReader:
+    """ calculate the checksum of the data read from a stream """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.checksum = hashlib.new(CHECKSUM_NAME)
+
+    def read(self, size):
+        data = self._stream.read(size)
+        self.checksum.update(data)
+        return data
+
+    def readline(self):
+        data = self._stream.readline()
+        self.checksum.update(data)
+        return data
+
+
+class _ChecksumWriter:
+    """ calculate the checksum of the data written to a stream """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.checksum = hashlib.new(CHECKSUM_NAME)
+
+    def write(self, data):
+        self.checksum.update(data)
+        self._stream.write(data)
+
+    def close(self):
+        self._stream.close()
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("unexpected end of patch")
+    return data
+
+
+def read_patch_header(stream):
+    """ return the fields of the header of a bdsync patch (e.g. "DEVICE" and "SIZE") """
+    if not stream.readline().startswith(b"BDSYNC "):
+        raise ValueError("not a bdsync patch")
+    fields = {}
+    while True:
+        line = stream.readline()
+        if not line:
+            raise ValueError("incomplete patch header")
+        line = line.rstrip(b"\n").decode()
+        if not line:
+            return fields
+        key, _, value = line.partition(":")
+        fields[key] = value
+
+
+def iter_patch_blocks(stream):
+    """ yield the offset and the data of the blocks of a bdsync patch (after its header) """
+    while True:
+        header = stream.read(BLOCK_HEADER.size)
+        if not header:
+            return
+        if len(header) != BLOCK_HEADER.size:
+            raise ValueError("unexpected end of patch")
+        offset, length = BLOCK_HEADER.unpack(header)
+        yield offset, _read_exactly(stream, length)
+
+
+def write_patch_header(stream, device_name, size):
+    stream.write("BDSYNC {0}\nDEVICE:{1}\nSIZE:{2:d}\n\n"
+                 .format(PATCH_VERSION, device_name, size).encode())
+
+
+class RangeSet:
+    """ a set of disjoint ranges (start and end) of bytes """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def add(self, start, end):
+        """ add a range and return the parts of it, which were not part of the set before """
+        first = bisect.bisect_right(self._ends, start)
+        last = first
+        position = start
+        missing = []
+        while (last < len(self._starts)) and (self._starts[last] <= end):
+            if self._starts[last] > position:
+                missing.append((position, self._starts[last]))
+            position = max(position, self._ends[last])
+            last += 1
+        if position < end:
+            missing.append((position, end))
+        if last > first:
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+        return missing
+
+
+def _detect_compression(stream):
+    """ return the decompression command for a stored patch (None: not compressed)
+
+        The position of the file is kept: the decompression command reads the file from the
+        start (a read via the buffered stream would move the position of the file).
+    """
+    magic = os.pread(stream.fileno(), 8, 0)
+    for prefix, tokens in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return tokens
+    return None
+
+
+@contextlib.contextmanager
+def _open_patch(filename, decompress_tokens=None):
+    """ provide the (maybe decompressed) content of a patch as a stream
+
+        The patch is read from stdin, if the filename is "-".  The compression of stored
+        patches is detected, unless a decompression command is given.
+    """
+    if filename == "-":
+        source = sys.stdin.buffer
+    else:
+        source = open(filename, "rb")
+        if not decompress_tokens:
+            decompress_tokens = _detect_compression(source)
+    try:
+        if not decompress_tokens:
+            yield source
+            return
+        process = subprocess.Popen(decompress_tokens, stdin=source, stdout=subprocess.PIPE)
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            if process.wait() != 0:
+                raise ValueError("failed to decompress patch: {0}".format(filename))
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+
+
+def _get_fallocate():
+    """ return the "fallocate" function of the C library (or None) """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    except (ImportError, OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    return fallocate
+
+
+class _CoalescingWriter:
+    """ combine writes of adjacent blocks into large sequential writes
+
+        All-zero blocks are turned into holes (combined in the same way), if requested.  Zeros
+        are written instead, if the filesystem does not support punching holes.
+    """
+
+    def __init__(self, fd, max_size=COALESCE_SIZE, punch_holes=False):
+        self._fd = fd
+        self._max_size = max_size
+        self._buffer = bytearray()
+        self._offset = 0
+        self._fallocate = _get_fallocate() if punch_holes else None
+        self._hole = None
+        self.writes = 0
+        self.bytes = 0
+        self.hole_bytes = 0
+
+    def write(self, offset, data):
+        if (self._fallocate is not None) and (data == bytes(len(data))):
+            self._flush_buffer()
+            if (self._hole is not None) and (offset == self._hole[1]):
+                self._hole[1] += len(data)
+            else:
+                self._flush_hole()
+                self._hole = [offset, offset + len(data)]
+            return
+        self._flush_hole()
+        if (offset != self._offset + len(self._buffer)) \
+                or (len(self._buffer) + len(data) > self._max_size):
+            self._flush_buffer()
+            self._offset = offset
+        self._buffer += data
+
+    def _flush_hole(self):
+        if self._hole is None:
+            return
+        start, end = self._hole
+        self._hole = None
+        if self._fallocate(self._fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, start,
+                           end - start) == 0:
+            self.hole_bytes += end - start
+            return
+        # e.g. EOPNOTSUPP: write zeros from now on
+        self._fallocate = None
+        for offset in range(start, end, self._max_size):
+            self.write(offset, bytes(min(self._max_size, end - offset)))
+
+    def _flush_buffer(self):
+        if self._buffer:
+            os.pwrite(self._fd, self._buffer, self._offset)
+            self.writes += 1
+            self.bytes += len(self._buffer)
+            self._offset += len(self._buffer)
+            self._buffer = bytearray()
+
+    def flush(self):
+        self._flush_hole()
+        self._flush_buffer()
+
+
+def _index_patch_blocks(stream):
+    """ collect the offsets, lengths and positions of the blocks of a seekable patch
+
+        Only the block headers are read.  The return value indicates, whether the offsets are
+        ascending.
+    """
+    offsets, lengths, positions = array.array("Q"), array.array("Q"), array.array("Q")
+    ascending = True
+    while True:
+        header = stream.read(BLOCK_HEADER.size)
+        if not header:
+            return ascending, offsets, lengths, positions
+        if len(header) != BLOCK_HEADER.size:
+            raise ValueError("unexpected end of patch")
+        offset, length = BLOCK_HEADER.unpack(header)
+        if offsets and (offset < offsets[-1]):
+            ascending = False
+        offsets.append(offset)
+        lengths.append(length)
+        positions.append(stream.tell())
+        stream.seek(length, os.SEEK_CUR)
+
+
+def get_dedup_digest(data):
+    return hashlib.blake2b(data, digest_size=DEDUP_RECORD.size - 4).digest()
+
+
+def _get_dedup_path(store_dir, digest):
+    name = digest.hex()
+    return os.path.join(store_dir, name[:2], name)
+
+
+def run_expand(store_dir, filename, decompress_tokens, apply_tokens):
+    """ pass a deduplicated patch as a plain bdsync patch to a command applying it
+
+        Blocks marked for storing are added to the store (one file per digest).  References
+        are replaced with the stored blocks (after checking their digests).  The command
+        applying the patch is started by the agent: a failure of either side is reported via
+        the exit code (a shell pipeline would hide a failure of its first command).
+    """
+    process = subprocess.Popen(apply_tokens, stdin=subprocess.PIPE)
+    output = process.stdin
+    try:
+        with _open_patch(filename, decompress_tokens) as stream:
+            while True:
+                line = stream.readline()
+                if not line.endswith(b"\n"):
+                    raise ValueError("incomplete patch header")
+                output.write(line)
+                if line == b"\n":
+                    break
+            while True:
+                header = stream.read(BLOCK_HEADER.size)
+                if not header:
+                    break
+                if len(header) != BLOCK_HEADER.size:
+                    raise ValueError("unexpected end of patch")
+                offset, length = BLOCK_HEADER.unpack(header)
+                if length in (DEDUP_STORE, DEDUP_REFERENCE):
+                    data = _expand_block(store_dir, stream, length)
+                else:
+                    data = _read_exactly(stream, length)
+                output.write(BLOCK_HEADER.pack(offset, len(data)))
+                output.write(data)
+        output.close()
+    except BaseException:
+        # the command must not handle an incomplete patch
+        process.kill()
+        process.wait()
+        raise
+    if process.wait() != 0:
+        raise ValueError("failed to apply patch (exit code {0:d})".format(process.returncode))
+
+
+def _expand_block(store_dir, stream, marker):
+    """ read a block record of a deduplicated patch and return the data of the block """
+    length, digest = DEDUP_RECORD.unpack(_read_exactly(stream, DEDUP_RECORD.size))
+    path = _get_dedup_path(store_dir, digest)
+    if marker == DEDUP_STORE:
+        data = _read_exactly(stream, length)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = "{0}.{1:d}".format(path, os.getpid())
+        with open(temp_path, "wb") as block_file:
+            block_file.write(data)
+        os.replace(temp_path, path)
+        return data
+    try:
+        with open(path, "rb") as block_file:
+            data = block_file.read()
+    except FileNotFoundError:
+        data = None
+    if (data is None) or (len(data) != length) or (get_dedup_digest(data) != digest):
+        raise ValueError("{0}: {1}".format(DEDUP_MISSING_MESSAGE, digest.hex()))
+    return data
+
+
+def run_forget(store_dir, clear):
+    """ remove the blocks listed (as hex digests) on stdin or all blocks from the store """
+    if clear:
+        names = (os.path.join(directory, name) for directory in os.listdir(store_dir)
+                 for name in os.listdir(os.path.join(store_dir, directory))) \
+            if os.path.isdir(store_dir) else ()
+    else:
+        names = (os.path.join(line[:2], line) for line in sys.stdin.read().split())
+    removed = 0
+    for name in names:
+        try:
+            os.unlink(os.path.join(store_dir, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+    sys.stdout.write("summary removed={0:d}\n".format(removed))
+    sys.stdout.flush()
+
+
+def _check_target_size(fd, target_filename, size, diffsize):
+    """ compare the size of the target with the size of the patch like "bdsync --patch"
+
+        The handling of different sizes follows bdsync's "--diffsize" ("strict": the sizes
+        must match, "resize": the target is resized, "minsize": a larger target is kept).
+        Blockdevices cannot be resized.  The size to be set after applying the patch is
+        returned (None: keep the size).
+    """
+    if diffsize not in DIFFSIZE_MODES:
+        raise ValueError("unknown diffsize mode: {0}".format(diffsize))
+    current_size = _get_size(fd)
+    if (current_size == size) or ((diffsize == "minsize") and (current_size > size)):
+        return None
+    if (diffsize == "strict") or not os.path.isfile(target_filename):
+        raise ValueError("size of the target ({0:d}) differs from the size of the patch ({1:d}):"
+                         " {2}".format(current_size, size, target_filename))
+    return size
+
+
+def run_apply(filename, decompress_tokens, target_filename, diffsize="strict"):
+    """ apply a bdsync patch to a file or blockdevice with large sequential writes
+
+        Adjacent blocks are combined into writes of up to COALESCE_SIZE bytes.  The blocks of
+        an uncompressed patch file are applied in the order of their offsets: the block headers
+        are indexed first (the memory usage is proportional to the number of blocks), if the
+        offsets are not ascending (e.g. for merged patches).  Other patches are streamed with
+        constant memory usage.  Later blocks overwrite earlier blocks at the same offset in
+        both cases.  All-zero blocks are punched as holes into the target (keeping it sparse).
+        Different sizes of the target and the patch are handled like "bdsync --diffsize".
+    """
+    fd = os.open(target_filename, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        writer = _CoalescingWriter(fd, punch_holes=True)
+        with _open_patch(filename, decompress_tokens) as stream:
+            fields = read_patch_header(stream)
+            new_size = _check_target_size(fd, target_filename, int(fields["SIZE"]), diffsize)
+            ascending = True
+            if stream.seekable():
+                start = stream.tell()
+                ascending, offsets, lengths, positions = _index_patch_blocks(stream)
+                stream.seek(start)
+            if ascending:
+                for offset, data in iter_patch_blocks(stream):
+                    writer.write(offset, data)
+            else:
+                # the sort is stable: the order of blocks with the same offset is kept
+                for index in sorted(range(len(offsets)), key=offsets.__getitem__):
+                    writer.write(offsets[index],
+                                 os.pread(stream.fileno(), lengths[index], positions[index]))
+        writer.flush()
+        if new_size is not None:
+            os.ftruncate(fd, new_size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    sys.stdout.write("summary writes={0:d} bytes={1:d} holes={2:d} sorted={3:d}\n".format(
+        writer.writes, writer.bytes, writer.hole_bytes, 0 if ascending else 1))
+    sys.stdout.flush()
+
+
+def run_inspect(filename, decompress_tokens, buckets):
+    """ write statistics (JSON) about the blocks of a patch
+
+        The patch is read as a stream with constant memory usage: the number of blocks and
+        bytes, a histogram of the changed bytes over the device (with the given number of
+        buckets) and the regions of consecutive blocks (only the first ones are listed).
+    """
+    with _open_patch(filename, decompress_tokens) as stream:
+        fields = read_patch_header(stream)
+        size = int(fields["SIZE"])
+        histogram = [0] * buckets
+        bucket_size = max(1, -(-size // buckets))
+        result = {"device": fields.get("DEVICE"), "size": size, "blocks": 0, "bytes": 0,
+                  "ascending": True, "regions": 0, "largest_block": 0,
+                  "bucket_size": bucket_size, "histogram": histogram, "region_list": []}
+        region = None
+        previous = None
+        for offset, data in iter_patch_blocks(stream):
+            length = len(data)
+            result["blocks"] += 1
+            result["bytes"] += length
+            result["largest_block"] = max(result["largest_block"], length)
+            if (previous is not None) and (offset < previous):
+                result["ascending"] = False
+            previous = offset
+            position = offset
+            while position < min(offset + length, bucket_size * buckets):
+                bucket = position // bucket_size
+                end = min(offset + length, (bucket + 1) * bucket_size)
+                histogram[bucket] += end - position
+                position = end
+            if (region is not None) and (region[0] <= offset <= region[0] + region[1]):
+                region[1] = max(region[1], offset + length - region[0])
+            else:
+                if region is not None:
+                    result["regions"] += 1
+                    if len(result["region_list"]) < MAX_REPORTED_REGIONS:
+                        result["region_list"].append(region)
+                region = [offset, length]
+        if region is not None:
+            result["regions"] += 1
+            if len(result["region_list"]) < MAX_REPORTED_REGIONS:
+                result["region_list"].append(region)
+    sys.stdout.write(json.dumps(result) + "\n")
+    sys.stdout.flush()
+
+
+def run_dump(filename, output_filename):
+    """ store the complete content of a file or blockdevice as a bdsync patch """
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = _get_size(fd)
+        with open(output_filename, "wb") as stream:
+            output = _ChecksumWriter(stream)
+            write_patch_header(output, filename, size)
+            for offset in range(0, size, DUMP_BLOCK_SIZE):
+                data = os.pread(fd, min(DUMP_BLOCK_SIZE, size - offset), offset)
+                output.write(BLOCK_HEADER.pack(offset, len(data)))
+                output.write(data)
+    finally:
+        os.close(fd)
+    sys.stdout.write("summary size={0:d} checksum={1}\n".format(
+        os.path.getsize(output_filename), output.checksum.hexdigest()))
+    sys.stdout.flush()
+
+
+def run_checksum(filename, decompress_tokens):
+    """ write the checksum of the (decompressed) content of a stored patch """
+    with _open_patch(filename, decompress_tokens) as stream:
+        reader = _ChecksumReader(stream)
+        read_patch_header(reader)
+        for offset, data in iter_patch_blocks(reader):
+            pass
+    sys.stdout.write("summary checksum={0}\n".format(reader.checksum.hexdigest()))
+    sys.stdout.flush()
+
+
+def run_merge(patches, output_filename, apply):
+    """ merge a chain of patches (ordered from old to new) into a single patch
+
+        Only the latest write of every byte is kept: the patches are processed from new to old
+        and only the parts of blocks not written by newer patches are passed on (the blocks of a
+        single patch must not overlap each other, like the blocks written by bdsync).  The result
+        is stored as a patch or applied to a file or blockdevice ("apply").  The checksums of the
+        patches are verified: a patch file is stored only if all checksums are valid (while an
+        applied result is incomplete in case of an error).
+    """
+    if not patches:
+        raise ValueError("no patches given")
+    written = RangeSet()
+    temp_filename = output_filename + ".new"
+    output = None
+    counters = collections.Counter()
+    try:
+        for patch in reversed(patches):
+            with _open_patch(patch["filename"], patch.get("decompress")) as stream:
+                reader = _ChecksumReader(stream)
+                fields = read_patch_header(reader)
+                if output is None:
+                    # the newest patch determines the size
+                    size = int(fields["SIZE"])
+                    if apply:
+                        output = open(output_filename, "r+b" if os.path.exists(output_filename)
+                                      else "wb")
+                    else:
+                        output = _ChecksumWriter(open(temp_filename, "wb"))
+                        write_patch_header(output, fields["DEVICE"], size)
+                for offset, data in iter_patch_blocks(reader):
+                    for start, end in written.add(offset, min(offset + len(data), size)):
+                        part = data[start - offset:end - offset]
+                        if apply:
+                            os.pwrite(output.fileno(), part, start)
+                        else:
+                            output.write(BLOCK_HEADER.pack(start, len(part)))
+                            output.write(part)
+                        counters["blocks"] += 1
+                        counters["bytes"] += len(part)
+            if reader.checksum.hexdigest() != patch["checksum"]:
+                raise ValueError("checksum mismatch: {0}".format(patch["filename"]))
+    except BaseException:
+        if output is not None:
+            output.close()
+            if not apply:
+                os.unlink(temp_filename)
+        raise
+    if apply:
+        if os.path.isfile(output_filename):
+            # the unwritten end of a file may be a hole
+            os.ftruncate(output.fileno(), size)
+        output.close()
+        checksum = ""
+    else:
+        output.close()
+        os.replace(temp_filename, output_filename)
+        checksum = output.checksum.hexdigest()
+    sys.stdout.write("summary blocks={0:d} bytes={1:d} size={2:d} checksum={3}\n".format(
+        counters["blocks"], counters["bytes"],
+        0 if apply else os.path.getsize(output_filename), checksum))
+    sys.stdout.flush()
+
+
+def main(args):
+    operation = args[0]
+    if operation == "hash":
+        run_hash(args[1], int(args[2]), int(args[3]), *(int(arg) for arg in args[4:6]))
+    elif operation == "verify":
+        run_verify(args[1], int(args[2]), int(args[3]), args[4], args[5] == "1",
+                   *(int(arg) for arg in args[6:8]))
+    elif operation == "dump":
+        run_dump(args[1], args[2])
+    elif operation == "checksum":
+        run_checksum(args[1], json.loads(args[2]))
+    elif operation == "merge":
+        run_merge(json.loads(args[1]), args[2], args[3] == "apply")
+    elif operation == "apply":
+        run_apply(args[1], json.loads(args[2]), args[3], args[4])
+    elif operation == "inspect":
+        run_inspect(args[1], json.loads(args[2]), int(args[3]))
+    elif operation == "expand":
+        run_expand(args[1], args[2], json.loads(args[3]), json.loads(args[4]))
+    elif operation == "forget":
+        run_forget(args[1], args[2] == "all")
+    else:
+        raise ValueError("unknown operation: {0}".format(operation))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,201 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import json
+import shlex
+import sys
+import time
+
+from plumbum import ProcessExecutionError
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.compression import get_decompress_tokens
+from bdsync_manager.connection import get_agent_command
+from bdsync_manager.trace import span
+from bdsync_manager.utils import log, sizeof_fmt
+
+
+INDEX_FILENAME = "index.json"
+INDEX_VERSION = 1
+# marks the end of the index written via the shell of the target host
+INDEX_DELIMITER = "__BDSYNC_MANAGER_INDEX__"
+
+
+class PatchArchive:
+    """ a store of the patches of a task on the target host (for point-in-time restores)
+
+        The archive starts with a "base" entry: a dump of the target (as a patch) taken before
+        the first archived patch is applied.  Every run adds its patch instead of removing it.
+        The state of the target at any archived point in time is the base with all subsequent
+        patches applied.  A chain of entries is merged into a single patch (keeping only the
+        latest write of every block) by the compaction (older entries are folded into the base)
+        and by restores.
+        The index (a JSON file next to the patches) lists the entries with their time, codec and
+        the checksum of their (uncompressed) content.  The checksums are verified whenever the
+        patches are read.  The patches are processed by the agent (see
+        "bdsync_manager.agent") on the target host: they are never transferred.
+    """
+
+    def __init__(self, directory, connection, remote_python="python3"):
+        self.directory = directory
+        self._connection = connection
+        self._remote_python = remote_python
+
+    def _get_path(self, filename):
+        return "{0}/{1}".format(self.directory.rstrip("/"), filename)
+
+    def _run_agent(self, args):
+        """ run an operation of the agent on the target host and return its summary """
+        python_bin = self._remote_python if self._connection.is_remote else sys.executable
+        command = get_agent_command(self._connection, python_bin, args)
+        try:
+            output = command()
+        except ProcessExecutionError as exc:
+            # the last line of the agent's traceback describes the problem
+            details = exc.stderr.strip().splitlines()
+            raise TaskProcessingError("Failed to process the patch archive ({0}): {1}"
+                                      .format(self.directory, details[-1] if details else exc))
+        for line in output.splitlines():
+            if line.startswith("summary "):
+                return dict(item.split("=", 1) for item in line.split()[1:])
+        raise TaskProcessingError("Failed to process the patch archive: missing summary")
+
+    def get_entries(self):
+        """ return the entries of the archive ordered by time (an empty list: no archive) """
+        returncode, output = self._connection.run(
+            "cat {0}".format(shlex.quote(self._get_path(INDEX_FILENAME))))
+        if returncode != 0:
+            return []
+        try:
+            index = json.loads(output)
+        except ValueError as exc:
+            raise TaskProcessingError("Failed to parse the index of the patch archive ({0}): {1}"
+                                      .format(self.directory, exc))
+        if index.get("version") != INDEX_VERSION:
+            raise TaskProcessingError("Unsupported version of the patch archive ({0}): {1}"
+                                      .format(self.directory, index.get("version")))
+        return index["entries"]
+
+    def _save_entries(self, entries):
+        """ replace the index atomically """
+        index_path = self._get_path(INDEX_FILENAME)
+        content = json.dumps({"version": INDEX_VERSION, "entries": entries}, indent=1)
+        self._connection.check_output(
+            "mkdir -p {directory} && cat >{temp} <<'{delimiter}'\n{content}\n{delimiter}\n"
+            "mv {temp} {index}".format(directory=shlex.quote(self.directory),
+                                       temp=shlex.quote(index_path + ".new"),
+                                       index=shlex.quote(index_path), content=content,
+                                       delimiter=INDEX_DELIMITER))
+
+    def _get_filename(self, timestamp, suffix):
+        name = datetime.datetime.fromtimestamp(timestamp).strftime("%Y%m%d-%H%M%S-%f")
+        return "{0}-{1}.bdsync".format(name, suffix)
+
+    def prepare(self, target_filename, timestamp):
+        """ create the base entry, unless the archive exists already
+
+            The target must not be changed between this call and "add_patch".
+        """
+        if self.get_entries():
+            return
+        filename = self._get_filename(timestamp, "base")
+        log.info("Creating the base of the patch archive: %s", self.directory)
+        self._connection.check_output("mkdir -p {0}".format(shlex.quote(self.directory)))
+        with span("dump archive base"):
+            result = self._run_agent(["dump", target_filename, self._get_path(filename)])
+        self._save_entries([{"time": timestamp, "filename": filename, "codec": None,
+                             "base": True, "size": int(result["size"]),
+                             "checksum": result["checksum"]}])
+
+    def add_patch(self, patch_filename, codec, timestamp):
+        """ move an applied patch (maybe compressed with a codec) into the archive """
+        entries = self.get_entries()
+        if not entries:
+            raise TaskProcessingError("The patch archive lacks its base ({0})"
+                                      .format(self.directory))
+        filename = self._get_filename(timestamp, "patch")
+        path = self._get_path(filename)
+        with span("archive patch"):
+            self._connection.check_output("mv {0} {1}".format(shlex.quote(patch_filename),
+                                                              shlex.quote(path)))
+            result = self._run_agent(["checksum", path, json.dumps(self._get_decompress(codec))])
+            size = int(self._connection.check_output(
+                "stat -L --format %s {0}".format(shlex.quote(path))))
+        entries.append({"time": timestamp, "filename": filename, "codec": codec, "base": False,
+                        "size": size, "checksum": result["checksum"]})
+        self._save_entries(entries)
+        log.info("Archived patch: %s (%s)", filename, sizeof_fmt(size))
+
+    @staticmethod
+    def _get_decompress(codec):
+        return get_decompress_tokens(codec) if codec else None
+
+    def _get_chain(self, entries):
+        return [{"filename": self._get_path(entry["filename"]),
+                 "decompress": self._get_decompress(entry["codec"]),
+                 "checksum": entry["checksum"]} for entry in entries]
+
+    def _get_entries_until(self, timestamp):
+        entries = self.get_entries()
+        chain = [entry for entry in entries if entry["time"] <= timestamp]
+        if not chain:
+            raise TaskProcessingError("The patch archive ({0}) does not contain a state before "
+                                      "{1}".format(self.directory, time.ctime(timestamp)))
+        return entries, chain
+
+    def compact(self, timestamp):
+        """ merge all entries up to a point in time into a new base entry
+
+            The number of merged entries is returned.
+        """
+        entries, chain = self._get_entries_until(timestamp)
+        if len(chain) < 2:
+            return 0
+        filename = self._get_filename(chain[-1]["time"], "base")
+        log.info("Compacting %d entries of the patch archive: %s", len(chain), self.directory)
+        with span("compact archive", entries=len(chain)):
+            result = self._run_agent(["merge", json.dumps(self._get_chain(chain)),
+                                      self._get_path(filename), "patch"])
+        base = {"time": chain[-1]["time"], "filename": filename, "codec": None, "base": True,
+                "size": int(result["size"]), "checksum": result["checksum"]}
+        self._save_entries([base] + entries[len(chain):])
+        obsolete = [self._get_path(entry["filename"]) for entry in chain
+                    if entry["filename"] != filename]
+        self._connection.check_output("rm -f {0}".format(shlex.join(obsolete)))
+        log.info("Compacted patch archive: %s merged into %s (%s)",
+                 sizeof_fmt(sum(entry["size"] for entry in chain)), filename,
+                 sizeof_fmt(base["size"]))
+        return len(chain)
+
+    def restore(self, timestamp, output_filename):
+        """ write the archived state of a point in time to a file or blockdevice
+
+            All entries up to this point in time are merged and applied at once: every block
+            is written only once.  The time of the restored state is returned.
+        """
+        entries, chain = self._get_entries_until(timestamp)
+        log.info("Restoring the state of %s from %d entries of the patch archive into %s",
+                 time.ctime(chain[-1]["time"]), len(chain), output_filename)
+        with span("restore archive", entries=len(chain)):
+            result = self._run_agent(["merge", json.dumps(self._get_chain(chain)),
+                                      output_filename, "apply"])
+        log.info("Restored %s", sizeof_fmt(int(result["bytes"])))
+        return chain[-1]["time"]
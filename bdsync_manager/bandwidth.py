@@ -0,0 +1,266 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import fcntl
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+from bdsync_manager.relay import TokenBucket
+from bdsync_manager.utils import log, parse_bandwidth_limit
+
+
+# interval (seconds) between updates of the shares of all streams
+UPDATE_INTERVAL = 1.0
+# streams of other processes are ignored, if they were not updated for this time (seconds)
+STALE_TIMEOUT = 10 * UPDATE_INTERVAL
+# streams using less than this part of their share are considered to be limited elsewhere
+IDLE_THRESHOLD = 0.8
+SCHEDULE_WINDOW_REGEX = re.compile(
+    r"^(?P<start>[0-9]{1,2}:[0-9]{2})-(?P<end>[0-9]{1,2}:[0-9]{2})=(?P<limit>\S+)$")
+
+_budget = None
+_budget_lock = threading.Lock()
+
+
+class BandwidthSchedule:
+    """ a bandwidth limit depending on the time of day
+
+        The schedule is a comma separated list of limits.  Limits may be restricted to a time
+        window (e.g. "08:00-18:00=10m").  The first matching entry is used.  An entry without a
+        time window applies to all other times.  No limit is applied if no entry matches.
+    """
+
+    def __init__(self, text):
+        self._entries = []
+        for item in text.split(","):
+            item = item.strip().lower()
+            if not item:
+                continue
+            match = SCHEDULE_WINDOW_REGEX.match(item)
+            if match:
+                window = (self._parse_time(match.group("start")),
+                          self._parse_time(match.group("end")))
+                limit = match.group("limit")
+            else:
+                window = None
+                limit = item
+            self._entries.append((window, parse_bandwidth_limit(limit)))
+
+    @staticmethod
+    def _parse_time(text):
+        try:
+            return datetime.datetime.strptime(text, "%H:%M").time()
+        except ValueError:
+            raise ValueError("invalid time of day: {0}".format(text))
+
+    def get_limit(self, now=None):
+        """ return the limit (bytes per second) valid at the given time (or None) """
+        if now is None:
+            now = datetime.datetime.now().time()
+        for window, limit in self._entries:
+            if window is None:
+                return limit
+            start, end = window
+            if (start <= now < end) if (start <= end) else (now >= start or now < end):
+                return limit
+        return None
+
+
+def get_fair_shares(limit, demands):
+    """ distribute a limit among streams according to max-min fairness
+
+        "demands" maps stream keys to their demand (None: unlimited).  Streams with a demand
+        below an equal share receive their demand.  The remaining bandwidth is distributed
+        equally among the other streams.
+    """
+    shares = {}
+    remaining = dict(demands)
+    available = limit
+    while remaining:
+        equal_share = available / len(remaining)
+        satisfied = {key: demand for key, demand in remaining.items()
+                     if (demand is not None) and (demand <= equal_share)}
+        if not satisfied:
+            shares.update((key, equal_share) for key in remaining)
+            break
+        for key, demand in satisfied.items():
+            shares[key] = demand
+            available -= demand
+            del remaining[key]
+    return shares
+
+
+class SharedBucket(TokenBucket):
+    """ the token bucket of a single stream participating in a bandwidth budget """
+
+    def __init__(self, budget, key, host, own_limit):
+        super().__init__(own_limit)
+        self.key = key
+        self.host = host
+        self.own_limit = own_limit
+        self.transferred = 0
+        self.measured_rate = None
+        self.allocated_rate = None
+        self._budget = budget
+
+    def get_demand(self):
+        """ estimate the bandwidth required by this stream (None: unlimited) """
+        if (self.measured_rate is not None) and self.allocated_rate \
+                and (self.measured_rate < IDLE_THRESHOLD * self.allocated_rate):
+            # the stream is limited elsewhere (e.g. by reading the source)
+            demand = max(self.measured_rate / IDLE_THRESHOLD, 1024)
+        else:
+            demand = None
+        if self.own_limit is not None:
+            demand = self.own_limit if demand is None else min(demand, self.own_limit)
+        return demand
+
+    def consume(self, count):
+        self.transferred += count
+        self._budget.update()
+        super().consume(count)
+
+
+class BandwidthBudget:
+    """ share run-wide bandwidth limits among all concurrent transfers
+
+        The global limit applies to all transfers.  The host limit applies to the transfers to
+        each remote host.  Both limits are shared fairly among the active transfers: bandwidth
+        not used by a transfer is redistributed to the others.  Transfers of other bdsync-manager
+        processes (e.g. separate cron jobs) are taken into account, if a coordination file is
+        given and accessible.
+    """
+
+    def __init__(self, global_schedule=None, host_schedule=None, coordination_file=None):
+        self._global_schedule = global_schedule
+        self._host_schedule = host_schedule
+        self._coordination_file = coordination_file
+        self._buckets = {}
+        self._key_counter = itertools.count()
+        self._lock = threading.Lock()
+        self._last_update = 0
+        self._last_measurement = time.monotonic()
+
+    def get_bucket(self, host, own_limit=None):
+        """ register a new stream and return its token bucket """
+        with self._lock:
+            key = "{0:d}-{1:d}".format(os.getpid(), next(self._key_counter))
+            bucket = SharedBucket(self, key, host, own_limit)
+            self._buckets[key] = bucket
+        self.update(force=True)
+        return bucket
+
+    def release(self, bucket):
+        with self._lock:
+            self._buckets.pop(bucket.key, None)
+        self.update(force=True)
+
+    def update(self, force=False):
+        """ recalculate the rates of all local streams (at most once per interval) """
+        now = time.monotonic()
+        with self._lock:
+            if not force and (now - self._last_update < UPDATE_INTERVAL):
+                return
+            self._last_update = now
+            elapsed = now - self._last_measurement
+            if elapsed >= UPDATE_INTERVAL:
+                self._last_measurement = now
+                for bucket in self._buckets.values():
+                    bucket.measured_rate = bucket.transferred / elapsed
+                    bucket.transferred = 0
+            streams = {key: (bucket.host, bucket.get_demand())
+                       for key, bucket in self._buckets.items()}
+            if self._coordination_file and (self._global_schedule or self._host_schedule):
+                try:
+                    streams = self._exchange_streams(streams)
+                except OSError as exc:
+                    # e.g. an unwritable state directory: the transfer must not fail
+                    log.warning("Failed to coordinate the bandwidth with other processes "
+                                "(%s): sharing the limits only within this process", exc)
+                    self._coordination_file = None
+            global_limit = self._global_schedule.get_limit() if self._global_schedule else None
+            host_limit = self._host_schedule.get_limit() if self._host_schedule else None
+            rates = {key: bucket.own_limit for key, bucket in self._buckets.items()}
+            if global_limit is not None:
+                shares = get_fair_shares(global_limit, {key: demand for key, (host, demand)
+                                                        in streams.items()})
+                self._apply_shares(rates, shares)
+            if host_limit is not None:
+                for current_host in {bucket.host for bucket in self._buckets.values()}:
+                    shares = get_fair_shares(host_limit, {key: demand for key, (host, demand)
+                                                          in streams.items()
+                                                          if host == current_host})
+                    self._apply_shares(rates, shares)
+            for key, bucket in self._buckets.items():
+                if bucket.rate != rates[key]:
+                    log.debug("Changing bandwidth limit of transfer %s: %s", key, rates[key])
+                bucket.rate = bucket.allocated_rate = rates[key]
+
+    @staticmethod
+    def _apply_shares(rates, shares):
+        for key, share in shares.items():
+            if key in rates:
+                rates[key] = share if rates[key] is None else min(rates[key], share)
+
+    def _exchange_streams(self, local_streams):
+        """ publish the local streams and retrieve the streams of all processes """
+        os.makedirs(os.path.dirname(self._coordination_file), exist_ok=True)
+        now = time.time()
+        pid_prefix = "{0:d}-".format(os.getpid())
+        with open(self._coordination_file, "a+") as coordination:
+            fcntl.flock(coordination, fcntl.LOCK_EX)
+            try:
+                coordination.seek(0)
+                try:
+                    entries = json.load(coordination)
+                except ValueError:
+                    entries = {}
+                # remove stale entries and the previous entries of this process
+                entries = {key: value for key, value in entries.items()
+                           if (now - value["timestamp"] < STALE_TIMEOUT)
+                           and not key.startswith(pid_prefix)}
+                for key, (host, demand) in local_streams.items():
+                    entries[key] = {"host": host, "demand": demand, "timestamp": now}
+                coordination.seek(0)
+                coordination.truncate()
+                json.dump(entries, coordination)
+            finally:
+                fcntl.flock(coordination, fcntl.LOCK_UN)
+        return {key: (value["host"], value["demand"]) for key, value in entries.items()}
+
+
+def configure_budget(global_schedule=None, host_schedule=None, coordination_file=None):
+    """ set up the bandwidth budget shared by all transfers of this process """
+    global _budget
+    with _budget_lock:
+        _budget = BandwidthBudget(global_schedule, host_schedule, coordination_file)
+
+
+def get_budget():
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = BandwidthBudget()
+        return _budget
@@ -0,0 +1,273 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+from plumbum import ProcessExecutionError
+
+import bdsync_manager
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.connection import get_connection
+from bdsync_manager.engine import LocalDiffEngine
+from bdsync_manager.task import SyncOptions, bdsync_run
+from bdsync_manager.utils import log, sizeof_fmt
+
+
+# patterns of changes applied to the source image
+PATTERNS = ("scattered", "contiguous", "append", "zero")
+# patterns changing the size of the source (bdsync needs to be told to resize the target)
+RESIZING_PATTERNS = ("append", )
+MODES = ("in-place", "two-phase")
+ENGINES = ("bdsync", "native")
+# the "remote" stand-in executes the commands via a local shell instead of a remote host
+CONNECTIONS = {"local": None,
+               "shell": "sh -c 'exec sh -c \"$*\"' benchmark-remote"}
+# granularity of the allocated extents of the sparse base image
+EXTENT_SIZE = 1024 * 1024
+# size of the blocks changed by the "scattered" pattern
+CHANGE_BLOCK_SIZE = 4096
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _get_random_bytes(rng, count):
+    return rng.getrandbits(8 * count).to_bytes(count, "little") if count else b""
+
+
+def create_image(filename, size, rng, fill_ratio=0.5):
+    """ create a sparse image file with random data in a part of its extents """
+    with open(filename, "wb") as image:
+        image.truncate(size)
+        for offset in range(0, size, EXTENT_SIZE):
+            if rng.random() < fill_ratio:
+                image.seek(offset)
+                image.write(_get_random_bytes(rng, min(EXTENT_SIZE, size - offset)))
+
+
+def copy_image(source_filename, target_filename):
+    """ copy an image file while keeping zero-filled chunks sparse """
+    with open(source_filename, "rb") as source, open(target_filename, "wb") as target:
+        while True:
+            data = source.read(COPY_CHUNK_SIZE)
+            if not data:
+                break
+            if data.count(0) == len(data):
+                target.seek(len(data), os.SEEK_CUR)
+            else:
+                target.write(data)
+        target.truncate(source.tell())
+
+
+def mutate_image(filename, pattern, change_size, rng):
+    """ apply a pattern of changes to an image file
+
+        "change_size" is the number of bytes to be changed.  The changed locations are aligned
+        to blocks of 4 KiB.
+    """
+    size = os.path.getsize(filename)
+    blocks = size // CHANGE_BLOCK_SIZE
+    change_blocks = max(1, min(blocks, change_size // CHANGE_BLOCK_SIZE))
+    with open(filename, "r+b") as image:
+        if pattern == "scattered":
+            for block in rng.sample(range(blocks), change_blocks):
+                image.seek(block * CHANGE_BLOCK_SIZE)
+                image.write(_get_random_bytes(rng, CHANGE_BLOCK_SIZE))
+        elif pattern in ("contiguous", "zero"):
+            image.seek(rng.randrange(blocks - change_blocks + 1) * CHANGE_BLOCK_SIZE)
+            length = change_blocks * CHANGE_BLOCK_SIZE
+            if pattern == "contiguous":
+                image.write(_get_random_bytes(rng, length))
+            else:
+                image.write(bytes(length))
+        elif pattern == "append":
+            image.seek(0, os.SEEK_END)
+            image.write(_get_random_bytes(rng, change_blocks * CHANGE_BLOCK_SIZE))
+        else:
+            raise ValueError("unknown change pattern: {0}".format(pattern))
+
+
+def _images_are_equal(filename1, filename2):
+    if os.path.getsize(filename1) != os.path.getsize(filename2):
+        return False
+    with open(filename1, "rb") as file1, open(filename2, "rb") as file2:
+        while True:
+            data = file1.read(COPY_CHUNK_SIZE)
+            if data != file2.read(COPY_CHUNK_SIZE):
+                return False
+            if not data:
+                return True
+
+
+def get_cases(patterns=PATTERNS, modes=MODES, engines=ENGINES, block_sizes=(None, ),
+              connections=tuple(CONNECTIONS)):
+    """ generate the matrix of benchmark cases (skipping unsupported combinations) """
+    for pattern, mode, engine, block_size, connection in itertools.product(
+            patterns, modes, engines, block_sizes, connections):
+        if (engine == "native") and (CONNECTIONS[connection] is not None):
+            # the native engine supports only local targets
+            continue
+        yield {"pattern": pattern, "mode": mode, "engine": engine, "block_size": block_size,
+               "connection": connection}
+
+
+class Benchmark:
+    """ measure the synchronization of synthetic images for a matrix of settings
+
+        For every change pattern a sparse base image is created and a mutated copy of it serves
+        as the source.  Every case starts with a fresh copy of the base image as its target.
+        The result of every case contains the durations (seconds) of the phases and the size of
+        the patch:
+            total_time: the complete synchronization
+            generate_time: waiting for the patch generator (including the comparison)
+            transfer_time: passing the patch to the target (including bandwidth limits)
+            compression_time: compressing the patch
+            apply_time: applying the stored patch (only for two-phase mode)
+        Generation and transfer run in parallel: their sum is close to the time spent on the
+        patch pipeline.  For in-place mode the application of the patch is part of the transfer.
+    """
+
+    def __init__(self, bdsync_bin, work_dir, image_size, change_size, seed=0, repeat=1,
+                 bandwidth_limit=None, compression=None):
+        self._bdsync_bin = bdsync_bin
+        self._work_dir = work_dir
+        self._image_size = image_size
+        self._change_size = change_size
+        self._seed = seed
+        self._repeat = repeat
+        self._bandwidth_limit = bandwidth_limit
+        self._compression = compression
+
+    def get_parameters(self):
+        return {"image_size": self._image_size, "change_size": self._change_size,
+                "seed": self._seed, "repeat": self._repeat,
+                "bandwidth_limit": self._bandwidth_limit,
+                "compression": self._compression[0] if self._compression else None}
+
+    def _prepare_images(self, pattern):
+        rng = random.Random("{0}:{1}".format(self._seed, pattern))
+        base_filename = os.path.join(self._work_dir, "base.img")
+        source_filename = os.path.join(self._work_dir, "source.img")
+        log.info("Creating images for pattern '%s' (%s)", pattern, sizeof_fmt(self._image_size))
+        create_image(base_filename, self._image_size, rng)
+        copy_image(base_filename, source_filename)
+        mutate_image(source_filename, pattern, self._change_size, rng)
+        return base_filename, source_filename
+
+    def _run_case(self, case, base_filename, source_filename):
+        target_filename = os.path.join(self._work_dir, "target.img")
+        patch_dir = os.path.join(self._work_dir, "patches")
+        os.makedirs(patch_dir, exist_ok=True)
+        copy_image(base_filename, target_filename)
+        connection = get_connection(CONNECTIONS[case["connection"]])
+        bdsync_args = []
+        engine = None
+        if case["engine"] == "native":
+            engine = LocalDiffEngine(**({"block_size": case["block_size"]}
+                                        if case["block_size"] else {}))
+        else:
+            if case["block_size"]:
+                bdsync_args.append("--blocksize={0:d}".format(case["block_size"]))
+            if case["pattern"] in RESIZING_PATTERNS:
+                bdsync_args.append("--diffsize=resize")
+        start_time = time.monotonic()
+        options = SyncOptions(local_bdsync=self._bdsync_bin, remote_bdsync=self._bdsync_bin,
+                              bdsync_args=" ".join(bdsync_args), target_patch_dir=patch_dir,
+                              apply_in_place=(case["mode"] == "in-place"),
+                              bandwidth_limit=self._bandwidth_limit,
+                              compression=self._compression)
+        statistics = bdsync_run(source_filename, target_filename, connection, options,
+                                engine=engine) or {}
+        result = dict(case)
+        result["total_time"] = time.monotonic() - start_time
+        if statistics:
+            result["transfer_time"] = statistics["transfer_time"]
+            result["compression_time"] = statistics["compression_time"]
+            result["generate_time"] = statistics["generate_time"]
+            result["apply_time"] = statistics.get("apply_time")
+            result["patch_size"] = statistics["bytes_transferred"]
+        else:
+            # the native engine applied the changes directly (without a patch)
+            result.update({"transfer_time": None, "compression_time": None,
+                           "generate_time": result["total_time"], "apply_time": None,
+                           "patch_size": None})
+        result["verified"] = _images_are_equal(source_filename, target_filename)
+        if not result["verified"]:
+            log.error("The target differs from the source after the synchronization: %s", case)
+        return result
+
+    def run(self, cases):
+        """ run all cases and return the document containing the parameters and the results """
+        cases = list(cases)
+        results = []
+        os.makedirs(self._work_dir, exist_ok=True)
+        try:
+            # the images are created once per pattern (keeping the order of the cases)
+            for pattern in dict.fromkeys(case["pattern"] for case in cases):
+                base_filename, source_filename = self._prepare_images(pattern)
+                for case in cases:
+                    if case["pattern"] != pattern:
+                        continue
+                    for repetition in range(self._repeat):
+                        log.info("Running benchmark case: %s", case)
+                        try:
+                            result = self._run_case(case, base_filename, source_filename)
+                        except (TaskProcessingError, ProcessExecutionError) as error:
+                            # a failing case must not abort the remaining cases
+                            log.error("Benchmark case failed (%s): %s", case, error)
+                            result = dict(case, error=str(error))
+                        result["repetition"] = repetition
+                        results.append(result)
+        finally:
+            for name in ("base.img", "source.img", "target.img", "patches"):
+                path = os.path.join(self._work_dir, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.unlink(path)
+        return {"version": bdsync_manager.VERSION,
+                "timestamp": time.time(),
+                "host": {"python": platform.python_version(), "machine": platform.machine(),
+                         "cpus": os.cpu_count()},
+                "bdsync_bin": self._bdsync_bin,
+                "parameters": self.get_parameters(),
+                "results": results}
+
+
+def run_benchmark(output, bdsync_bin, image_size, change_size, cases, work_dir=None, **kwargs):
+    """ run the benchmark and write its results (JSON) to a file-like object """
+    temporary_dir = None
+    if work_dir is None:
+        work_dir = temporary_dir = tempfile.mkdtemp(prefix="bdsync-manager-benchmark-",
+                                                    dir="/var/tmp")
+    try:
+        document = Benchmark(bdsync_bin, work_dir, image_size, change_size,
+                             **kwargs).run(cases)
+    finally:
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+    json.dump(document, output, indent=2, sort_keys=True)
+    output.write("\n")
+    return document
@@ -0,0 +1,118 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import hashlib
+import os
+import time
+
+from bdsync_manager.estimate import compare_sample
+from bdsync_manager.history import get_recent_rates
+from bdsync_manager.patch import BLOCK_HEADER
+from bdsync_manager.utils import log, parse_size, sizeof_fmt
+
+
+# the kind of state used for storing the tuned block size of a task
+STATE_BLOCK_SIZE = "block-size"
+DEFAULT_CANDIDATES = "4k,16k,64k,256k,1m"
+# bdsync exchanges the digest (md5) of every block of the target
+DIGEST_SIZE = hashlib.new("md5").digest_size
+# amount of data hashed for measuring the hashing speed for every block size
+HASH_BENCHMARK_SIZE = 8 * 1024 * 1024
+# assumed transfer rate (bytes per second), if the history does not contain any transfers
+DEFAULT_LINK_RATE = 10 * 1024 * 1024
+
+
+def parse_candidates(text):
+    """ parse a comma separated list of block sizes (e.g. "4k,64k") into a sorted list """
+    candidates = sorted({parse_size(item.strip()) for item in text.split(",") if item.strip()})
+    if not candidates:
+        raise ValueError("no block sizes given")
+    smallest = candidates[0]
+    if any(candidate % smallest for candidate in candidates):
+        raise ValueError("all block sizes must be multiples of the smallest one")
+    return candidates
+
+
+def measure_hash_times(candidates):
+    """ measure the time (seconds per byte) spent on hashing data in blocks of every size """
+    data = memoryview(os.urandom(HASH_BENCHMARK_SIZE))
+    result = {}
+    for block_size in candidates:
+        start_time = time.perf_counter()
+        for offset in range(0, len(data), block_size):
+            hashlib.md5(data[offset:offset + block_size]).digest()
+        result[block_size] = (time.perf_counter() - start_time) / len(data)
+    return result
+
+
+def get_link_rate(state_dir, task_name):
+    """ determine the transfer rate (bytes per second) of the recent runs of a task """
+    return get_recent_rates(state_dir, task_name)["link_rate"] or DEFAULT_LINK_RATE
+
+
+def estimate_costs(size, mismatching_ranges, sample_ratio, candidates, hash_times, link_rate):
+    """ estimate the duration of a synchronization for every block size
+
+        The differing ranges of a sample (determined at the granularity of the smallest block
+        size) tell the number of differing blocks for all larger block sizes.  The patch
+        contains every differing block (including its header).  The digests of all blocks are
+        exchanged and all data is hashed (on both hosts in parallel).
+    """
+    result = {}
+    for block_size in candidates:
+        blocks = set()
+        for offset, length in mismatching_ranges:
+            blocks.update(range(offset // block_size, (offset + length - 1) // block_size + 1))
+        patch_size = len(blocks) * (block_size + BLOCK_HEADER.size) / sample_ratio
+        digest_traffic = -(-size // block_size) * DIGEST_SIZE
+        hash_time = size * hash_times[block_size]
+        result[block_size] = {
+            "patch_size": int(patch_size),
+            "digest_traffic": digest_traffic,
+            "hash_time": hash_time,
+            "cost": hash_time + (patch_size + digest_traffic) / link_rate}
+    return result
+
+
+def tune_block_size(source_filename, target_filename, connection, candidates, sample_percent,
+                    link_rate, threads=0, remote_python="python3"):
+    """ determine the block size with the lowest estimated cost for the current changes
+
+        A sample of regions of the source and the target is compared block by block (at the
+        granularity of the smallest candidate, see "bdsync_manager.estimate").  Thus the
+        tuning is only meaningful before a synchronization (while the target differs from the
+        source).  The chosen block size and the estimates of all candidates are returned.
+    """
+    fine_size = candidates[0]
+    result = compare_sample(source_filename, target_filename, connection, fine_size,
+                            candidates[-1], sample_percent, threads, remote_python)
+    sample_ratio = result["compared"] / result["blocks"]
+    estimates = estimate_costs(result["size"], result["mismatching_ranges"], sample_ratio,
+                               candidates, measure_hash_times(candidates), link_rate)
+    block_size = min(candidates, key=lambda candidate: estimates[candidate]["cost"])
+    for candidate in candidates:
+        log.debug("Block size %s: estimated patch size %s, digest traffic %s, hashing %.1fs",
+                  sizeof_fmt(candidate), sizeof_fmt(estimates[candidate]["patch_size"]),
+                  sizeof_fmt(estimates[candidate]["digest_traffic"]),
+                  estimates[candidate]["hash_time"])
+    log.info("Block size tuning: %s (sampled %s of the source, %d differing ranges)",
+             sizeof_fmt(block_size), sizeof_fmt(result["compared"] * fine_size),
+             len(result["mismatching_ranges"]))
+    return block_size, estimates
@@ -19,12 +19,24 @@
 """
 
 import argparse
+import collections
+import datetime
+import json
 import logging
+import os
 import re
+import shutil
+import signal
+import sys
+import time
 
 import bdsync_manager
+import bdsync_manager.bandwidth
+import bdsync_manager.compression
 import bdsync_manager.config
-from bdsync_manager.utils import log
+from bdsync_manager.trace import span, start_tracing, stop_tracing
+from bdsync_manager.utils import log, parse_bandwidth_limit, parse_duration, parse_size, \
+    sizeof_fmt
 
 
 EXITCODE_SUCCESS = 0
@@ -32,6 +44,86 @@ EXITCODE_MISSING_DEPENDENCY = 1
 EXITCODE_CONFIGURATION_ERROR = 2
 EXITCODE_TASK_PROCESSING_ERROR = 3
 EXITCODE_CANCELLED = 4
+DEFAULT_CONTROL_SOCKET = "/run/bdsync-manager.sock"
+# requests accepted by the daemon (see "bdsync_manager.daemon")
+CONTROL_COMMANDS = ("status", "run", "reload")
+# actions for the patch archives (see "bdsync_manager.archive")
+ARCHIVE_COMMANDS = ("list", "compact", "restore")
+# width of the changed-region map of an inspected patch
+REGION_MAP_WIDTH = 64
+
+
+def _get_list_parser(item_parser=str, choices=None):
+    """ create a parser for comma separated lists of values (for argparse) """
+    def parse_list(text):
+        items = [item.strip() for item in text.split(",") if item.strip()]
+        if choices is not None:
+            for item in items:
+                if item not in choices:
+                    raise argparse.ArgumentTypeError("invalid choice: '{0}' (choose from {1})"
+                                                     .format(item, ", ".join(choices)))
+        try:
+            return [item_parser(item) for item in items]
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(str(exc))
+    return parse_list
+
+
+def _parse_point_in_time(text):
+    """ parse a date and time (ISO 8601) or an age (e.g. "3d") into a timestamp """
+    try:
+        return time.time() - parse_duration(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid point in time (expected something like "
+                                         "'2016-05-01 22:00' or '3d'): {0}".format(text))
+
+
+def _add_benchmark_arguments(parser):
+    from bdsync_manager.benchmark import CONNECTIONS, ENGINES, MODES, PATTERNS
+    parser.add_argument("--bdsync-bin", metavar="PATH", dest="bdsync_bin",
+                        default=shutil.which("bdsync"), help="Location of the bdsync binary")
+    parser.add_argument("--size", metavar="SIZE", dest="image_size", type=parse_size,
+                        default="256m", help="Size of the synthetic images (default: 256m)")
+    parser.add_argument("--change-size", metavar="SIZE", dest="change_size", type=parse_size,
+                        default="16m",
+                        help="Number of bytes changed in the source image (default: 16m)")
+    parser.add_argument("--patterns", metavar="LIST", type=_get_list_parser(choices=PATTERNS),
+                        default=list(PATTERNS),
+                        help="Patterns of changes (default: {0})".format(",".join(PATTERNS)))
+    parser.add_argument("--modes", metavar="LIST", type=_get_list_parser(choices=MODES),
+                        default=list(MODES),
+                        help="Synchronization modes (default: {0})".format(",".join(MODES)))
+    parser.add_argument("--engines", metavar="LIST", type=_get_list_parser(choices=ENGINES),
+                        default=list(ENGINES),
+                        help="Diff engines (default: {0})".format(",".join(ENGINES)))
+    parser.add_argument("--block-sizes", metavar="LIST", dest="block_sizes",
+                        type=_get_list_parser(parse_size), default=[None],
+                        help="Block sizes used for the comparison (default: the default of "
+                             "the engine)")
+    parser.add_argument("--connections", metavar="LIST",
+                        type=_get_list_parser(choices=tuple(CONNECTIONS)),
+                        default=list(CONNECTIONS),
+                        help="Local targets and/or targets accessed via a local shell standing "
+                             "in for a remote connection (default: {0})"
+                             .format(",".join(CONNECTIONS)))
+    parser.add_argument("--bandwidth-limit", metavar="LIMIT", dest="bandwidth_limit",
+                        type=parse_bandwidth_limit, help="Limit the speed of the patch transfer")
+    parser.add_argument("--compression", metavar="CODEC",
+                        choices=tuple(sorted(bdsync_manager.compression.CODECS)),
+                        help="Compress the patch for the transfer")
+    parser.add_argument("--repeat", metavar="COUNT", type=int, default=1,
+                        help="Number of runs of every case")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the random content and changes of the images")
+    parser.add_argument("--work-dir", metavar="DIRECTORY", dest="work_dir",
+                        help="Directory for the images (default: a temporary directory below "
+                             "/var/tmp)")
+    parser.add_argument("--output", metavar="FILE", type=argparse.FileType("w"), default="-",
+                        help="Store the results (JSON) in a file (default: standard output)")
 
 
 def parse_arguments():
@@ -41,12 +133,87 @@ def parse_arguments():
     parser.add_argument("--version", action="version",
                         version="%(prog)s {}".format(bdsync_manager.VERSION))
     parser.add_argument("--config", metavar="CONFIG_FILE", dest="config_file",
-                        default="/etc/bdsync-manager.conf", type=argparse.FileType('r'),
-                        help="Location of the config file")
+                        default="/etc/bdsync-manager.conf", help="Location of the config file")
     parser.add_argument("--task", metavar="TASK_NAME", dest="tasks", action="append",
                         help="Optionally execute only one of the tasks described in the "
                              "configuration")
+    parser.add_argument("--jobs", metavar="COUNT", dest="jobs", type=int, default=1,
+                        help="Number of tasks to be processed in parallel")
+    parser.add_argument("--max-jobs-per-host", metavar="COUNT", dest="max_jobs_per_host",
+                        type=int, default=0,
+                        help="Maximum number of parallel tasks using the same remote host "
+                             "(default: no limit)")
+    parser.add_argument("--max-jobs-per-volume-group", metavar="COUNT",
+                        dest="max_jobs_per_volume_group", type=int, default=0,
+                        help="Maximum number of parallel tasks using LVM snapshots in the same "
+                             "volume group (default: no limit)")
+    parser.add_argument("--max-jobs-per-patch-dir", metavar="COUNT",
+                        dest="max_jobs_per_patch_dir", type=int, default=0,
+                        help="Maximum number of parallel tasks storing patches in the same "
+                             "directory (default: no limit)")
+    parser.add_argument("--trace", metavar="FILE", dest="trace_file",
+                        help="Store the durations of all phases and external commands in a file "
+                             "(Chrome trace event format)")
+    parser.add_argument("--profile", metavar="FILE", dest="profile_file",
+                        help="Store a profile of the Python code in a file (see 'pstats')")
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND",
+                                       help="The operation to be executed (default: run)")
+    subparsers.add_parser("run", help="Synchronize the configured tasks")
+    stats_parser = subparsers.add_parser(
+        "stats", help="Summarize the history of the configured tasks (durations, patch sizes, "
+                      "change rates and regressions)")
+    stats_parser.add_argument("--days", metavar="DAYS", type=float,
+                              help="Consider only the runs of the latest days")
+    stats_parser.add_argument("--format", dest="output_format", default="text",
+                              choices=("text", "json"), help="Output format")
+    verify_parser = subparsers.add_parser(
+        "verify", help="Compare the sources and the targets of the configured tasks")
+    verify_parser.add_argument("--full", action="store_true",
+                               help="Read all blocks of the target (ignoring the manifests)")
+    daemon_parser = subparsers.add_parser(
+        "daemon", help="Run the tasks repeatedly according to their schedules (see "
+                       "'schedule_interval') and accept control requests")
+    daemon_parser.add_argument("--socket", dest="control_socket", metavar="PATH",
+                               default=DEFAULT_CONTROL_SOCKET,
+                               help="Location of the control socket (default: %(default)s)")
+    control_parser = subparsers.add_parser(
+        "control", help="Send a request to a running daemon (the configuration file is not used)")
+    control_parser.add_argument("--socket", dest="control_socket", metavar="PATH",
+                                default=DEFAULT_CONTROL_SOCKET,
+                                help="Location of the control socket (default: %(default)s)")
+    control_parser.add_argument("control_command", metavar="REQUEST", choices=CONTROL_COMMANDS,
+                                help="The request: {0}".format(", ".join(CONTROL_COMMANDS)))
+    control_parser.add_argument("control_tasks", metavar="TASK_NAME", nargs="*",
+                                help="The tasks to be started immediately (for 'run')")
+    archive_parser = subparsers.add_parser(
+        "archive", help="List, compact or restore the patch archives of the configured tasks "
+                        "(see 'patch_archive_dir')")
+    archive_parser.add_argument("archive_command", metavar="ACTION", choices=ARCHIVE_COMMANDS,
+                                help="The action: {0}".format(", ".join(ARCHIVE_COMMANDS)))
+    archive_parser.add_argument("--time", dest="archive_time", metavar="TIME",
+                                type=_parse_point_in_time,
+                                help="The point in time: a date (e.g. '2016-05-01 22:00') or "
+                                     "an age (e.g. '3d').  Default for 'restore': now.  "
+                                     "Default for 'compact': 'patch_archive_compact_age'.")
+    archive_parser.add_argument("--output", dest="archive_output", metavar="PATH",
+                                help="The file or blockdevice on the target host receiving the "
+                                     "restored state (required for 'restore')")
+    inspect_parser = subparsers.add_parser(
+        "inspect-patch", help="Summarize a stored patch on the target host of a task (changed "
+                              "blocks, histogram of offsets and changed regions)")
+    inspect_parser.add_argument("patch_path", metavar="PATH",
+                                help="The patch file (relative to 'target_patch_dir' or "
+                                     "absolute)")
+    inspect_parser.add_argument("--buckets", type=int, default=16,
+                                help="Number of buckets of the histogram (default: 16)")
+    inspect_parser.add_argument("--format", dest="output_format", default="text",
+                                choices=("text", "json"), help="Output format")
+    _add_benchmark_arguments(subparsers.add_parser(
+        "benchmark", help="Measure the synchronization of synthetic images for a matrix of "
+                          "settings (the configuration file is not used)"))
     args = parser.parse_args()
+    if args.command is None:
+        args.command = "run"
     log_levels = {"debug": logging.DEBUG,
                   "info": logging.INFO,
                   "warning": logging.WARNING,
@@ -59,6 +226,257 @@ def _get_safe_string(text):
     return re.sub(r"\W", "_", text)
 
 
+def _get_ordered_tasks(task_settings):
+    """ sort tasks by their priority (descending)
+
+        Tasks with the same priority are sorted by the duration of their previous runs
+        (descending, see "bdsync_manager.history"): long running tasks should not delay the end
+        of parallel processing.  The given order is kept otherwise.
+    """
+    from bdsync_manager.history import get_expected_duration
+
+    def get_sort_key(name):
+        duration = get_expected_duration(task_settings[name]["state_dir"], name)
+        return (-task_settings[name]["priority"], -(duration or 0))
+
+    return sorted(task_settings, key=get_sort_key)
+
+
+def run_benchmark_command(args):
+    # late import: avoid import problems before dependency checks (see "main")
+    from bdsync_manager.benchmark import get_cases, run_benchmark
+    from bdsync_manager.connection import close_connections
+    if not args.bdsync_bin or not os.path.isfile(args.bdsync_bin):
+        log.error("The bdsync binary was not found (see '--bdsync-bin')")
+        return EXITCODE_CONFIGURATION_ERROR
+    compression = None
+    if args.compression:
+        if not bdsync_manager.compression.is_codec_available(args.compression):
+            log.error("The Python module required for the compression codec '%s' is not "
+                      "installed", args.compression)
+            return EXITCODE_MISSING_DEPENDENCY
+        compression = (args.compression, None)
+    cases = get_cases(args.patterns, args.modes, args.engines, args.block_sizes,
+                      args.connections)
+    try:
+        document = run_benchmark(args.output, args.bdsync_bin, args.image_size,
+                                 args.change_size, cases, work_dir=args.work_dir,
+                                 seed=args.seed, repeat=args.repeat,
+                                 bandwidth_limit=args.bandwidth_limit, compression=compression)
+    finally:
+        close_connections()
+    if all(result.get("verified") for result in document["results"]):
+        return EXITCODE_SUCCESS
+    else:
+        return EXITCODE_TASK_PROCESSING_ERROR
+
+
+def _get_selected_tasks(settings, selected_names=None):
+    """ return the settings of the selected tasks (all tasks by default)
+
+        Volume group tasks are expanded into the tasks for their volumes.  They may be selected
+        as a whole (by the name of the task) or individually ("TASK/VOLUME").
+        Only the settings of the selected tasks are validated.
+    """
+    result = collections.OrderedDict()
+    unknown = set(selected_names or [])
+    for name, task_settings in settings.tasks.items():
+        is_selected = not selected_names or (name in selected_names)
+        unknown.discard(name)
+        if task_settings["lvm_volume_group"] and not task_settings["disabled"]:
+            prefix = name + "/"
+            if not is_selected and not any(item.startswith(prefix) for item in unknown):
+                continue
+            task_settings = settings.get_validated_task(name)
+            for volume_task_name, volume_settings in \
+                    task_settings.get_volume_group_tasks().items():
+                if is_selected or (volume_task_name in unknown):
+                    unknown.discard(volume_task_name)
+                    result[volume_task_name] = volume_settings
+        elif is_selected:
+            result[name] = settings.get_validated_task(name)
+    for name in sorted(unknown):
+        log.warning("Skipping unknown task: %s", _get_safe_string(name))
+    return result
+
+
+def run_control_command(args):
+    # late import: avoid import problems before dependency checks (see "main")
+    from bdsync_manager.daemon import send_control_request
+    request = {"command": args.control_command, "tasks": args.control_tasks}
+    try:
+        response = send_control_request(args.control_socket, request)
+    except (OSError, ValueError) as exc:
+        log.error("Failed to contact the daemon (%s): %s", args.control_socket, exc)
+        return EXITCODE_TASK_PROCESSING_ERROR
+    print(json.dumps(response, indent=2))
+    if "error" in response:
+        return EXITCODE_TASK_PROCESSING_ERROR
+    return EXITCODE_SUCCESS
+
+
+def run_daemon(args, settings, tasks):
+    """ run the daemon until it is terminated (SIGTERM or SIGINT)
+
+        The daemon starts with the given (already loaded) tasks.  The configuration file is
+        read again on SIGHUP.
+    """
+    from bdsync_manager.daemon import Daemon
+    from bdsync_manager.scheduler import RESOURCE_HOST, RESOURCE_PATCH_DIR, \
+        RESOURCE_VOLUME_GROUP
+    initial_tasks = [tasks]
+
+    def load_tasks():
+        if initial_tasks:
+            return initial_tasks.pop()
+        return _get_selected_tasks(bdsync_manager.config.Configuration(args.config_file),
+                                   args.tasks)
+
+    try:
+        daemon = Daemon(load_tasks, args.control_socket, args.jobs,
+                        {RESOURCE_HOST: args.max_jobs_per_host,
+                         RESOURCE_VOLUME_GROUP: args.max_jobs_per_volume_group,
+                         RESOURCE_PATCH_DIR: args.max_jobs_per_patch_dir})
+    except bdsync_manager.TaskSettingsError as error:
+        log.error(error)
+        return EXITCODE_CONFIGURATION_ERROR
+    bdsync_manager.bandwidth.configure_budget(
+        settings.run_settings["global_bandwidth_limit"],
+        settings.run_settings["host_bandwidth_limit"],
+        os.path.join(settings.run_settings["state_dir"], "bandwidth.json"))
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGHUP, lambda signum, frame: daemon.request_reload())
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    except bdsync_manager.TaskProcessingError as error:
+        log.error(error)
+        return EXITCODE_TASK_PROCESSING_ERROR
+    return EXITCODE_SUCCESS
+
+
+def run_archive_command(args, tasks):
+    # late import: avoid import problems before dependency checks (see "main")
+    from bdsync_manager.connection import close_connections, get_connection
+    from bdsync_manager.task import Task
+    archived = collections.OrderedDict((name, settings) for name, settings in tasks.items()
+                                       if settings["patch_archive_dir"])
+    if not archived:
+        log.error("None of the tasks uses a patch archive (see 'patch_archive_dir')")
+        return EXITCODE_CONFIGURATION_ERROR
+    if (args.archive_command == "restore") and ((len(archived) != 1) or not args.archive_output):
+        log.error("Restoring requires a single task (see '--task') and an output (see "
+                  "'--output')")
+        return EXITCODE_CONFIGURATION_ERROR
+    try:
+        for name, settings in archived.items():
+            archive = Task(settings).get_patch_archive(get_connection(
+                settings["connection_command"], settings["connection_multiplexing"]))
+            if args.archive_command == "list":
+                for entry in archive.get_entries():
+                    print("{0}\t{1}\t{2}\t{3:d}\t{4}".format(
+                        name, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])),
+                        "base" if entry["base"] else "patch", entry["size"], entry["filename"]))
+            elif args.archive_command == "compact":
+                if args.archive_time is not None:
+                    limit = args.archive_time
+                elif settings["patch_archive_compact_age"]:
+                    limit = time.time() - settings["patch_archive_compact_age"]
+                else:
+                    limit = time.time()
+                archive.compact(limit)
+            else:
+                restored = archive.restore(args.archive_time or time.time(), args.archive_output)
+                print("Restored the state of {0}".format(time.ctime(restored)))
+    except bdsync_manager.TaskProcessingError as error:
+        log.error(error)
+        return EXITCODE_TASK_PROCESSING_ERROR
+    finally:
+        close_connections()
+    return EXITCODE_SUCCESS
+
+
+def format_patch_statistics(path, statistics):
+    """ turn the statistics of a patch (see "bdsync_manager.agent.run_inspect") into lines """
+    size = statistics["size"]
+    lines = ["Patch: {0}".format(path),
+             "  Device: {0} ({1})".format(statistics["device"], sizeof_fmt(size)),
+             "  Changed: {0:d} blocks with {1} in {2:d} regions (largest block: {3})".format(
+                 statistics["blocks"], sizeof_fmt(statistics["bytes"]), statistics["regions"],
+                 sizeof_fmt(statistics["largest_block"])),
+             "  Ascending offsets: {0}".format("yes" if statistics["ascending"] else "no")]
+    # the map marks every part of the device by the share of changed bytes
+    histogram = statistics["histogram"]
+    cells = [0] * REGION_MAP_WIDTH
+    for offset, length in statistics["region_list"]:
+        for cell in range(offset * REGION_MAP_WIDTH // max(1, size),
+                          min(REGION_MAP_WIDTH, -(-(offset + length) * REGION_MAP_WIDTH
+                                                  // max(1, size)))):
+            cells[cell] = 1
+    lines.append("  Region map: [{0}]{1}".format(
+        "".join("#" if cell else "." for cell in cells),
+        "" if statistics["regions"] == len(statistics["region_list"])
+        else " (first {0:d} regions)".format(len(statistics["region_list"]))))
+    lines.append("  Histogram (changed bytes):")
+    bucket_size = statistics["bucket_size"]
+    largest = max(histogram) or 1
+    for index, value in enumerate(histogram):
+        lines.append("    {0:>10} - {1:>10}: {2:>10} {3}".format(
+            sizeof_fmt(index * bucket_size), sizeof_fmt(min(size, (index + 1) * bucket_size)),
+            sizeof_fmt(value), "*" * round(40 * value / largest)))
+    return lines
+
+
+def inspect_patch(args, tasks):
+    # late import: avoid import problems before dependency checks (see "main")
+    from plumbum import ProcessExecutionError
+    from bdsync_manager.connection import close_connections, get_agent_command, get_connection
+    if len(tasks) != 1:
+        log.error("Inspecting a patch requires a single task (see '--task')")
+        return EXITCODE_CONFIGURATION_ERROR
+    if args.buckets <= 0:
+        log.error("The number of buckets must be positive")
+        return EXITCODE_CONFIGURATION_ERROR
+    settings = list(tasks.values())[0]
+    path = args.patch_path
+    if not os.path.isabs(path) and settings["target_patch_dir"]:
+        path = os.path.join(settings["target_patch_dir"], path)
+    connection = get_connection(settings["connection_command"],
+                                settings["connection_multiplexing"])
+    python_bin = settings["remote_python_bin"] if connection.is_remote else sys.executable
+    try:
+        output = get_agent_command(connection, python_bin,
+                                   ["inspect", path, "null", args.buckets])()
+    except ProcessExecutionError as exc:
+        details = exc.stderr.strip().splitlines()
+        log.error("Failed to inspect the patch (%s): %s", path, details[-1] if details else exc)
+        return EXITCODE_TASK_PROCESSING_ERROR
+    finally:
+        close_connections()
+    statistics = json.loads(output)
+    if args.output_format == "json":
+        print(json.dumps(statistics, indent=2))
+    else:
+        print("\n".join(format_patch_statistics(path, statistics)))
+    return EXITCODE_SUCCESS
+
+
+def show_statistics(args, tasks):
+    from bdsync_manager.history import format_task_statistics, get_runs, get_task_statistics
+    since = None if args.days is None else time.time() - args.days * 86400
+    summaries = collections.OrderedDict()
+    for task_name, task_settings in tasks.items():
+        runs = get_runs(task_settings["state_dir"], task_name, since)
+        summaries[task_name] = get_task_statistics(runs)
+    if args.output_format == "json":
+        print(json.dumps(summaries, indent=2))
+    else:
+        for task_name, summary in summaries.items():
+            print("\n".join(format_task_statistics(task_name, summary)))
+    return EXITCODE_SUCCESS
+
+
 def main():
     try:
         bdsync_manager.utils.verify_requirements()
@@ -67,38 +485,86 @@ def main():
         return EXITCODE_MISSING_DEPENDENCY
     log.debug("Parsing arguments")
     args = parse_arguments()
+    if not args.trace_file and not args.profile_file:
+        return run_command(args)
+    start_tracing(args.trace_file, args.profile_file)
+    try:
+        with span("bdsync-manager", command=args.command):
+            return run_command(args)
+    finally:
+        stop_tracing()
+
+
+def run_command(args):
+    if args.command == "benchmark":
+        return run_benchmark_command(args)
+    if args.command == "control":
+        return run_control_command(args)
+    if not os.access(args.config_file, os.R_OK):
+        log.error("Failed to read the config file: %s", args.config_file)
+        return EXITCODE_CONFIGURATION_ERROR
     try:
-        settings = bdsync_manager.config.Configuration(args.config_file.name)
+        with span("load configuration", filename=args.config_file):
+            settings = bdsync_manager.config.Configuration(args.config_file)
     except bdsync_manager.TaskSettingsError as error:
         log.error(error)
         return EXITCODE_CONFIGURATION_ERROR
-    if args.tasks:
-        tasks = []
-        for task in args.tasks:
-            if task in settings.tasks:
-                tasks.append(task)
-            else:
-                log.warning("Skipping unknown task: %s", _get_safe_string(task))
-    else:
-        tasks = settings.tasks.keys()
+    try:
+        tasks = _get_selected_tasks(settings, args.tasks)
+    except bdsync_manager.TaskSettingsError as error:
+        log.error(error)
+        return EXITCODE_CONFIGURATION_ERROR
+    except bdsync_manager.TaskProcessingError as error:
+        log.error(error)
+        return EXITCODE_TASK_PROCESSING_ERROR
     if not tasks:
         log.warning("There is nothing to be done (no tasks found in config file).")
-    processing_error = False
+    if args.command == "stats":
+        return show_statistics(args, tasks)
+    if args.command == "archive":
+        return run_archive_command(args, tasks)
+    if args.command == "inspect-patch":
+        return inspect_patch(args, tasks)
+    if args.command == "daemon":
+        return run_daemon(args, settings, tasks)
+    bdsync_manager.bandwidth.configure_budget(
+        settings.run_settings["global_bandwidth_limit"],
+        settings.run_settings["host_bandwidth_limit"],
+        os.path.join(settings.run_settings["state_dir"], "bandwidth.json"))
     # late import: avoid import problems before dependency checks (see above)
-    from bdsync_manager.task import Task
-    for task_name in tasks:
-        task = Task(settings.tasks[task_name])
-        bdsync_manager.utils.set_log_format("[Task {0}] %(levelname)s: %(message)s"
-                                            .format(task_name))
-        try:
-            task.run()
-        except bdsync_manager.TaskProcessingError as error:
-            log.error(str(error))
-            processing_error = True
-        except KeyboardInterrupt:
-            log.error("Terminated via user input")
-            return EXITCODE_CANCELLED
-    if processing_error:
+    from bdsync_manager.scheduler import get_group_resources, Scheduler, RESOURCE_HOST, \
+        RESOURCE_PATCH_DIR, RESOURCE_VOLUME_GROUP
+    from bdsync_manager.connection import close_connections
+    from bdsync_manager.task import get_source_groups, Task, TaskGroup
+    from bdsync_manager.verify import TaskVerification
+    scheduler = Scheduler(args.jobs, {RESOURCE_HOST: args.max_jobs_per_host,
+                                      RESOURCE_VOLUME_GROUP: args.max_jobs_per_volume_group,
+                                      RESOURCE_PATCH_DIR: args.max_jobs_per_patch_dir})
+    ordered_tasks = collections.OrderedDict((name, tasks[name])
+                                            for name in _get_ordered_tasks(tasks))
+    if args.command == "verify":
+        groups = [[task_name] for task_name in ordered_tasks]
+    else:
+        # tasks sharing their source are processed together
+        groups = get_source_groups(ordered_tasks)
+    for group in groups:
+        if args.command == "verify":
+            task = TaskVerification(tasks[group[0]], args.full)
+        elif len(group) == 1:
+            task = Task(tasks[group[0]])
+        else:
+            task = TaskGroup([Task(tasks[task_name]) for task_name in group])
+        scheduler.add("+".join(group), task,
+                      get_group_resources([tasks[task_name] for task_name in group]))
+    try:
+        with span("run tasks", jobs=args.jobs):
+            failed_tasks = scheduler.run()
+    except KeyboardInterrupt:
+        log.error("Terminated via user input")
+        return EXITCODE_CANCELLED
+    finally:
+        close_connections()
+    if failed_tasks:
         return EXITCODE_TASK_PROCESSING_ERROR
     else:
         return EXITCODE_SUCCESS
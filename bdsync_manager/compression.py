@@ -0,0 +1,150 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import importlib
+import lzma
+import zlib
+
+
+# codecs: python module, default level, remote decompression command
+CODECS = {
+    "zlib": ("zlib", 6, ["gzip", "--decompress", "--stdout"]),
+    "lzma": ("lzma", 1, ["xz", "--decompress", "--stdout"]),
+    "zstd": ("zstandard", 3, ["zstd", "--decompress", "--stdout", "--quiet"]),
+    "lz4": ("lz4.frame", 0, ["lz4", "--decompress", "--stdout", "--quiet"]),
+}
+# candidates (codec and level) evaluated by the adaptive mode ("none": no compression)
+AUTO_CANDIDATES = (("none", None), ("lz4", 0), ("zstd", 1), ("zstd", 3), ("zlib", 1),
+                   ("zlib", 6), ("lzma", 1))
+# weight of the latest run for the statistics of the adaptive mode
+STATISTICS_WEIGHT = 0.3
+
+
+def is_codec_available(codec):
+    """ check if the python module required for a codec can be imported """
+    if codec == "none":
+        return True
+    try:
+        importlib.import_module(CODECS[codec][0])
+    except ImportError:
+        return False
+    return True
+
+
+def get_decompress_tokens(codec):
+    return list(CODECS[codec][2])
+
+
+class _LZ4Compressor:
+    """ adapt the frame compressor of the "lz4" module to the usual compress/flush interface """
+
+    def __init__(self, level):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        result = self._header + self._compressor.compress(data)
+        self._header = b""
+        return result
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+def get_compressor(codec, level=None):
+    """ return a compression object (with the methods "compress" and "flush")
+
+        The output formats are understood by the usual command line tools (see
+        "get_decompress_tokens").
+    """
+    if level is None:
+        level = CODECS[codec][1]
+    if codec == "zlib":
+        # gzip container
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif codec == "lzma":
+        return lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=level)
+    elif codec == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    elif codec == "lz4":
+        return _LZ4Compressor(level)
+    else:
+        raise ValueError("unknown compression codec: {0}".format(codec))
+
+
+def _get_candidate_key(codec, level):
+    return codec if level is None else "{0}:{1:d}".format(codec, level)
+
+
+def choose_codec(statistics, is_usable):
+    """ choose the codec and level for the adaptive mode based on the statistics of earlier runs
+
+        Candidates without statistics are tried first.  Afterwards the candidate with the
+        shortest expected transfer time is chosen: compression and transfer run in parallel,
+        thus the slower of both determines the time.  "is_usable" is a function checking if a
+        codec can be used.
+    """
+    link_rate = statistics.get("link_rate")
+    best = None
+    for codec, level in AUTO_CANDIDATES:
+        if not is_usable(codec):
+            continue
+        if codec == "none":
+            ratio, speed = 1, None
+        else:
+            values = statistics.get("codecs", {}).get(_get_candidate_key(codec, level))
+            if not values:
+                return codec, level
+            ratio, speed = values["ratio"], values.get("speed")
+        if not link_rate:
+            # the link was not measured, yet
+            return codec, level
+        # expected time per byte of the patch
+        cost = max(1 / speed if speed else 0, ratio / link_rate)
+        if (best is None) or (cost < best[0]):
+            best = (cost, codec, level)
+    return best[1], best[2]
+
+
+def update_statistics(statistics, codec, level, relay_statistics):
+    """ add the measurements of a transfer to the statistics of the adaptive mode """
+    raw_bytes = relay_statistics["bytes_received"]
+    wire_bytes = relay_statistics["bytes_transferred"]
+    compression_time = relay_statistics["compression_time"]
+    # the time spent on waiting for the patch generator is not related to the link
+    transfer_time = relay_statistics["transfer_time"]
+    if raw_bytes < 1024 * 1024:
+        # too small for meaningful measurements
+        return statistics
+
+    def merge(old, new):
+        return new if old is None else (1 - STATISTICS_WEIGHT) * old + STATISTICS_WEIGHT * new
+
+    if transfer_time > 0:
+        statistics["link_rate"] = merge(statistics.get("link_rate"), wire_bytes / transfer_time)
+    if codec != "none":
+        codecs = statistics.setdefault("codecs", {})
+        values = codecs.setdefault(_get_candidate_key(codec, level), {})
+        values["ratio"] = merge(values.get("ratio"), wire_bytes / raw_bytes)
+        if compression_time > 0:
+            values["speed"] = merge(values.get("speed"), raw_bytes / compression_time)
+    return statistics
@@ -23,16 +23,39 @@ import collections
 import configparser
 import os
 import re
+import shutil
 
-import bdsync_manager.lvm
+import bdsync_manager.bandwidth
+import bdsync_manager.blocksize
+import bdsync_manager.compression
+import bdsync_manager.resources
+import bdsync_manager.scheduler
 from bdsync_manager import TaskSettingsError
-from bdsync_manager.utils import log, parse_bandwidth_limit
+from bdsync_manager.trace import span
+from bdsync_manager.utils import load_state, log, parse_bandwidth_limit, parse_duration, \
+    parse_size, save_state
 
 
 LVM_SIZE_REGEX = re.compile(r"^[0-9]+[bBsSkKmMgGtTpPeE]?$")
+CHANGE_TRACKING_METHODS = ("era", "thin")
+DIFF_ENGINES = ("bdsync", "native")
+APPLY_ENGINES = ("bdsync", "native")
+PATCH_SPACE_ACTIONS = ("fail", "in-place", "defer")
+TARGET_PREALLOCATIONS = ("sparse", "full")
+COMPRESSION_METHODS = ("none", "auto") + tuple(sorted(bdsync_manager.compression.CODECS))
+DEFAULT_STATE_DIR = "/var/lib/bdsync-manager"
+# validated settings of tasks (see "Configuration.get_validated_task")
+STATE_CONFIG_CACHE = "config-cache"
+CONFIG_CACHE_VERSION = 1
 
 
 class Configuration:
+    """ the settings of all tasks of a config file
+
+        The settings of the tasks are parsed at once, but they are validated only when they are
+        requested (see "get_validated_task").  The validated settings are cached in the state
+        directory until the config file is modified.
+    """
 
     def __init__(self, filename):
         log.debug("Reading config file: %s", filename)
@@ -42,62 +65,280 @@ class Configuration:
         except configparser.Error as error:
             raise TaskSettingsError("Failed to parse configuration ({0}): {1}"
                                     .format(filename, error))
-        self._tasks = {key: TaskConfiguration(self.config[key]) for key in self.config.sections()}
+        self._tasks = {key: TaskConfiguration(self.config[key], validate=False)
+                       for key in self.config.sections()}
+        self.run_settings = self._load_run_settings(self.config.defaults())
+        self._cache_name = os.path.abspath(filename)
+        try:
+            details = os.stat(filename)
+        except OSError:
+            self._cache_key = None
+        else:
+            self._cache_key = [CONFIG_CACHE_VERSION, bdsync_manager.VERSION,
+                               details.st_mtime_ns, details.st_size]
+        self._cache = None
 
     @property
     def tasks(self):
+        """ the (not yet validated) settings of all tasks """
         return dict(self._tasks)
 
+    def _get_cache(self):
+        if self._cache is None:
+            state = load_state(self.run_settings["state_dir"], self._cache_name,
+                               STATE_CONFIG_CACHE) or {}
+            if (self._cache_key is None) or (state.get("key") != self._cache_key):
+                state = {"key": self._cache_key, "tasks": {}}
+            self._cache = state
+        return self._cache
+
+    def get_validated_task(self, name):
+        """ return the settings of a task after validating them (once)
+
+            The validation is reduced to checking the local paths, if the cache contains the
+            result of an earlier validation of the unmodified config file.
+        """
+        task = self._tasks[name]
+        if task.is_validated:
+            return task
+        cache = self._get_cache()
+        cached = cache["tasks"].get(name)
+        if cached is not None:
+            log.debug("Using cached settings of task: %s", name)
+            task.restore(cached)
+            return task
+        task.check()
+        if self._cache_key is not None:
+            cache["tasks"][name] = task.export()
+            try:
+                save_state(self.run_settings["state_dir"], self._cache_name,
+                           STATE_CONFIG_CACHE, cache)
+            except OSError as exc:
+                log.debug("Failed to store the validated settings: %s", exc)
+        return task
+
+    @staticmethod
+    def _load_run_settings(defaults):
+        """ parse the settings of the DEFAULT section, which apply to the whole run """
+        settings = {"state_dir": os.path.expanduser(defaults.get("state_dir", DEFAULT_STATE_DIR))}
+        for key in ("global_bandwidth_limit", "host_bandwidth_limit"):
+            value = defaults.get(key, "")
+            try:
+                settings[key] = (bdsync_manager.bandwidth.BandwidthSchedule(value)
+                                 if value else None)
+            except ValueError as exc:
+                raise TaskSettingsError("Failed to parse '{0}' ({1}): {2}"
+                                        .format(key, value, exc))
+        return settings
+
 
 class TaskConfiguration(collections.UserDict):
 
-    def __init__(self, config_section):
+    def __init__(self, config_section, validate=True):
         super().__init__()
-        self._load(config_section)
-        self.validate()
+        self.is_validated = False
+        with span("load settings", task=config_section.name):
+            self._load(config_section)
+        if validate:
+            self.check()
+
+    def check(self):
+        """ validate the settings (unless this happened before) """
+        if not self.is_validated:
+            with span("validate settings", task=self["name"]):
+                self.validate()
+            self.is_validated = True
+
+    def export(self):
+        """ return the validated settings in a serializable form (see "restore") """
+        result = dict(self)
+        if "lvm" in result:
+            result["lvm"] = {key: value for key, value in result["lvm"].items()
+                             if key != "caller"}
+        return result
+
+    def restore(self, settings):
+        """ take over validated settings (see "export")
+
+            Only the cheap checks of the local paths are repeated: files may have disappeared
+            since the validation.
+        """
+        self.data = dict(settings)
+        self._validate_paths()
+        if "lvm" in self:
+            self["lvm"] = dict(self["lvm"], caller=self._get_lvm_caller())
+        self.is_validated = True
+
+    def _get_lvm_caller(self):
+        # late import: plumbum (used by the LVM module) is slow to import
+        import bdsync_manager.lvm
+        return bdsync_manager.lvm.get_caller(self["lvm"]["program_path"])
 
     def _load(self, config):
         # load and validate settings
         try:
+            self["name"] = config.name
             self["local_bdsync_bin"] = config["local_bdsync_bin"]
             self["remote_bdsync_bin"] = config.get("remote_bdsync_bin", None)
             self["bdsync_args"] = config.get("bdsync_args", "")
-            self["source_path"] = config["source_path"]
+            self["lvm_volume_group"] = config.get("lvm_volume_group", None)
+            # the sources of volume group tasks are the volumes of the group
+            self["source_path"] = config.get("source_path", None) if self["lvm_volume_group"] \
+                else config["source_path"]
             self["target_path"] = config["target_path"]
             self["disabled"] = config.getboolean("disabled", False)
             self["apply_patch_in_place"] = config.getboolean("apply_patch_in_place", False)
             self["connection_command"] = config.get("connection_command", None)
+            self["connection_multiplexing"] = config.getboolean("connection_multiplexing", True)
             self["target_patch_dir"] = config.get("target_patch_dir", None)
             self["create_target_if_missing"] = config.getboolean("create_target_if_missing", False)
+            self["target_preallocation"] = config.get("target_preallocation", "sparse").lower()
             self["bandwidth_limit"] = config.get("bandwidth_limit", None)
+            self["priority"] = config.getint("priority", 0)
+            self["diff_engine"] = config.get("diff_engine", "bdsync").lower()
+            self["apply_engine"] = config.get("apply_engine", "bdsync").lower()
+            self["diff_block_size"] = config.getint("diff_block_size", 4096)
+            self["block_size"] = config.get("block_size", "").lower()
+            self["block_size_candidates"] = config.get(
+                "block_size_candidates", bdsync_manager.blocksize.DEFAULT_CANDIDATES)
+            self["block_size_tuning_interval"] = config.get("block_size_tuning_interval", "7d")
+            self["block_size_sample"] = config.getfloat("block_size_sample", 1)
+            self["change_estimation"] = config.getboolean("change_estimation", False)
+            self["change_estimation_sample"] = config.getfloat("change_estimation_sample", 1)
+            self["patch_space_action"] = config.get("patch_space_action", "fail").lower()
+            self["patch_archive_dir"] = config.get("patch_archive_dir", None)
+            self["patch_archive_compact_age"] = config.get("patch_archive_compact_age", None)
+            self["dedup_store_dir"] = config.get("dedup_store_dir", None)
+            self["dedup_index_size"] = config.getint("dedup_index_size", 65536)
+            self["diff_threads"] = config.getint("diff_threads", 0)
+            self["segment_size"] = config.get("segment_size", None)
+            self["segment_count"] = config.getint("segment_count", 0)
+            self["segment_jobs"] = config.getint("segment_jobs", 0)
+            self["resumable"] = config.getboolean("resumable", False)
+            self["io_priority_class"] = config.get("io_priority_class", "").lower()
+            self["io_priority_level"] = config.getint("io_priority_level", None)
+            self["cpu_nice"] = config.getint("cpu_nice", 0)
+            self["cgroup_dir"] = config.get(
+                "cgroup_dir", bdsync_manager.resources.DEFAULT_CGROUP_DIR)
+            self["cgroup_read_limit"] = config.get("cgroup_read_limit", None)
+            self["cgroup_cpu_limit"] = config.getfloat("cgroup_cpu_limit", None)
+            self["io_latency_threshold"] = config.getfloat("io_latency_threshold", None)
+            self["io_latency_device"] = config.get("io_latency_device", None)
+            self["source_sharing"] = config.getboolean("source_sharing", True)
+            self["schedule_interval"] = config.get("schedule_interval", None)
+            self["schedule_window"] = config.get("schedule_window", "")
+            self["verify_block_size"] = config.get("verify_block_size", "1m")
+            self["verify_threads"] = config.getint("verify_threads", 0)
+            self["verify_manifest"] = config.get("verify_manifest", None)
+            self["remote_python_bin"] = config.get("remote_python_bin", "python3")
+            self["compression"] = config.get("compression", "").lower()
+            self["compression_level"] = config.getint("compression_level", None)
+            self["state_dir"] = config.get("state_dir", DEFAULT_STATE_DIR)
+            self["change_tracking"] = config.get("change_tracking", "").lower()
+            self["change_tracking_device"] = config.get("change_tracking_device", None)
+            self["change_tracking_metadata_device"] = config.get(
+                "change_tracking_metadata_device", None)
             lvm_snapshot_enabled = config.getboolean("lvm_snapshot_enabled", False)
             if lvm_snapshot_enabled:
-                self["lvm"] = {"snapshot_size": config["lvm_snapshot_size"],
+                self["lvm"] = {"snapshot_size": config.get("lvm_snapshot_size", None),
                                "snapshot_name": config.get("lvm_snapshot_name", "bdsync-snapshot"),
-                               "program_path": config.get("lvm_program_path", "/sbin/lvm")}
+                               "program_path": config.get("lvm_program_path", "/sbin/lvm"),
+                               "volume_include": config.get("lvm_volume_include", None),
+                               "volume_exclude": config.get("lvm_volume_exclude", None),
+                               "snapshot_limit": config.getint("lvm_snapshot_limit", 0),
+                               "snapshot_batch_size": config.getint(
+                                   "lvm_snapshot_batch_size", 1),
+                               "monitor_interval": config.getfloat(
+                                   "lvm_snapshot_monitor_interval", 10),
+                               "extend_threshold": config.getfloat(
+                                   "lvm_snapshot_extend_threshold", 80),
+                               "extend_size": config.get("lvm_snapshot_extend_size", None),
+                               "max_size": config.get("lvm_snapshot_max_size", None),
+                               "abort_threshold": config.getfloat(
+                                   "lvm_snapshot_abort_threshold", 95)}
         except configparser.NoOptionError as exc:
             raise TaskSettingsError("Missing a mandatory task option: %s" % str(exc))
+        except ValueError as exc:
+            raise TaskSettingsError("Invalid task option: %s" % str(exc))
         # expand path names (e.g. user directories, ...)
         path_filter = os.path.expanduser
         for key in ("local_bdsync_bin", "remote_bdsync_bin", "source_path",
-                    "target_path", "target_patch_dir"):
+                    "target_path", "target_patch_dir", "state_dir", "verify_manifest"):
             # apply filtering only if value is set / non-empty
             if self[key]:
                 self[key] = path_filter(self[key])
 
     def validate(self):
-        if not os.path.isfile(self["local_bdsync_bin"]):
-            raise TaskSettingsError("The local 'bdsync' binary was not found ({0})."
-                                    .format(self["local_bdsync_bin"]))
-        if not os.path.exists(self["source_path"]):
-            raise TaskSettingsError("The source device (source_path={0}) does not exist"
-                                    .format(self["source_path"]))
+        self._validate_paths()
+        if self["lvm_volume_group"]:
+            self._validate_volume_group()
         if self["connection_command"] and not self["remote_bdsync_bin"]:
             raise TaskSettingsError("The setting 'remote_bdsync_bin' is required if "
                                     "'connection_command' is defined.")
         if not self["apply_patch_in_place"] and not self["target_patch_dir"]:
             raise TaskSettingsError("Missing 'target_patch_dir' setting (while "
                                     "'apply_patch_in_place' is disabled).")
+        if self["target_preallocation"] not in TARGET_PREALLOCATIONS:
+            raise TaskSettingsError("Invalid 'target_preallocation' ({0}). Supported methods: {1}"
+                                    .format(self["target_preallocation"],
+                                            ", ".join(TARGET_PREALLOCATIONS)))
+        if self["diff_engine"] not in DIFF_ENGINES:
+            raise TaskSettingsError("Invalid 'diff_engine' ({0}). Supported engines: {1}"
+                                    .format(self["diff_engine"], ", ".join(DIFF_ENGINES)))
+        if (self["diff_engine"] == "native") and self["connection_command"]:
+            raise TaskSettingsError("The 'native' diff engine supports only local targets "
+                                    "(empty 'connection_command')")
+        if self["diff_block_size"] <= 0:
+            raise TaskSettingsError("The 'diff_block_size' must be positive")
+        if self["apply_engine"] not in APPLY_ENGINES:
+            raise TaskSettingsError("Invalid 'apply_engine' ({0}). Supported engines: {1}"
+                                    .format(self["apply_engine"], ", ".join(APPLY_ENGINES)))
+        self._validate_block_size()
+        self._validate_change_estimation()
+        self._validate_patch_archive()
+        self._validate_dedup()
+        self._validate_resource_control()
+        if self["segment_size"]:
+            try:
+                self["segment_size"] = parse_size(self["segment_size"])
+            except ValueError as exc:
+                raise TaskSettingsError("Failed to parse 'segment_size' ({}): {}"
+                                        .format(self["segment_size"], exc))
+        else:
+            self["segment_size"] = None
+        if (self["segment_count"] < 0) or (self["segment_jobs"] < 0):
+            raise TaskSettingsError("The settings 'segment_count' and 'segment_jobs' must not "
+                                    "be negative")
+        try:
+            self["verify_block_size"] = parse_size(self["verify_block_size"])
+        except ValueError as exc:
+            raise TaskSettingsError("Failed to parse 'verify_block_size' ({}): {}"
+                                    .format(self["verify_block_size"], exc))
+        if (self["verify_block_size"] <= 0) or (self["verify_threads"] < 0):
+            raise TaskSettingsError("The setting 'verify_block_size' must be positive and "
+                                    "'verify_threads' must not be negative")
+        if self["resumable"] and not (self["segment_size"] or self["segment_count"]):
+            raise TaskSettingsError("The setting 'resumable' requires 'segment_size' or "
+                                    "'segment_count'")
+        if self["compression"] and (self["compression"] not in COMPRESSION_METHODS):
+            raise TaskSettingsError("Invalid 'compression' ({0}). Supported methods: {1}"
+                                    .format(self["compression"], ", ".join(COMPRESSION_METHODS)))
+        if ((self["compression"] in bdsync_manager.compression.CODECS)
+                and not bdsync_manager.compression.is_codec_available(self["compression"])):
+            raise TaskSettingsError("The Python module required for the compression codec '{0}' "
+                                    "is not installed".format(self["compression"]))
+        if self["schedule_interval"]:
+            try:
+                self["schedule_interval"] = parse_duration(self["schedule_interval"])
+            except ValueError as exc:
+                raise TaskSettingsError("Failed to parse 'schedule_interval' ({}): {}"
+                                        .format(self["schedule_interval"], exc))
+        else:
+            self["schedule_interval"] = None
+        try:
+            bdsync_manager.scheduler.ScheduleWindow(self["schedule_window"])
+        except ValueError as exc:
+            raise TaskSettingsError("Failed to parse 'schedule_window': {}".format(exc))
         if self["bandwidth_limit"]:
             try:
                 value = parse_bandwidth_limit(self["bandwidth_limit"])
@@ -109,13 +350,34 @@ class TaskConfiguration(collections.UserDict):
             # an empty string is interpreted as no limit
             self["bandwidth_limit"] = None
         if "lvm" in self:
-            if not os.path.exists(self["lvm"]["program_path"]):
-                raise TaskSettingsError("Failed to find 'lvm' executable (lvm_program_path='{0}')"
-                                        .format(self["lvm"]["program_path"]))
-            self["lvm"]["caller"] = bdsync_manager.lvm.Caller(self["lvm"]["program_path"])
-            if not LVM_SIZE_REGEX.match(self["lvm"]["snapshot_size"]):
+            self["lvm"]["caller"] = self._get_lvm_caller()
+            if self["change_tracking"] == "thin":
+                # thin snapshots do not require a size
+                self["lvm"]["snapshot_size"] = None
+            elif not self["lvm"]["snapshot_size"]:
+                raise TaskSettingsError("Missing 'lvm_snapshot_size' setting (while "
+                                        "'lvm_snapshot_enabled' is enabled)")
+            elif not LVM_SIZE_REGEX.match(self["lvm"]["snapshot_size"]):
                 raise TaskSettingsError("Invalid LVM snapshot size ({0})"
                                         .format(self["lvm"]["snapshot_size"]))
+            self._validate_snapshot_monitor()
+        if self["change_tracking"]:
+            self._validate_change_tracking()
+
+    def _validate_paths(self):
+        """ check the existence of the local files and directories used by the task
+
+            These checks are repeated for cached settings (see "restore").
+        """
+        if not os.path.isfile(self["local_bdsync_bin"]):
+            raise TaskSettingsError("The local 'bdsync' binary was not found ({0})."
+                                    .format(self["local_bdsync_bin"]))
+        if not self["lvm_volume_group"] and not os.path.exists(self["source_path"]):
+            raise TaskSettingsError("The source device (source_path={0}) does not exist"
+                                    .format(self["source_path"]))
+        if ("lvm" in self) and not os.path.exists(self["lvm"]["program_path"]):
+            raise TaskSettingsError("Failed to find 'lvm' executable (lvm_program_path='{0}')"
+                                    .format(self["lvm"]["program_path"]))
         if not self["connection_command"]:
             # local transfer
             if not os.path.exists(os.path.dirname(self["target_path"])):
@@ -125,3 +387,185 @@ class TaskConfiguration(collections.UserDict):
                 raise TaskSettingsError("The patch directory of the local target "
                                         "(target_patch_dir={0}) does not exist"
                                         .format(self["target_patch_dir"]))
+
+    def _validate_block_size(self):
+        if "--blocksize" in self["bdsync_args"] and self["block_size"]:
+            raise TaskSettingsError("The setting 'block_size' conflicts with '--blocksize' in "
+                                    "'bdsync_args'")
+        if not self["block_size"]:
+            self["block_size"] = None
+        elif self["block_size"] != "auto":
+            try:
+                self["block_size"] = parse_size(self["block_size"])
+            except ValueError as exc:
+                raise TaskSettingsError("Failed to parse 'block_size' ({}): {}"
+                                        .format(self["block_size"], exc))
+        try:
+            self["block_size_candidates"] = bdsync_manager.blocksize.parse_candidates(
+                self["block_size_candidates"])
+            self["block_size_tuning_interval"] = parse_duration(
+                self["block_size_tuning_interval"])
+        except ValueError as exc:
+            raise TaskSettingsError("Invalid block size tuning settings: {}".format(exc))
+        if not 0 < self["block_size_sample"] <= 100:
+            raise TaskSettingsError("The setting 'block_size_sample' must be a percentage "
+                                    "(0..100)")
+
+    def _validate_change_estimation(self):
+        if not 0 < self["change_estimation_sample"] <= 100:
+            raise TaskSettingsError("The setting 'change_estimation_sample' must be a percentage "
+                                    "(0..100)")
+        if self["patch_space_action"] not in PATCH_SPACE_ACTIONS:
+            raise TaskSettingsError("Invalid 'patch_space_action' ({0}). Supported actions: {1}"
+                                    .format(self["patch_space_action"],
+                                            ", ".join(PATCH_SPACE_ACTIONS)))
+
+    def _validate_patch_archive(self):
+        if not self["patch_archive_dir"]:
+            self["patch_archive_dir"] = None
+            if self["patch_archive_compact_age"]:
+                raise TaskSettingsError("The setting 'patch_archive_compact_age' requires "
+                                        "'patch_archive_dir'")
+            return
+        if self["apply_patch_in_place"] or (self["patch_space_action"] == "in-place"):
+            raise TaskSettingsError("The patch archive requires stored patches: disable "
+                                    "'apply_patch_in_place' and avoid 'patch_space_action = "
+                                    "in-place'")
+        if self["segment_size"] or self["segment_count"]:
+            raise TaskSettingsError("The patch archive cannot be combined with segmented "
+                                    "synchronization ('segment_size' / 'segment_count')")
+        if self["patch_archive_compact_age"]:
+            try:
+                self["patch_archive_compact_age"] = parse_duration(
+                    self["patch_archive_compact_age"])
+            except ValueError as exc:
+                raise TaskSettingsError("Failed to parse 'patch_archive_compact_age': {}"
+                                        .format(exc))
+
+    def _validate_dedup(self):
+        if not self["dedup_store_dir"]:
+            self["dedup_store_dir"] = None
+            return
+        if not self["connection_command"]:
+            raise TaskSettingsError("The setting 'dedup_store_dir' requires a remote target "
+                                    "('connection_command')")
+        if self["dedup_index_size"] <= 0:
+            raise TaskSettingsError("The setting 'dedup_index_size' must be positive")
+        if self["segment_size"] or self["segment_count"] or self["patch_archive_dir"]:
+            raise TaskSettingsError("Deduplication cannot be combined with segmented "
+                                    "synchronization ('segment_size' / 'segment_count') or the "
+                                    "patch archive ('patch_archive_dir')")
+
+    def _validate_resource_control(self):
+        classes = bdsync_manager.resources.IO_PRIORITY_CLASSES
+        if self["io_priority_class"] and (self["io_priority_class"] not in classes):
+            raise TaskSettingsError("Invalid 'io_priority_class' ({0}). Supported classes: {1}"
+                                    .format(self["io_priority_class"], ", ".join(classes)))
+        if self["io_priority_class"] and not shutil.which("ionice"):
+            raise TaskSettingsError("The setting 'io_priority_class' requires 'ionice'")
+        if (self["io_priority_level"] is not None) and not 0 <= self["io_priority_level"] <= 7:
+            raise TaskSettingsError("The setting 'io_priority_level' must be between 0 and 7")
+        if not -20 <= self["cpu_nice"] <= 19:
+            raise TaskSettingsError("The setting 'cpu_nice' must be between -20 and 19")
+        if self["cgroup_read_limit"]:
+            try:
+                self["cgroup_read_limit"] = parse_bandwidth_limit(self["cgroup_read_limit"])
+            except ValueError as exc:
+                raise TaskSettingsError("Invalid 'cgroup_read_limit': {0}".format(exc))
+        else:
+            self["cgroup_read_limit"] = None
+        for key in ("cgroup_cpu_limit", "io_latency_threshold"):
+            if (self[key] is not None) and (self[key] <= 0):
+                raise TaskSettingsError("The setting '{0}' must be positive".format(key))
+        if self["io_latency_device"] and not self["io_latency_threshold"]:
+            raise TaskSettingsError("The setting 'io_latency_device' requires "
+                                    "'io_latency_threshold'")
+
+    def _validate_snapshot_monitor(self):
+        settings = self["lvm"]
+        if settings["monitor_interval"] < 0:
+            raise TaskSettingsError("The setting 'lvm_snapshot_monitor_interval' must not be "
+                                    "negative")
+        if not (0 < settings["extend_threshold"] <= 100) \
+                or not (0 < settings["abort_threshold"] <= 100):
+            raise TaskSettingsError("The settings 'lvm_snapshot_extend_threshold' and "
+                                    "'lvm_snapshot_abort_threshold' must be percentages (1..100)")
+        if not settings["extend_size"]:
+            settings["extend_size"] = None
+        elif not LVM_SIZE_REGEX.match(settings["extend_size"]):
+            raise TaskSettingsError("Invalid LVM snapshot extension size ({0})"
+                                    .format(settings["extend_size"]))
+        if settings["max_size"]:
+            try:
+                settings["max_size"] = parse_size(settings["max_size"])
+            except ValueError as exc:
+                raise TaskSettingsError("Failed to parse 'lvm_snapshot_max_size' ({}): {}"
+                                        .format(settings["max_size"], exc))
+        else:
+            settings["max_size"] = None
+
+    def _validate_volume_group(self):
+        if "lvm" not in self:
+            raise TaskSettingsError("The setting 'lvm_volume_group' requires "
+                                    "'lvm_snapshot_enabled'")
+        if "{name}" not in self["target_path"]:
+            raise TaskSettingsError("The 'target_path' of a volume group task must contain the "
+                                    "placeholder '{name}' (the name of the volume)")
+        if self["change_tracking"]:
+            raise TaskSettingsError("Volume group tasks do not support 'change_tracking'")
+        for key in ("volume_include", "volume_exclude"):
+            try:
+                re.compile(self["lvm"][key] or "")
+            except re.error as exc:
+                raise TaskSettingsError("Invalid regular expression in 'lvm_{0}': {1}"
+                                        .format(key, exc))
+
+    def get_volume_group_tasks(self):
+        """ expand a volume group task into the settings of tasks for all of its volumes
+
+            The volumes are enumerated by a single LVM call (see "VolumeGroupInventory").  The
+            names of the tasks are composed of the name of this task and the name of the
+            volume.  All tasks share a coordinator for their snapshots.
+        """
+        import bdsync_manager.lvm
+        caller = self["lvm"]["caller"]
+        inventory = bdsync_manager.lvm.VolumeGroupInventory(caller, self["lvm_volume_group"])
+        coordinator = bdsync_manager.lvm.SnapshotCoordinator(
+            caller, self["lvm_volume_group"], self["lvm"]["snapshot_limit"],
+            self["lvm"]["snapshot_batch_size"])
+        tasks = collections.OrderedDict()
+        for volume_name in inventory.get_volume_names(self["lvm"]["volume_include"],
+                                                      self["lvm"]["volume_exclude"]):
+            settings = dict(self)
+            settings["name"] = "{0}/{1}".format(self["name"], volume_name)
+            settings["source_path"] = inventory.get_attributes(volume_name)["lv_path"]
+            settings["target_path"] = self["target_path"].replace("{name}", volume_name)
+            settings["lvm"] = dict(self["lvm"])
+            settings["lvm"].update(
+                volume=inventory.get_volume(volume_name), coordinator=coordinator,
+                snapshot_name="{0}-{1}".format(volume_name, self["lvm"]["snapshot_name"]))
+            tasks[settings["name"]] = settings
+        return tasks
+
+    def _validate_change_tracking(self):
+        method = self["change_tracking"]
+        if method not in CHANGE_TRACKING_METHODS:
+            raise TaskSettingsError("Invalid 'change_tracking' method ({0}). Supported methods: "
+                                    "{1}".format(method, ", ".join(CHANGE_TRACKING_METHODS)))
+        if method == "era":
+            required_settings = ("change_tracking_device", "change_tracking_metadata_device")
+            required_programs = ("dmsetup", "era_invalidate")
+        else:
+            required_settings = ()
+            required_programs = ("dmsetup", "thin_delta")
+            if "lvm" not in self:
+                raise TaskSettingsError("The change tracking method 'thin' requires "
+                                        "'lvm_snapshot_enabled'")
+        for key in required_settings:
+            if not self[key]:
+                raise TaskSettingsError("Missing '{0}' setting (required for change tracking "
+                                        "via '{1}')".format(key, method))
+        for program in required_programs:
+            if not shutil.which(program):
+                raise TaskSettingsError("Failed to find the program '{0}' (required for change "
+                                        "tracking via '{1}')".format(program, method))
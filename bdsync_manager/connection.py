@@ -0,0 +1,263 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import inspect
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+
+import bdsync_manager.agent
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.trace import CATEGORY_COMMAND, span
+from bdsync_manager.utils import get_command_from_tokens, get_connection_host, log
+
+
+# shell script collecting all information required before a transfer in a single call
+PREFLIGHT_SCRIPT = """
+target={target}
+patch_dir={patch_dir}
+if [ -e "$target" ]; then
+    echo "exists=1"
+    if [ -b "$target" ]; then
+        echo "size=$(blockdev --getsize64 "$target")"
+    else
+        echo "size=$(stat -L --format %s "$target")"
+    fi
+else
+    echo "exists=0"
+fi
+if [ -n "$patch_dir" ]; then
+    echo "free=$(df -P -B1 "$patch_dir" | awk 'NR == 2 {{ print $4 }}')"
+    patch=$(mktemp --tmpdir="$patch_dir" patch-XXXXXX.bdsync) || exit 1
+    echo "patch=$patch"
+else
+    echo "free=$(df -P -B1 "$(dirname "$target")" | awk 'NR == 2 {{ print $4 }}')"
+fi
+"""
+
+_connections = {}
+_connections_lock = threading.Lock()
+# directory for the control sockets of multiplexed ssh connections
+_control_dir = None
+
+
+def get_connection(connection_command, multiplexing=True):
+    """ retrieve the shared connection to a host for the duration of the run
+
+        An empty connection command refers to the local host.
+    """
+    global _control_dir
+    key = (connection_command or "", bool(multiplexing))
+    with _connections_lock:
+        if key not in _connections:
+            if multiplexing and (_control_dir is None):
+                _control_dir = tempfile.mkdtemp(prefix="bdsync-manager-")
+            _connections[key] = Connection(connection_command,
+                                           _control_dir if multiplexing else None)
+        return _connections[key]
+
+
+def close_connections():
+    """ close all connections opened via "get_connection" """
+    global _control_dir
+    with _connections_lock:
+        for connection in _connections.values():
+            connection.close()
+        _connections.clear()
+        if _control_dir is not None:
+            shutil.rmtree(_control_dir, ignore_errors=True)
+            _control_dir = None
+
+
+def get_agent_tokens(python_bin, args):
+    """ return the tokens of a command line running the agent (see "bdsync_manager.agent") """
+    return [python_bin, "-c", inspect.getsource(bdsync_manager.agent)] + [str(arg) for arg in args]
+
+
+def get_agent_command(connection, python_bin, args):
+    """ create a command running the agent (see "bdsync_manager.agent") on the host """
+    tokens = get_agent_tokens(python_bin, args)
+    if connection.is_remote:
+        return get_command_from_tokens(connection.tokens + [shlex.join(tokens)])
+    else:
+        return get_command_from_tokens(tokens)
+
+
+class Connection:
+    """ execute commands on the local host or via a connection command on a remote host
+
+        Short commands are executed by a persistent shell process.  Thus a remote host is
+        contacted only once for all these commands.  ssh connections are multiplexed (if a
+        "control_dir" is given): all further ssh commands (e.g. the bdsync transfers) reuse the
+        connection of the persistent shell.
+    """
+
+    def __init__(self, connection_command, control_dir=None):
+        self.tokens = shlex.split(connection_command or "")
+        self.host = get_connection_host(connection_command)
+        if self.tokens and control_dir and (os.path.basename(self.tokens[0]) == "ssh"):
+            self.tokens[1:1] = ["-o", "ControlMaster=auto",
+                                "-o", "ControlPath={0}".format(os.path.join(control_dir, "%C"))]
+        self._process = None
+        self._errors = None
+        self._programs = {}
+        self._marker = "__bdsync_manager_{0}__".format(uuid.uuid4().hex)
+        self._lock = threading.Lock()
+
+    @property
+    def is_remote(self):
+        return bool(self.tokens)
+
+    def get_command(self, tokens):
+        """ turn a list of command + arguments into a plumbum command to be run on the host """
+        cmd = get_command_from_tokens(tokens)
+        if self.tokens:
+            return get_command_from_tokens(self.tokens + [cmd])
+        else:
+            return cmd
+
+    def _start_shell(self):
+        shell_cmd = self.tokens + ["sh"] if self.tokens else ["sh"]
+        log.debug("Starting persistent shell: %s", " ".join(shell_cmd))
+        # the output of the commands is redirected - stderr receives only the messages of the
+        # connection command (e.g. authentication failures) and of the shell
+        self._close_errors()
+        self._errors = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(shell_cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=self._errors)
+
+    def _get_errors(self):
+        """ return the error messages of the persistent shell (if any) """
+        if self._errors is None:
+            return ""
+        self._errors.seek(0)
+        return self._errors.read().decode(errors="replace").strip()
+
+    def _close_errors(self):
+        if self._errors is not None:
+            self._errors.close()
+            self._errors = None
+
+    def run(self, command):
+        """ execute a shell command and return its exit code and its output
+
+            The output contains stdout and stderr of the command.  The command must not read
+            from stdin.
+        """
+        with self._lock, span("shell", CATEGORY_COMMAND, command=command) as details:
+            if (self._process is None) or (self._process.poll() is not None):
+                self._start_shell()
+            details["pid"] = self._process.pid
+            # the subshell prevents the command from changing the state of the persistent shell
+            request = "( {command}\n) </dev/null 2>&1; printf '\\n%s %d\\n' {marker} $?\n".format(
+                command=command, marker=self._marker)
+            try:
+                self._process.stdin.write(request.encode())
+                self._process.stdin.flush()
+                lines = []
+                while True:
+                    line = self._process.stdout.readline()
+                    if not line:
+                        raise EOFError()
+                    line = line.decode(errors="replace")
+                    if line.startswith(self._marker + " "):
+                        break
+                    lines.append(line)
+            except (OSError, EOFError):
+                self._process.kill()
+                self._process.wait()
+                self._process = None
+                errors = self._get_errors()
+                self._close_errors()
+                message = "Lost the connection to the host ({0})".format(
+                    " ".join(self.tokens) or "localhost")
+                if errors:
+                    message += ": " + errors
+                raise TaskProcessingError(message)
+            details["exit_status"] = int(line.split()[1])
+        # remove the linebreak added in front of the marker
+        output = "".join(lines)[:-1]
+        return details["exit_status"], output
+
+    def check_output(self, command):
+        """ execute a shell command and return its output
+
+            @raises TaskProcessingError if the command failed
+        """
+        returncode, output = self.run(command)
+        if returncode != 0:
+            raise TaskProcessingError("Command failed ({0}): {1}"
+                                      .format(command, output.strip()))
+        return output
+
+    def has_program(self, name):
+        """ check if a program is available on the host (the result is cached) """
+        if name not in self._programs:
+            returncode, output = self.run("command -v {0}".format(shlex.quote(name)))
+            self._programs[name] = (returncode == 0)
+        return self._programs[name]
+
+    def preflight(self, target_path, patch_dir=None):
+        """ retrieve all information about the target required before a transfer
+
+            A temporary patch file is created if "patch_dir" is given.  The result is a
+            dictionary with the keys "exists", "size" (of the target), "free" (space in the patch
+            directory or the target's directory) and "patch_path".
+        """
+        script = PREFLIGHT_SCRIPT.format(target=shlex.quote(target_path),
+                                         patch_dir=shlex.quote(patch_dir or ""))
+        log.debug("Running preflight checks for target: %s", target_path)
+        values = dict(line.split("=", 1)
+                      for line in self.check_output(script).splitlines() if "=" in line)
+        result = {"exists": values.get("exists") == "1",
+                  "size": None, "free": None, "patch_path": values.get("patch")}
+        for key in ("size", "free"):
+            try:
+                result[key] = int(values[key])
+            except (KeyError, ValueError):
+                pass
+        log.debug("Preflight result: %s", result)
+        return result
+
+    def get_free_space(self, path):
+        """ return the number of bytes available in the filesystem containing "path" """
+        output = self.check_output("df -P -B1 {0} | awk 'NR == 2 {{ print $4 }}'"
+                                   .format(shlex.quote(path)))
+        try:
+            return int(output.strip())
+        except ValueError:
+            raise TaskProcessingError("Failed to determine the free space in '{0}': {1}"
+                                      .format(path, output.strip()))
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                try:
+                    self._process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+                    self._process.wait()
+                self._process = None
+            self._close_errors()
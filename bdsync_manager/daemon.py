@@ -0,0 +1,288 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from bdsync_manager import BDSyncManagerError, TaskProcessingError
+from bdsync_manager.connection import close_connections
+from bdsync_manager.history import get_last_start_time
+from bdsync_manager.relay import get_transfer_progress
+from bdsync_manager.scheduler import get_group_resources, Scheduler, ScheduleWindow
+from bdsync_manager.task import get_source_groups, Task, TaskGroup
+from bdsync_manager.utils import log
+
+
+# interval (seconds) between checks for due tasks
+TICK_INTERVAL = 1
+
+
+class _ScheduledUnit:
+    """ a task (or a group of tasks sharing their source) and the state of its schedule
+
+        The schedule is based on the settings of the first task.  The first run is due one
+        interval after the latest run recorded in the history.
+    """
+
+    def __init__(self, settings_list):
+        self.settings_list = settings_list
+        self.name = "+".join(settings["name"] for settings in settings_list)
+        self.interval = settings_list[0]["schedule_interval"]
+        self.window = ScheduleWindow(settings_list[0]["schedule_window"])
+        self.running = False
+        self.triggered = False
+        self.last_start = None
+        self.last_duration = None
+        self.last_success = None
+        latest = [get_last_start_time(settings["state_dir"], settings["name"])
+                  for settings in settings_list]
+        latest = [value for value in latest if value is not None]
+        self.next_run = None if self.interval is None else \
+            (min(latest) + self.interval if latest else time.time())
+
+    def adopt_state(self, other):
+        """ keep the state of the same unit loaded from an earlier configuration """
+        for key in ("running", "triggered", "last_start", "last_duration", "last_success"):
+            setattr(self, key, getattr(other, key))
+        if (self.interval is not None) and (other.next_run is not None):
+            self.next_run = other.next_run
+
+    def is_due(self, now):
+        if self.running:
+            return False
+        if self.triggered:
+            return True
+        return (self.next_run is not None) and (self.next_run <= now) and self.window.contains(now)
+
+    def get_task(self):
+        tasks = [Task(settings) for settings in self.settings_list]
+        return tasks[0] if len(tasks) == 1 else TaskGroup(tasks)
+
+    def finish(self, success, now):
+        self.running = False
+        self.last_duration = now - self.last_start
+        self.last_success = success
+        if self.interval is None:
+            return
+        # runs missed during a long run are skipped (instead of running repeatedly)
+        missed = max(0, int((now - self.last_start) // self.interval))
+        if missed:
+            log.warning("Skipping %d overlapping run(s) of %s", missed, self.name)
+        self.next_run = self.last_start + (missed + 1) * self.interval
+
+    def get_status(self):
+        return {"name": self.name,
+                "state": "running" if self.running else "idle",
+                "interval": self.interval,
+                "next_run": self.next_run,
+                "last_start": self.last_start,
+                "last_duration": self.last_duration,
+                "last_success": self.last_success}
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """ process a single request (a JSON line) and send the response (a JSON line) """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            response = self.server.daemon.handle_request(request)
+        except (ValueError, KeyError, TypeError) as exc:
+            response = {"error": "Invalid request: {0}".format(exc)}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+
+class Daemon:
+    """ run tasks repeatedly according to their schedule (see "schedule_interval")
+
+        The configuration, the LVM callers and the connections to remote hosts are kept between
+        the runs.  A run is never started while the previous run of the same task is still
+        busy.  A local UNIX socket accepts control requests (see "send_control_request"):
+        querying the status (including the progress of running transfers), triggering tasks
+        and reloading the configuration.
+    """
+
+    def __init__(self, load_tasks, socket_path, jobs=1, resource_limits=None):
+        self._load_tasks = load_tasks
+        self._socket_path = socket_path
+        self._scheduler = Scheduler(jobs, resource_limits, persistent=True,
+                                    on_finished=self._on_finished)
+        self._lock = threading.Lock()
+        self._units = {}
+        self._stopped = threading.Event()
+        self._reload_requested = threading.Event()
+        self._load()
+
+    def _load(self):
+        """ read the configuration and create the schedules for all tasks """
+        tasks = self._load_tasks()
+        # tasks sharing their source are grouped only if they share their schedule, too
+        by_schedule = {}
+        for name, settings in tasks.items():
+            key = (settings["schedule_interval"], settings["schedule_window"])
+            by_schedule.setdefault(key, collections.OrderedDict())[name] = settings
+        units = {}
+        for schedule_tasks in by_schedule.values():
+            for group in get_source_groups(schedule_tasks):
+                unit = _ScheduledUnit([tasks[name] for name in group])
+                units[unit.name] = unit
+        with self._lock:
+            for name, unit in units.items():
+                if name in self._units:
+                    unit.adopt_state(self._units[name])
+            self._units = units
+        if not any(unit.interval for unit in units.values()):
+            log.warning("No task has a 'schedule_interval': tasks run only on request")
+
+    def request_reload(self):
+        self._reload_requested.set()
+
+    def stop(self):
+        self._stopped.set()
+
+    def handle_request(self, request):
+        command = request["command"]
+        if command == "status":
+            with self._lock:
+                units = [unit.get_status() for unit in self._units.values()]
+            return {"tasks": units, "transfers": get_transfer_progress()}
+        elif command == "run":
+            names = request.get("tasks") or []
+            result = {}
+            with self._lock:
+                for name in names:
+                    unit = self._find_unit(name)
+                    if unit is None:
+                        result[name] = "unknown"
+                    elif unit.running:
+                        result[name] = "running"
+                    else:
+                        unit.triggered = True
+                        result[name] = "triggered"
+            return {"tasks": result}
+        elif command == "reload":
+            self.request_reload()
+            return {"reload": "requested"}
+        else:
+            return {"error": "Unknown command: {0}".format(command)}
+
+    def _find_unit(self, name):
+        """ find the unit of a task (or the unit of a group of tasks) """
+        for unit in self._units.values():
+            if (unit.name == name) or \
+                    any(settings["name"] == name for settings in unit.settings_list):
+                return unit
+        return None
+
+    def _on_finished(self, name, success):
+        with self._lock:
+            unit = self._units.get(name)
+            if unit is not None:
+                unit.finish(success, time.time())
+
+    def _start_due_units(self):
+        now = time.time()
+        with self._lock:
+            due = [unit for unit in self._units.values() if unit.is_due(now)]
+            for unit in due:
+                unit.running = True
+                unit.triggered = False
+                unit.last_start = now
+        for unit in due:
+            log.info("Starting scheduled run: %s", unit.name)
+            self._scheduler.add(unit.name, unit.get_task(),
+                                get_group_resources(unit.settings_list))
+
+    def _open_socket(self):
+        if os.path.exists(self._socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._socket_path)
+            except OSError:
+                # a remainder of a previous daemon
+                os.unlink(self._socket_path)
+            else:
+                raise TaskProcessingError("Another daemon is using the control socket: {0}"
+                                          .format(self._socket_path))
+            finally:
+                probe.close()
+        old_umask = os.umask(0o077)
+        try:
+            server = _ControlServer(self._socket_path, _ControlHandler)
+        finally:
+            os.umask(old_umask)
+        server.daemon = self
+        return server
+
+    def run(self):
+        """ process the schedules until "stop" is called """
+        server = self._open_socket()
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True,
+                                         name="bdsync-control")
+        server_thread.start()
+        scheduler_thread = threading.Thread(target=self._scheduler.run, daemon=True,
+                                            name="bdsync-scheduler")
+        scheduler_thread.start()
+        log.info("Daemon started (control socket: %s)", self._socket_path)
+        try:
+            while not self._stopped.wait(TICK_INTERVAL):
+                if self._reload_requested.is_set():
+                    self._reload_requested.clear()
+                    log.info("Reloading the configuration")
+                    try:
+                        self._load()
+                    except BDSyncManagerError as exc:
+                        log.error("Keeping the previous configuration: %s", exc)
+                self._start_due_units()
+        finally:
+            log.info("Stopping the daemon: waiting for running tasks to finish")
+            server.shutdown()
+            server.server_close()
+            os.unlink(self._socket_path)
+            self._scheduler.cancel()
+            scheduler_thread.join()
+            close_connections()
+
+
+def send_control_request(socket_path, request):
+    """ send a request to a running daemon and return its response """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        client.sendall(json.dumps(request).encode() + b"\n")
+        response = b""
+        while not response.endswith(b"\n"):
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+    finally:
+        client.close()
+    return json.loads(response.decode())
@@ -0,0 +1,255 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import threading
+
+from plumbum import ProcessExecutionError
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.agent import BLOCK_HEADER, DEDUP_MISSING_MESSAGE, DEDUP_RECORD, \
+    DEDUP_REFERENCE, DEDUP_STORE, get_dedup_digest
+from bdsync_manager.connection import get_agent_command
+from bdsync_manager.utils import load_state, log, save_state, sizeof_fmt
+
+
+STATE_DEDUP = "dedup"
+INDEX_VERSION = 1
+# smaller blocks are not worth a reference (see "DEDUP_RECORD")
+MIN_BLOCK_SIZE = 1024
+
+# indexes shared by all tasks of this process (see "get_dedup_index")
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class DedupIndex:
+    """ the digests of the blocks in the store of a target host (least recently used first)
+
+        The index is shared by all tasks using the same store.  Its size is limited: the
+        least recently used blocks are evicted.  Evicted blocks are removed from the store only
+        while no transfer is using the store (a running transfer may refer to them).  The
+        index is stored in the state directory after every successful transfer.
+    """
+
+    def __init__(self, state_dir, host, store_dir, capacity):
+        self.host = host
+        self.store_dir = store_dir
+        self.capacity = capacity
+        self._state_dir = state_dir
+        self._state_name = "{0}:{1}".format(host, store_dir)
+        self._digests = collections.OrderedDict()
+        self._evicted = set()
+        self._active = 0
+        self._clear = False
+        self._lock = threading.Lock()
+        state = load_state(state_dir, self._state_name, STATE_DEDUP)
+        if state and (state.get("version") == INDEX_VERSION):
+            for digest in state["digests"][-capacity:]:
+                self._digests[bytes.fromhex(digest)] = None
+
+    def __len__(self):
+        return len(self._digests)
+
+    def start(self):
+        with self._lock:
+            self._active += 1
+
+    def lookup(self, digest):
+        """ check if a block is part of the store (and mark it as recently used) """
+        with self._lock:
+            if digest not in self._digests:
+                return False
+            self._digests.move_to_end(digest)
+            return True
+
+    def finish(self, added=None):
+        """ add the blocks stored by a successful transfer (if given)
+
+            The blocks to be removed from the store are returned, if no other transfer is
+            running.  None is returned, if the complete store should be cleared.
+        """
+        with self._lock:
+            self._active -= 1
+            for digest in added or ():
+                self._digests[digest] = None
+                self._digests.move_to_end(digest)
+                self._evicted.discard(digest)
+            while len(self._digests) > self.capacity:
+                self._evicted.add(self._digests.popitem(last=False)[0])
+            if self._active > 0:
+                if added is not None:
+                    self._save()
+                return []
+            self._evicted, evicted = set(), sorted(self._evicted)
+            if self._clear:
+                # blocks added after the reset may be affected by clearing the store
+                self._clear = False
+                self._digests.clear()
+                evicted = None
+            if (added is not None) or (evicted is None):
+                self._save()
+            return evicted
+
+    def reset(self):
+        """ forget all blocks (e.g. after the store turned out to be incomplete)
+
+            The store is cleared as soon as no transfer is using it.
+        """
+        with self._lock:
+            self._digests.clear()
+            self._evicted.clear()
+            self._clear = True
+            self._save()
+
+    def _save(self):
+        save_state(self._state_dir, self._state_name, STATE_DEDUP,
+                   {"version": INDEX_VERSION, "host": self.host, "store": self.store_dir,
+                    "digests": [digest.hex() for digest in self._digests]})
+
+
+def get_dedup_index(state_dir, host, store_dir, capacity):
+    """ return the index of the block store of a host (shared by all tasks using the store) """
+    key = (state_dir, host, store_dir)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = DedupIndex(state_dir, host, store_dir, capacity)
+        return _indexes[key]
+
+
+class DedupSession:
+    """ deduplicate the blocks of the patches of a synchronization run (a context manager)
+
+        Blocks contained in the store of the target host are sent as references.  All other
+        blocks are added to the store while the patch is applied (see
+        "bdsync_manager.agent.run_expand").  The blocks stored by the run are added to the
+        index only after the run succeeded.  The index and the store are cleared if the store
+        turns out to lack a block.
+    """
+
+    def __init__(self, index, connection, python_bin):
+        self.index = index
+        self.python_bin = python_bin
+        self._connection = connection
+        self._added = set()
+        self.references = 0
+        self.bytes_saved = 0
+
+    @property
+    def store_dir(self):
+        return self.index.store_dir
+
+    def __enter__(self):
+        self.index.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            log.info("Deduplication: %d block(s) (%s) sent as references, %d block(s) stored",
+                     self.references, sizeof_fmt(self.bytes_saved), len(self._added))
+            self._forget(self.index.finish(self._added))
+            return
+        if DEDUP_MISSING_MESSAGE in "{0} {1}".format(
+                exc_value, getattr(exc_value, "stderr", "") or ""):
+            log.warning("The dedup store of the target host is incomplete: clearing it")
+            self.index.reset()
+        self._forget(self.index.finish())
+
+    def encode_block(self, offset, data):
+        """ return the record of a block within the deduplicated patch """
+        if len(data) < MIN_BLOCK_SIZE:
+            return BLOCK_HEADER.pack(offset, len(data)) + data
+        digest = get_dedup_digest(data)
+        if (digest in self._added) or self.index.lookup(digest):
+            self.references += 1
+            self.bytes_saved += len(data)
+            return BLOCK_HEADER.pack(offset, DEDUP_REFERENCE) + DEDUP_RECORD.pack(len(data),
+                                                                                  digest)
+        self._added.add(digest)
+        return BLOCK_HEADER.pack(offset, DEDUP_STORE) + DEDUP_RECORD.pack(len(data), digest) \
+            + data
+
+    def _forget(self, digests):
+        """ remove the given blocks (None: all blocks) from the store """
+        if digests == []:
+            return
+        if digests is None:
+            command = get_agent_command(self._connection, self.python_bin,
+                                        ["forget", self.store_dir, "all"])
+        else:
+            command = get_agent_command(self._connection, self.python_bin,
+                                        ["forget", self.store_dir, "list"]) \
+                << "".join(digest.hex() + "\n" for digest in digests)
+        try:
+            command()
+        except ProcessExecutionError as exc:
+            # orphaned blocks waste space, but they are harmless
+            log.warning("Failed to remove blocks from the dedup store: %s",
+                        exc.stderr.strip().splitlines()[-1:] or exc)
+        else:
+            log.debug("Removed %s block(s) from the dedup store",
+                      "all" if digests is None else len(digests))
+
+
+class DedupEncoder:
+    """ replace the blocks of a bdsync patch stream with references (see "DedupSession")
+
+        The encoder provides the interface of a compression object ("compress" and "flush",
+        see "bdsync_manager.compression").  Thus it is used by the relay of a transfer.  Its
+        output is passed to a compressor, if given.
+    """
+
+    def __init__(self, session, compressor=None):
+        self._session = session
+        self._compressor = compressor
+        self._buffer = bytearray()
+        self._header_done = False
+
+    def _pass(self, data):
+        return data if self._compressor is None else self._compressor.compress(data)
+
+    def compress(self, data):
+        buffer = self._buffer
+        buffer += data
+        output = bytearray()
+        position = 0
+        if not self._header_done:
+            end = buffer.find(b"\n\n")
+            if end < 0:
+                return b""
+            position = end + 2
+            output += buffer[:position]
+            self._header_done = True
+        while len(buffer) - position >= BLOCK_HEADER.size:
+            offset, length = BLOCK_HEADER.unpack_from(buffer, position)
+            end = position + BLOCK_HEADER.size + length
+            if end > len(buffer):
+                break
+            output += self._session.encode_block(
+                offset, bytes(buffer[position + BLOCK_HEADER.size:end]))
+            position = end
+        del buffer[:position]
+        return self._pass(bytes(output))
+
+    def flush(self):
+        if self._buffer:
+            raise TaskProcessingError("Incomplete patch: {0:d} trailing bytes"
+                                      .format(len(self._buffer)))
+        return b"" if self._compressor is None else self._compressor.flush()
@@ -0,0 +1,178 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import mmap
+import os
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.patch import PatchWriter
+from bdsync_manager.utils import check_abort, get_file_size, log, sizeof_fmt
+
+
+class LocalDiffEngine:
+    """ compare and synchronize a local source and a local target without bdsync
+
+        Both files are memory-mapped.  Chunks of both files are hashed in parallel by a pool of
+        threads (hashlib releases the GIL while hashing).  Only the blocks of differing chunks
+        are hashed individually.  Adjacent differing blocks are coalesced into large writes.
+    """
+
+    def __init__(self, block_size=4096, threads=None, hash_name="md5", chunk_blocks=256,
+                 max_write_size=8 * 1024 * 1024):
+        self._block_size = block_size
+        self._threads = threads or os.cpu_count() or 1
+        self._hash_name = hash_name
+        self._chunk_size = block_size * chunk_blocks
+        # the write size is a multiple of the chunk size: writes stay aligned to chunks
+        self._max_write_size = max(self._chunk_size,
+                                   max_write_size - (max_write_size % self._chunk_size))
+
+    def _get_digest(self, data):
+        return hashlib.new(self._hash_name, data).digest()
+
+    def _compare_chunk(self, source_view, target_view, offset, length):
+        """ return the differing ranges (offset and length) of a chunk """
+        end = offset + length
+        if self._get_digest(source_view[offset:end]) == self._get_digest(target_view[offset:end]):
+            return []
+        ranges = []
+        for block_offset in range(offset, end, self._block_size):
+            block_end = min(block_offset + self._block_size, end)
+            if self._get_digest(source_view[block_offset:block_end]) != \
+                    self._get_digest(target_view[block_offset:block_end]):
+                if ranges and (ranges[-1][0] + ranges[-1][1] == block_offset):
+                    ranges[-1] = (ranges[-1][0], block_end - ranges[-1][0])
+                else:
+                    ranges.append((block_offset, block_end - block_offset))
+        return ranges
+
+    def _get_differing_ranges(self, source_view, target_view, size, ranges=None):
+        """ compare chunks in parallel and return the differing ranges in ascending order
+
+            The comparison is restricted to the given ranges (if specified).
+        """
+        if ranges is None:
+            ranges = [(0, size)]
+        chunks = ((chunk_offset, min(self._chunk_size, offset + length - chunk_offset))
+                  for offset, length in ranges
+                  for chunk_offset in range(offset, offset + length, self._chunk_size))
+        with concurrent.futures.ThreadPoolExecutor(self._threads) as executor:
+            # limit the number of pending chunks (results are consumed in order)
+            pending = collections.deque()
+            for chunk_offset, chunk_length in chunks:
+                check_abort()
+                pending.append(executor.submit(self._compare_chunk, source_view, target_view,
+                                               chunk_offset, chunk_length))
+                if len(pending) >= 4 * self._threads:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _coalesce(self, ranges):
+        """ merge adjacent ranges up to the maximum write size (aligned to its boundaries) """
+        current = None
+        for offset, length in ranges:
+            if (current is not None) and (current[0] + current[1] == offset) \
+                    and (current[0] // self._max_write_size == offset // self._max_write_size):
+                current = (current[0], current[1] + length)
+                continue
+            if current is not None:
+                yield current
+            current = (offset, length)
+        if current is not None:
+            yield current
+
+    def _process(self, source_filename, target_filename, handle_range, ranges=None):
+        """ call "handle_range" with the offset and the data of every differing range
+
+            Data beyond the end of the target is always treated as differing.
+        """
+        source_size = get_file_size(source_filename)
+        target_size = get_file_size(target_filename)
+        compare_size = min(source_size, target_size)
+        if ranges is not None:
+            ranges = [(offset, min(offset + length, compare_size) - offset)
+                      for offset, length in ranges if offset < compare_size]
+        with open(source_filename, "rb") as source_file, \
+                open(target_filename, "rb") as target_file:
+            if compare_size > 0:
+                source_map = mmap.mmap(source_file.fileno(), compare_size, access=mmap.ACCESS_READ)
+                target_map = mmap.mmap(target_file.fileno(), compare_size, access=mmap.ACCESS_READ)
+                source_view = memoryview(source_map)
+                target_view = memoryview(target_map)
+                try:
+                    for offset, length in self._coalesce(self._get_differing_ranges(
+                            source_view, target_view, compare_size, ranges)):
+                        handle_range(offset, source_view[offset:offset + length])
+                finally:
+                    # all views need to be released before closing the maps
+                    source_view.release()
+                    target_view.release()
+                    source_map.close()
+                    target_map.close()
+            # append the remaining part of the source
+            offset = compare_size
+            while offset < source_size:
+                length = min(self._max_write_size, source_size - offset)
+                source_file.seek(offset)
+                handle_range(offset, source_file.read(length))
+                offset += length
+        return source_size
+
+    def sync(self, source_filename, target_filename, ranges=None):
+        """ write all differing blocks of the source to the target
+
+            A target file is extended if it is smaller than the source.  The number of written
+            bytes is returned.
+        """
+        source_size = get_file_size(source_filename)
+        if get_file_size(target_filename) < source_size:
+            if not os.path.isfile(target_filename):
+                raise TaskProcessingError("The target ({0}) is smaller than the source"
+                                          .format(target_filename))
+            os.truncate(target_filename, source_size)
+        written = 0
+        with open(target_filename, "r+b") as target_file:
+            target_fd = target_file.fileno()
+
+            def write_range(offset, data):
+                nonlocal written
+                while data:
+                    count = os.pwrite(target_fd, data, offset)
+                    data = data[count:]
+                    offset += count
+                    written += count
+
+            self._process(source_filename, target_filename, write_range, ranges)
+            os.fsync(target_fd)
+        log.info("Changed data written to target: %s", sizeof_fmt(written))
+        return written
+
+    def write_patch(self, source_filename, target_filename, stream, ranges=None):
+        """ write a bdsync patch containing all differing blocks into a stream
+
+            The patch refers to the target: "bdsync --patch" applies it to this device.
+        """
+        writer = PatchWriter(stream, target_filename, get_file_size(source_filename))
+        self._process(source_filename, target_filename, writer.write_block, ranges)
+        writer.finish()
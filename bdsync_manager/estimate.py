@@ -0,0 +1,134 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.patch import BLOCK_HEADER
+from bdsync_manager.utils import log, sizeof_fmt
+
+
+# the default block size of bdsync
+DEFAULT_BLOCK_SIZE = 4096
+# size of the sampled regions: large enough for catching clustered changes efficiently
+DEFAULT_REGION_SIZE = 1024 * 1024
+# the upper bounds of the estimation are this number of standard errors above the mean
+CONFIDENCE_FACTOR = 2
+
+
+def compare_sample(source_filename, target_filename, connection, block_size, region_size,
+                   sample_percent, threads=0, remote_python="python3"):
+    """ compare evenly spaced regions of the source and the target block by block
+
+        The regions (with "region_size" bytes each) cover about "sample_percent" of the
+        source.  Both hosts read only these regions (via the agent of the verification, see
+        "bdsync_manager.verify").  The result of "verify_target" is returned along with the
+        layout of the sample ("region_size" and "region_step").
+        A TaskProcessingError is raised if the target is missing or differs in size.
+    """
+    # late import: the verification depends on the task module
+    from bdsync_manager.verify import verify_target
+    region_blocks = max(1, region_size // block_size)
+    region_step = max(1, round(100 / sample_percent))
+    result = verify_target(source_filename, target_filename, connection, block_size,
+                           threads=threads, remote_python=remote_python,
+                           sample=(region_blocks, region_step))
+    if result["size"] != result["source_size"]:
+        raise TaskProcessingError("the size of the target differs from the source")
+    if not result["compared"]:
+        raise TaskProcessingError("the source is empty")
+    result.update(block_size=block_size, region_size=region_blocks * block_size,
+                  region_step=region_step)
+    return result
+
+
+def estimate_changes(sample):
+    """ extrapolate the changes of the whole source from a sample (see "compare_sample")
+
+        The changed part of every sampled region is a single observation: changes tend to be
+        clustered, thus the variation between the regions determines the uncertainty.  The
+        result contains the estimated part of changed data ("change_ratio") and the resulting
+        patch size ("patch_size") - each along with an upper bound ("..._max").
+    """
+    size = sample["size"]
+    region_size = sample["region_size"]
+    region_starts = range(0, size, region_size * sample["region_step"])
+    changed = dict.fromkeys(region_starts, 0)
+    for offset, length in sample["mismatching_ranges"]:
+        start = offset - offset % region_size
+        changed[start] += length
+    ratios = [changed[start] / min(region_size, size - start) for start in region_starts]
+    sampled_size = sum(min(region_size, size - start) for start in region_starts)
+    change_ratio = sum(changed.values()) / sampled_size
+    if sample["region_step"] == 1:
+        # the whole source was compared
+        change_ratio_max = change_ratio
+    elif len(ratios) > 1:
+        mean = sum(ratios) / len(ratios)
+        deviation = math.sqrt(sum((ratio - mean) ** 2 for ratio in ratios) / (len(ratios) - 1))
+        change_ratio_max = min(1, change_ratio
+                               + CONFIDENCE_FACTOR * deviation / math.sqrt(len(ratios)))
+    else:
+        # a single region does not tell anything about the variation
+        change_ratio_max = 1
+
+    def get_patch_size(ratio):
+        # every changed block is stored along with its header
+        return int(ratio * size * (1 + BLOCK_HEADER.size / sample["block_size"]))
+
+    result = {"source_size": size,
+              "sampled_size": sampled_size,
+              "change_ratio": change_ratio,
+              "change_ratio_max": change_ratio_max,
+              "patch_size": get_patch_size(change_ratio),
+              "patch_size_max": get_patch_size(change_ratio_max)}
+    log.info("Estimated changes: %.2f%% (at most %.2f%%) - patch size: %s (at most %s), "
+             "sampled: %s", 100 * change_ratio, 100 * change_ratio_max,
+             sizeof_fmt(result["patch_size"]), sizeof_fmt(result["patch_size_max"]),
+             sizeof_fmt(sampled_size))
+    return result
+
+
+def get_tracked_changes(source_size, changed_ranges, block_size=None):
+    """ determine the changes reported by a changed block tracker (see "estimate_changes")
+
+        The estimation is exact: only the changed ranges are compared.
+    """
+    block_size = block_size or DEFAULT_BLOCK_SIZE
+    changed = sum(length for offset, length in changed_ranges)
+    change_ratio = changed / source_size if source_size else 0
+    patch_size = changed + BLOCK_HEADER.size * sum(-(-length // block_size)
+                                                   for offset, length in changed_ranges)
+    return {"source_size": source_size,
+            "sampled_size": changed,
+            "change_ratio": change_ratio,
+            "change_ratio_max": change_ratio,
+            "patch_size": patch_size,
+            "patch_size_max": patch_size}
+
+
+def estimate_duration(source_size, patch_size, rates):
+    """ estimate the duration of a run based on the rates of the recent runs (or None)
+
+        The source is read completely.  The patch is transferred at the recent transfer rate.
+    """
+    if not rates["read_rate"] or not rates["link_rate"]:
+        return None
+    return source_size / rates["read_rate"] + patch_size / rates["link_rate"]
@@ -0,0 +1,268 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import datetime
+import os
+import sqlite3
+import statistics
+import threading
+import time
+
+from bdsync_manager.utils import log, sizeof_fmt
+
+
+HISTORY_FILENAME = "history.sqlite"
+# fields of a run (beside its id): name and SQL type
+RUN_FIELDS = (("task", "TEXT NOT NULL"),
+              ("start_time", "REAL NOT NULL"),
+              ("duration", "REAL"),
+              ("status", "TEXT NOT NULL"),
+              ("error", "TEXT"),
+              ("source_size", "INTEGER"),
+              ("bytes_read", "INTEGER"),
+              ("patch_size", "INTEGER"),
+              ("bytes_transferred", "INTEGER"),
+              ("generate_time", "REAL"),
+              ("transfer_time", "REAL"),
+              ("compression_time", "REAL"),
+              ("apply_time", "REAL"),
+              ("snapshot_fill", "REAL"),
+              ("snapshot_usage", "INTEGER"),
+              ("block_size", "INTEGER"),
+              ("estimated_patch_size", "INTEGER"))
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+# the run was postponed by its preflight checks (see "bdsync_manager.estimate")
+STATUS_DEFERRED = "deferred"
+# a run is a regression if its duration or patch size exceeds the median by this factor
+REGRESSION_FACTOR = 1.5
+# number of preceding runs used as the reference for detecting regressions
+REFERENCE_RUNS = 10
+# snapshots filled above this level (percent) are reported
+SNAPSHOT_FILL_WARNING = 80
+# the suggested size of snapshots exceeds the peak usage by this factor
+SNAPSHOT_SIZE_MARGIN = 1.5
+
+# serialize writes of the threads of this process (other processes are handled by sqlite)
+_history_lock = threading.Lock()
+
+
+def get_history_filename(state_dir):
+    return os.path.join(state_dir, HISTORY_FILENAME)
+
+
+@contextlib.contextmanager
+def _open_database(state_dir, create=False):
+    filename = get_history_filename(state_dir)
+    if create:
+        os.makedirs(state_dir, exist_ok=True)
+    database = sqlite3.connect(filename, timeout=60)
+    try:
+        database.row_factory = sqlite3.Row
+        if create:
+            database.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, {0})"
+                             .format(", ".join(" ".join(field) for field in RUN_FIELDS)))
+            database.execute("CREATE INDEX IF NOT EXISTS runs_task ON runs (task, start_time)")
+            # add the fields introduced after the creation of the database
+            existing = {row["name"] for row in database.execute("PRAGMA table_info(runs)")}
+            for name, sql_type in RUN_FIELDS:
+                if name not in existing:
+                    database.execute("ALTER TABLE runs ADD COLUMN {0} {1}".format(name, sql_type))
+        with database:
+            yield database
+    finally:
+        database.close()
+
+
+def record_run(state_dir, run):
+    """ store a run (a dictionary containing a subset of "RUN_FIELDS") in the history
+
+        Failures are logged: the history must not interfere with the synchronization.
+    """
+    names = [name for name, sql_type in RUN_FIELDS if name in run]
+    try:
+        with _history_lock, _open_database(state_dir, create=True) as database:
+            database.execute("INSERT INTO runs ({0}) VALUES ({1})".format(
+                ", ".join(names), ", ".join("?" for name in names)),
+                [run[name] for name in names])
+    except (OSError, sqlite3.Error) as exc:
+        log.warning("Failed to store the run in the history (%s): %s", state_dir, exc)
+
+
+def get_runs(state_dir, task_name=None, since=None):
+    """ retrieve the runs (ordered by time) of one or all tasks, optionally since a timestamp """
+    if not os.path.exists(get_history_filename(state_dir)):
+        return []
+    conditions = []
+    arguments = []
+    if task_name is not None:
+        conditions.append("task = ?")
+        arguments.append(task_name)
+    if since is not None:
+        conditions.append("start_time >= ?")
+        arguments.append(since)
+    query = "SELECT * FROM runs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    with _open_database(state_dir) as database:
+        return [dict(row) for row in database.execute(query + " ORDER BY start_time", arguments)]
+
+
+def get_last_start_time(state_dir, task_name):
+    """ return the start time of the latest run of a task (or None) """
+    if not os.path.exists(get_history_filename(state_dir)):
+        return None
+    try:
+        with _open_database(state_dir) as database:
+            row = database.execute("SELECT MAX(start_time) FROM runs WHERE task = ?",
+                                   (task_name, )).fetchone()
+    except sqlite3.Error as exc:
+        log.warning("Failed to read the history (%s): %s", state_dir, exc)
+        return None
+    return row[0]
+
+
+def get_recent_rates(state_dir, task_name):
+    """ determine the read rate of the source and the transfer rate of the latest runs
+
+        The rates (bytes per second) are None if the recent runs do not tell them.
+    """
+    try:
+        runs = [run for run in get_runs(state_dir, task_name)
+                if run["status"] == STATUS_SUCCESS][-REFERENCE_RUNS:]
+    except sqlite3.Error as exc:
+        log.warning("Failed to read the history (%s): %s", state_dir, exc)
+        runs = []
+
+    def get_rate(bytes_key, time_key):
+        items = [(run[bytes_key], run[time_key]) for run in runs
+                 if run[bytes_key] and run[time_key]]
+        if not items:
+            return None
+        return sum(count for count, duration in items) / sum(duration for count, duration in items)
+
+    return {"read_rate": get_rate("bytes_read", "generate_time"),
+            "link_rate": get_rate("bytes_transferred", "transfer_time")}
+
+
+def get_expected_duration(state_dir, task_name):
+    """ guess the duration of the next run of a task (the median of the latest runs) """
+    try:
+        durations = [run["duration"] for run in get_runs(state_dir, task_name)
+                     if (run["status"] == STATUS_SUCCESS) and run["duration"]]
+    except sqlite3.Error as exc:
+        log.warning("Failed to read the history (%s): %s", state_dir, exc)
+        return None
+    return statistics.median(durations[-REFERENCE_RUNS:]) if durations else None
+
+
+def _get_median(runs, key):
+    values = [run[key] for run in runs if run[key] is not None]
+    return statistics.median(values) if values else None
+
+
+def get_task_statistics(runs):
+    """ summarize the runs of a single task (ordered by time)
+
+        The latest successful run is compared with the preceding successful runs: an unusual
+        duration or patch size (e.g. an exploding change rate) is reported as a regression.
+    """
+    successful = [run for run in runs if run["status"] == STATUS_SUCCESS]
+    result = {"runs": len(runs),
+              "failures": len([run for run in runs if run["status"] == STATUS_FAILED]),
+              "last_run": runs[-1]["start_time"] if runs else None,
+              "last_status": runs[-1]["status"] if runs else None,
+              "median_duration": _get_median(successful, "duration"),
+              "median_patch_size": _get_median(successful, "patch_size"),
+              "max_snapshot_fill": max((run["snapshot_fill"] for run in runs
+                                        if run["snapshot_fill"] is not None), default=None),
+              "max_snapshot_usage": max((run.get("snapshot_usage") or 0 for run in runs),
+                                        default=0) or None,
+              "suggested_snapshot_size": None,
+              "change_rate": None,
+              "change_ratio": None,
+              "regressions": []}
+    if result["max_snapshot_usage"]:
+        result["suggested_snapshot_size"] = int(SNAPSHOT_SIZE_MARGIN
+                                                * result["max_snapshot_usage"])
+    if runs and (runs[-1]["status"] == STATUS_FAILED):
+        result["regressions"].append("the latest run failed: {0}".format(runs[-1]["error"]))
+    if not successful:
+        return result
+    last = successful[-1]
+    result["last_duration"] = last["duration"]
+    result["last_patch_size"] = last["patch_size"]
+    if (len(successful) > 1) and (last["patch_size"] is not None):
+        # changed bytes per day since the previous successful run
+        interval = last["start_time"] - successful[-2]["start_time"]
+        if interval > 0:
+            result["change_rate"] = last["patch_size"] * 86400 / interval
+    if last["patch_size"] is not None and last["source_size"]:
+        result["change_ratio"] = last["patch_size"] / last["source_size"]
+    reference = successful[-REFERENCE_RUNS - 1:-1]
+    for key, label in (("duration", "duration"), ("patch_size", "patch size")):
+        median = _get_median(reference, key)
+        if median and (last[key] is not None) and (last[key] > REGRESSION_FACTOR * median):
+            result["regressions"].append("{0} increased by factor {1:.1f} (median of the "
+                                         "preceding {2:d} runs)".format(label, last[key] / median,
+                                                                        len(reference)))
+    if (last["snapshot_fill"] is not None) and (last["snapshot_fill"] >= SNAPSHOT_FILL_WARNING):
+        result["regressions"].append("LVM snapshot filled up to {0:.0f}%".format(
+            last["snapshot_fill"]))
+    return result
+
+
+def format_task_statistics(task_name, summary):
+    """ turn the summary of a task (see "get_task_statistics") into human readable lines """
+    def fmt_duration(value):
+        return "-" if value is None else str(datetime.timedelta(seconds=round(value)))
+
+    def fmt_size(value):
+        return "-" if value is None else sizeof_fmt(value)
+
+    lines = ["{0}:".format(task_name)]
+    if not summary["runs"]:
+        lines.append("  no runs recorded")
+        return lines
+    lines.append("  runs: {0:d} (failed: {1:d}), latest: {2} ({3})".format(
+        summary["runs"], summary["failures"],
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(summary["last_run"])),
+        summary["last_status"]))
+    if summary.get("last_duration") is not None:
+        lines.append("  duration: {0} (median: {1})".format(
+            fmt_duration(summary["last_duration"]), fmt_duration(summary["median_duration"])))
+        lines.append("  patch size: {0} (median: {1})".format(
+            fmt_size(summary["last_patch_size"]), fmt_size(summary["median_patch_size"])))
+    if summary["change_rate"] is not None:
+        lines.append("  change rate: {0}/day".format(fmt_size(summary["change_rate"])))
+    if summary["change_ratio"] is not None:
+        lines.append("  changed part of the source: {0:.2f}%".format(
+            100 * summary["change_ratio"]))
+    if summary["max_snapshot_fill"] is not None:
+        lines.append("  maximum LVM snapshot fill level: {0:.1f}%".format(
+            summary["max_snapshot_fill"]))
+    if summary["max_snapshot_usage"] is not None:
+        lines.append("  maximum LVM snapshot usage: {0} (suggested 'lvm_snapshot_size': {1})"
+                     .format(fmt_size(summary["max_snapshot_usage"]),
+                             fmt_size(summary["suggested_snapshot_size"])))
+    for regression in summary["regressions"]:
+        lines.append("  WARNING: {0}".format(regression))
+    return lines
@@ -18,10 +18,71 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import json
+import os
+import re
+import threading
+import xml.etree.ElementTree
+
 import plumbum
 
 from bdsync_manager import NotFoundError, RequirementsError, TaskProcessingError
-from bdsync_manager.utils import log
+from bdsync_manager.patch import get_merged_ranges
+from bdsync_manager.trace import TracedCommand
+from bdsync_manager.utils import get_task_name, log, set_task_name, sizeof_fmt, \
+    wrap_command_tokens
+
+
+SECTOR_SIZE = 512
+# fields of the logical volumes retrieved for the inventory of a volume group
+INVENTORY_FIELDS = ("lv_name", "lv_path", "lv_size", "lv_attr", "origin", "pool_lv")
+# types of volumes (first character of "lv_attr") to be synchronized: plain volumes, origins of
+# snapshots and thin volumes
+SYNCABLE_VOLUME_TYPES = ("-", "o", "V")
+
+_callers = {}
+_callers_lock = threading.Lock()
+
+
+# device mapper names of LVM volumes: "VG-LV" with dashes in names being doubled
+DM_NAME_REGEX = re.compile(r"^(?P<group>(?:[^-]|--)+)-(?:[^-]|--)+$")
+
+
+def get_volume_group_from_path(volume_path):
+    """ guess the name of the volume group based on the path of a volume
+
+        No LVM command is executed.  Paths like "/dev/VG/LV" and "/dev/mapper/VG-LV" are
+        recognized.  None is returned for other paths.
+    """
+    directory, name = os.path.split(os.path.normpath(volume_path))
+    parent, group = os.path.split(directory)
+    if parent != "/dev":
+        return None
+    if group == "mapper":
+        match = DM_NAME_REGEX.match(name)
+        return match.group("group").replace("--", "-") if match else None
+    return group
+
+
+def get_dm_name(vg_name, lv_name):
+    """ return the device mapper name of a logical volume """
+    return "{0}-{1}".format(vg_name.replace("-", "--"), lv_name.replace("-", "--"))
+
+
+def _get_program(name):
+    try:
+        return TracedCommand(plumbum.local[name])
+    except plumbum.CommandNotFound:
+        raise RequirementsError("Failed to find the program '{0}'".format(name))
+
+
+def get_caller(exec_path="/sbin/lvm"):
+    """ return the shared caller for an LVM executable (the executable is checked only once) """
+    with _callers_lock:
+        if exec_path not in _callers:
+            _callers[exec_path] = Caller(exec_path)
+        return _callers[exec_path]
 
 
 class Caller:
@@ -34,8 +95,14 @@ class Caller:
         return Volume(self, volume_path)
 
     def __getitem__(self, args):
-        """ provide a prepare/call interface similar to plumbum's """
-        return plumbum.local[self._exec_path][args]
+        """ provide a prepare/call interface similar to plumbum's (see "TracedCommand")
+
+            The resource limits of the current task apply (see "wrap_command_tokens").
+        """
+        if not isinstance(args, tuple):
+            args = (args, )
+        tokens = wrap_command_tokens((self._exec_path, ) + args)
+        return TracedCommand(plumbum.local[tokens[0]][tuple(tokens[1:])])
 
     def __call__(self, *args):
         return self[tuple(args)]()
@@ -50,9 +117,10 @@ class Caller:
 
 class Volume:
 
-    def __init__(self, caller, volume_path):
+    def __init__(self, caller, volume_path, group_and_name=None):
+        """ the group and the name of the volume are determined via LVM, unless given """
         self._caller = caller
-        self._group, self._volume = self._parse_volume_path(volume_path)
+        self._group, self._volume = group_and_name or self._parse_volume_path(volume_path)
         self._snapshot_name = None
 
     def _parse_volume_path(self, volume_path):
@@ -75,11 +143,71 @@ class Volume:
         assert volume
         return "/dev/{vg_name}/{volume}".format(vg_name=self._group, volume=volume)
 
+    @property
+    def group(self):
+        return self._group
+
+    @property
+    def name(self):
+        return self._volume
+
+    @property
+    def has_snapshot(self):
+        return self._snapshot_name is not None
+
+    def get_attribute(self, field, volume=None):
+        """ retrieve a single reporting field (see "lvs -o help") of the volume
+
+            An empty string is returned if the volume does not exist.
+        """
+        lv_path = "%s/%s" % (self._group, volume or self._volume)
+        cmd = self._caller["lvs", "--noheadings", "--units", "b", "--nosuffix",
+                           "-o", field, lv_path]
+        returncode, stdout, stderr = cmd.run(retcode=None)
+        return stdout.strip() if returncode == 0 else ""
+
+    def get_snapshot_fill(self):
+        """ return the fill level (percent) of the current snapshot (None: unknown) """
+        if self._snapshot_name is None:
+            return None
+        try:
+            return float(self.get_attribute("data_percent", self._snapshot_name))
+        except ValueError:
+            return None
+
+    def get_snapshot_usage(self):
+        """ return the fill level (percent) and the size (bytes) of the current snapshot
+
+            Both values are retrieved with a single call.  None is returned if they are unknown.
+        """
+        if self._snapshot_name is None:
+            return None
+        values = self.get_attribute("data_percent,lv_size", self._snapshot_name).split()
+        try:
+            return float(values[0]), int(values[1])
+        except (IndexError, ValueError):
+            return None
+
+    def extend_snapshot(self, size):
+        """ increase the size of the current snapshot (a size in LVM's notation, e.g. "5G") """
+        assert self._snapshot_name
+        lv_path = "%s/%s" % (self._group, self._snapshot_name)
+        log.info("Extending LVM snapshot %s by %s", lv_path, size)
+        try:
+            self._caller("lvextend", "--size", "+" + size, lv_path)
+        except plumbum.commands.processes.ProcessExecutionError as exc:
+            raise TaskProcessingError("Failed to extend LVM snapshot: {0}".format(exc))
+
     def _create_snapshot(self, snapshot_name, snapshot_size):
         assert self._snapshot_name is None
         log.info("Creating LVM snapshot: %s/%s", self._group, snapshot_name)
-        cmd = self._caller["lvcreate", "--snapshot", "--name", snapshot_name,
-                           "--size", snapshot_size, self._get_path()]
+        if snapshot_size:
+            cmd = self._caller["lvcreate", "--snapshot", "--name", snapshot_name,
+                               "--size", snapshot_size, self._get_path()]
+        else:
+            # thin snapshot: no size is required, but it needs to be activated explicitly
+            cmd = self._caller["lvcreate", "--snapshot", "--name", snapshot_name,
+                               "--setactivationskip", "n", self._get_path()]
         log.debug("LVM snapshot create command: %s", cmd)
         try:
             cmd()
@@ -92,6 +220,11 @@ class Volume:
             self._create_snapshot(snapshot_name, snapshot_size)
         return self._get_path(self._snapshot_name)
 
+    def adopt_snapshot(self, snapshot_name):
+        """ manage an existing snapshot (e.g. left behind by an interrupted run) """
+        assert self._snapshot_name is None
+        self._snapshot_name = snapshot_name
+
     def remove_snapshot(self):
         # the name should not be None or empty
         assert self._snapshot_name
@@ -107,3 +240,355 @@ class Volume:
             log.debug("LVM snapshot remove command: %s", cmd)
             cmd()
             self._snapshot_name = None
+
+    def keep_snapshot(self, new_name):
+        """ rename the current snapshot and stop managing it """
+        assert self._snapshot_name
+        log.info("Keeping LVM snapshot %s/%s as %s", self._group, self._snapshot_name, new_name)
+        self._caller("lvrename", self._group, self._snapshot_name, new_name)
+        self._snapshot_name = None
+
+    def remove_volume(self, name):
+        """ remove another volume of the same group (e.g. an old snapshot) """
+        lv_path = "%s/%s" % (self._group, name)
+        log.info("Removing LVM volume: %s", lv_path)
+        self._caller("lvremove", "--force", lv_path)
+
+
+def remove_snapshots(caller, group, volumes):
+    """ remove the current snapshots of multiple volumes of a group with a single command
+
+        The state of all snapshots is verified with a single "lvs" call before.
+    """
+    inventory = VolumeGroupInventory(caller, group)
+    lv_paths = []
+    for volume in volumes:
+        if inventory.get_attributes(volume._snapshot_name).get("origin") != volume.name:
+            log.error("Refusing to remove LVM snapshot due to its unclear state: %s/%s",
+                      group, volume._snapshot_name)
+        else:
+            lv_paths.append("%s/%s" % (group, volume._snapshot_name))
+    if lv_paths:
+        log.info("Removing LVM snapshots: %s", " ".join(lv_paths))
+        caller(*(["lvremove", "--force"] + lv_paths))
+        for volume in volumes:
+            if "%s/%s" % (group, volume._snapshot_name) in lv_paths:
+                volume._snapshot_name = None
+
+
+class VolumeGroupInventory:
+    """ the metadata of all logical volumes of a volume group
+
+        The metadata is retrieved by a single "lvs" call (instead of one call per volume).
+    """
+
+    def __init__(self, caller, group):
+        self._caller = caller
+        self.group = group
+        self._volumes = collections.OrderedDict()
+        self.refresh()
+
+    def refresh(self):
+        try:
+            output = self._caller("lvs", "--reportformat", "json", "--units", "b", "--nosuffix",
+                                  "-o", ",".join(INVENTORY_FIELDS), self.group)
+            report = json.loads(output)["report"][0]["lv"]
+        except (plumbum.commands.processes.ProcessExecutionError, ValueError, LookupError) \
+                as exc:
+            raise TaskProcessingError("Failed to list the volumes of the LVM volume group '{0}': "
+                                      "{1}".format(self.group, exc))
+        self._volumes = collections.OrderedDict((item["lv_name"], item) for item in report)
+
+    def get_attributes(self, name):
+        """ return the metadata of a volume (an empty dictionary if it does not exist) """
+        return dict(self._volumes.get(name) or {})
+
+    def get_volume_names(self, include=None, exclude=None):
+        """ return the names of the volumes to be synchronized
+
+            Snapshots, pools and other internal volumes are skipped.  The names may be filtered
+            by regular expressions.
+        """
+        result = []
+        for name, attributes in self._volumes.items():
+            if attributes["lv_attr"][:1] not in SYNCABLE_VOLUME_TYPES:
+                continue
+            if include and not re.fullmatch(include, name):
+                continue
+            if exclude and re.fullmatch(exclude, name):
+                continue
+            result.append(name)
+        return result
+
+    def get_volume(self, name):
+        """ return a volume object based on the inventory (without further LVM calls) """
+        return Volume(self._caller, self._volumes[name]["lv_path"], (self.group, name))
+
+
+class SnapshotCoordinator:
+    """ create and remove the snapshots of the volumes of a volume group
+
+        The number of existing snapshots is limited (zero: no limit).  Released snapshots are
+        removed in batches with a single command.  Pending removals are carried out early, if
+        a new snapshot has to wait for the limit or if no snapshot is in use anymore.
+    """
+
+    def __init__(self, caller, group, limit=0, batch_size=1):
+        self._caller = caller
+        self._group = group
+        self._limit = limit
+        self._batch_size = max(1, batch_size)
+        self._condition = threading.Condition()
+        # existing snapshots (including the ones waiting for their removal)
+        self._active = 0
+        self._in_use = 0
+        self._removal_queue = []
+
+    def get_snapshot(self, volume, snapshot_name, snapshot_size):
+        with self._condition:
+            while self._limit and (self._active >= self._limit):
+                if self._removal_queue:
+                    self._flush()
+                else:
+                    self._condition.wait()
+            self._active += 1
+            self._in_use += 1
+        try:
+            return volume.get_snapshot(snapshot_name, snapshot_size)
+        except BaseException:
+            self.forget_snapshot(volume)
+            raise
+
+    def forget_snapshot(self, volume):
+        """ stop managing the snapshot of a volume without removing it """
+        with self._condition:
+            self._active -= 1
+            self._in_use -= 1
+            self._condition.notify_all()
+
+    def release_snapshot(self, volume):
+        """ remove the snapshot of a volume (maybe later along with other snapshots) """
+        with self._condition:
+            self._in_use -= 1
+            self._removal_queue.append(volume)
+            if (len(self._removal_queue) >= self._batch_size) or (self._in_use == 0):
+                self._flush()
+
+    def _flush(self):
+        volumes = self._removal_queue
+        self._removal_queue = []
+        try:
+            remove_snapshots(self._caller, self._group, volumes)
+        finally:
+            self._active -= len(volumes)
+            self._condition.notify_all()
+
+
+class SnapshotMonitor:
+    """ watch the fill level of a snapshot in the background
+
+        A snapshot running out of space is invalidated by LVM: the synchronization would fail
+        after wasting the time spent so far.  The snapshot is extended by a given size whenever
+        its fill level reaches a threshold (up to a maximum size).  The task is aborted early
+        (see "AbortSignal") if the snapshot cannot grow anymore and its fill level reaches the
+        abort threshold.  The peak fill level and usage (bytes) are recorded.
+    """
+
+    def __init__(self, volume, abort_signal, interval, extend_threshold, abort_threshold,
+                 extend_size=None, max_size=None):
+        self._volume = volume
+        self.abort_signal = abort_signal
+        self._interval = interval
+        self._extend_threshold = extend_threshold
+        self._abort_threshold = abort_threshold
+        self._extend_size = extend_size
+        self._max_size = max_size
+        self._stopped = threading.Event()
+        self._thread = None
+        self.peak_fill = None
+        self.peak_usage = None
+        self.extensions = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, args=(get_task_name(), ), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, task_name):
+        set_task_name(task_name)
+        while not self._stopped.wait(self._interval):
+            try:
+                if not self.check():
+                    break
+            except plumbum.commands.processes.ProcessExecutionError as exc:
+                log.warning("Failed to query the fill level of the LVM snapshot: %s", exc)
+
+    def _can_extend(self, size):
+        return self._extend_size and ((self._max_size is None) or (size < self._max_size))
+
+    def check(self):
+        """ update the peak fill level and react on a full snapshot
+
+            False is returned if the task was aborted.
+        """
+        usage = self._volume.get_snapshot_usage()
+        if usage is None:
+            return True
+        fill, size = usage
+        self.peak_fill = fill if self.peak_fill is None else max(self.peak_fill, fill)
+        self.peak_usage = max(self.peak_usage or 0, int(size * fill / 100))
+        if (fill >= self._extend_threshold) and self._can_extend(size):
+            try:
+                self._volume.extend_snapshot(self._extend_size)
+            except TaskProcessingError as exc:
+                log.error("%s", exc)
+                # do not try again: the abort threshold applies from now on
+                self._extend_size = None
+            else:
+                self.extensions += 1
+                return True
+        if fill >= self._abort_threshold:
+            self.abort_signal.request(
+                "Aborting the synchronization: the LVM snapshot is almost full ({0:.1f}% of {1}). "
+                "Consider a larger 'lvm_snapshot_size' or 'lvm_snapshot_extend_size'."
+                .format(fill, sizeof_fmt(size)))
+            log.error("LVM snapshot is almost full (%.1f%%): aborting the task", fill)
+            return False
+        return True
+
+
+class EraTracker:
+    """ changed block tracking via a dm-era device
+
+        The era device needs to be stacked on top of the source volume: all writes to the source
+        volume must pass through the era device.  See "Documentation/device-mapper/era.txt" of
+        the linux kernel for details.
+
+        A checkpoint (the era at the beginning of a synchronization) is stored after every
+        successful synchronization.  The blocks written since this era are synchronized during
+        the next run.
+    """
+
+    def __init__(self, era_device, metadata_device):
+        self._era_device = era_device
+        self._metadata_device = metadata_device
+        self._dmsetup = _get_program("dmsetup")
+        self._era_invalidate = _get_program("era_invalidate")
+        self._current_era = None
+
+    def _get_table_fields(self, operation):
+        return self._dmsetup(operation, self._era_device).split()
+
+    def start(self):
+        """ begin a new era: writes from now on are part of the next synchronization """
+        log.debug("Creating checkpoint of dm-era device: %s", self._era_device)
+        self._dmsetup("message", self._era_device, "0", "checkpoint")
+        # status: <start> <length> era <metadata block size> <used>/<total> <current era> <root>
+        self._current_era = int(self._get_table_fields("status")[5])
+        # no replacement of the source is necessary
+        return None
+
+    def get_changed_ranges(self, checkpoint):
+        """ return the list of changed ranges (offset and length in bytes) since a checkpoint
+
+            None is returned if the changes cannot be determined.
+        """
+        if not checkpoint or (checkpoint.get("type") != "era") \
+                or (checkpoint.get("device") != self._era_device) \
+                or (checkpoint["era"] > self._current_era):
+            return None
+        # table: <start> <length> era <metadata device> <origin device> <block size (sectors)>
+        table = self._get_table_fields("table")
+        device_size = int(table[1]) * SECTOR_SIZE
+        block_size = int(table[5]) * SECTOR_SIZE
+        self._dmsetup("message", self._era_device, "0", "take_metadata_snap")
+        try:
+            output = self._era_invalidate("--metadata-snapshot", "--written-since",
+                                          str(checkpoint["era"]), self._metadata_device)
+        finally:
+            self._dmsetup("message", self._era_device, "0", "drop_metadata_snap")
+        ranges = []
+        for item in xml.etree.ElementTree.fromstring(output):
+            if item.tag == "block":
+                first = last = int(item.get("block"))
+            elif item.tag == "range":
+                # treat the end as inclusive: synchronizing one block too many does no harm
+                first, last = int(item.get("begin")), int(item.get("end"))
+            else:
+                continue
+            ranges.append((first * block_size, (last - first + 1) * block_size))
+        return get_merged_ranges(ranges, device_size)
+
+    def get_checkpoint(self):
+        return {"type": "era", "device": self._era_device, "era": self._current_era}
+
+    def commit(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+class ThinDeltaTracker:
+    """ changed block tracking for thin volumes via "thin_delta"
+
+        The snapshot of a successful synchronization is kept (with the suffix "-base").  The next
+        run compares a new snapshot with this base snapshot.  Afterwards the new snapshot
+        replaces the base snapshot.
+    """
+
+    def __init__(self, volume, snapshot_name):
+        self._volume = volume
+        self._snapshot_name = snapshot_name
+        self._base_name = snapshot_name + "-base"
+        self._thin_delta = _get_program("thin_delta")
+        self._dmsetup = _get_program("dmsetup")
+
+    def start(self):
+        """ create a new snapshot and return its path (to be used as the source) """
+        return self._volume.get_snapshot(self._snapshot_name, None)
+
+    def get_changed_ranges(self, checkpoint):
+        base_id = self._volume.get_attribute("thin_id", self._base_name)
+        if not checkpoint or (checkpoint.get("type") != "thin") or not base_id \
+                or (checkpoint.get("base_thin_id") != int(base_id)):
+            return None
+        current_id = self._volume.get_attribute("thin_id", self._snapshot_name)
+        pool = self._volume.get_attribute("pool_lv")
+        chunk_size = int(self._volume.get_attribute("chunk_size", pool))
+        device_size = int(self._volume.get_attribute("lv_size"))
+        pool_dm_name = get_dm_name(self._volume.group, pool)
+        self._dmsetup("message", pool_dm_name + "-tpool", "0", "reserve_metadata_snap")
+        try:
+            output = self._thin_delta("--metadata-snap", "--snap1", base_id,
+                                      "--snap2", current_id,
+                                      "/dev/mapper/{0}_tmeta".format(pool_dm_name))
+        finally:
+            self._dmsetup("message", pool_dm_name + "-tpool", "0", "release_metadata_snap")
+        ranges = []
+        for item in xml.etree.ElementTree.fromstring(output).iter():
+            # blocks only present in the base snapshot were discarded: they are read as zeros
+            if item.tag in ("different", "left_only", "right_only"):
+                ranges.append((int(item.get("begin")) * chunk_size,
+                               int(item.get("length")) * chunk_size))
+        return get_merged_ranges(ranges, device_size)
+
+    def get_checkpoint(self):
+        return {"type": "thin",
+                "base_thin_id": int(self._volume.get_attribute("thin_id", self._snapshot_name))}
+
+    def commit(self):
+        """ replace the base snapshot with the current one """
+        if self._volume.get_attribute("lv_name", self._base_name):
+            self._volume.remove_volume(self._base_name)
+        self._volume.keep_snapshot(self._base_name)
+
+    def cleanup(self):
+        """ remove the current snapshot if it was not committed """
+        if self._volume.has_snapshot:
+            self._volume.remove_snapshot()
@@ -0,0 +1,148 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import errno
+import os
+import struct
+
+from bdsync_manager.utils import get_file_size
+
+
+# bdsync patches consist of a text header (terminated by an empty line) followed by binary block
+# records: the offset (64 bit) and the length (32 bit) in network byte order and the data
+PATCH_VERSION = "0.3"
+BLOCK_HEADER = struct.Struct("!QI")
+# maximum amount of data to be read from the source at once
+READ_CHUNK_SIZE = 1024 * 1024
+# granularity of the detection of all-zero blocks (see "write_range_patch")
+ZERO_BLOCK_SIZE = 4096
+
+
+class PatchWriter:
+    """ write a patch in the format of bdsync ("bdsync --patch" is able to apply it)
+
+        "bdsync --patch" writes to the device named in the header (the target, not the source).
+    """
+
+    def __init__(self, stream, device_name, device_size):
+        self._stream = stream
+        self._stream.write("BDSYNC {0}\nDEVICE:{1}\nSIZE:{2:d}\n\n"
+                           .format(PATCH_VERSION, device_name, device_size).encode())
+
+    def write_block(self, offset, data):
+        self._stream.write(BLOCK_HEADER.pack(offset, len(data)))
+        self._stream.write(data)
+
+    def finish(self):
+        self._stream.flush()
+
+
+def get_merged_ranges(ranges, limit=None):
+    """ sort and merge overlapping or adjacent ranges (tuples of offset and length)
+
+        All ranges are clipped to the given limit (e.g. the size of a device).
+    """
+    result = []
+    for offset, length in sorted(ranges):
+        if limit is not None:
+            length = min(offset + length, limit) - offset
+        if length <= 0:
+            continue
+        if result and (offset <= result[-1][0] + result[-1][1]):
+            last_offset, last_length = result.pop()
+            length = max(last_offset + last_length, offset + length) - last_offset
+            offset = last_offset
+        result.append((offset, length))
+    return result
+
+
+def get_data_ranges(filename):
+    """ return the ranges (offset and length) of a file, which are not holes
+
+        The holes are determined via SEEK_DATA and SEEK_HOLE.  The complete file is returned
+        as a single range, if these are not supported (e.g. by the filesystem).  Blockdevices
+        usually consist of a single range.
+    """
+    size = get_file_size(filename)
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+    ranges = []
+    with open(filename, "rb") as source:
+        fd = source.fileno()
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as exc:
+                if exc.errno == errno.ENXIO:
+                    # no data after this offset
+                    break
+                return [(0, size)]
+            offset = min(size, os.lseek(fd, start, os.SEEK_HOLE))
+            ranges.append((start, offset - start))
+    return ranges
+
+
+def _iter_non_zero_blocks(offset, data):
+    """ yield the offset and the data of the sequences of blocks containing non-zero bytes """
+    view = memoryview(data)
+    zero_block = bytes(ZERO_BLOCK_SIZE)
+    start = None
+    for position in range(0, len(view), ZERO_BLOCK_SIZE):
+        block = view[position:position + ZERO_BLOCK_SIZE]
+        if block == zero_block[:len(block)]:
+            if start is not None:
+                yield offset + start, view[start:position]
+                start = None
+        elif start is None:
+            start = position
+    if start is not None:
+        yield offset + start, view[start:]
+
+
+def write_range_patch(source_filename, target_filename, ranges, stream, skip_zero_blocks=False):
+    """ write a patch containing only the given ranges of the source into a stream
+
+        Only the given ranges of the source are read.  The target is not read at all.
+        All-zero blocks are omitted, if requested (e.g. for a target consisting of zeros).
+        The patch refers to the target: "bdsync --patch" applies it to this device.
+    """
+    size = get_file_size(source_filename)
+    writer = PatchWriter(stream, target_filename, size)
+    with open(source_filename, "rb") as source:
+        for offset, length in get_merged_ranges(ranges, size):
+            end = offset + length
+            while offset < end:
+                data = _read_at(source, offset, min(READ_CHUNK_SIZE, end - offset))
+                if skip_zero_blocks:
+                    for block_offset, block in _iter_non_zero_blocks(offset, data):
+                        writer.write_block(block_offset, block)
+                else:
+                    writer.write_block(offset, data)
+                offset += len(data)
+    writer.finish()
+
+
+def _read_at(source, offset, length):
+    source.seek(offset)
+    data = source.read(length)
+    if len(data) != length:
+        raise IOError("Unexpected end of source at offset {0:d}".format(offset + len(data)))
+    return data
@@ -0,0 +1,266 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import datetime
+import os
+import select
+import threading
+import time
+
+from bdsync_manager.utils import check_abort, get_task_name, log, sizeof_fmt
+
+
+# maximum amount of data passed at once
+RELAY_CHUNK_SIZE = 1024 * 1024
+# interval (seconds) between progress messages
+PROGRESS_REPORT_INTERVAL = 60
+# maximum time (seconds) spent on waiting for data before checking for an abort request
+ABORT_CHECK_INTERVAL = 1
+
+
+class TokenBucket:
+    """ limit the rate (bytes per second) of one or more data streams
+
+        The rate may be changed at any time.  A rate of None disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = 0
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        """ wait until the given number of bytes may be transferred """
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # allow bursts of up to one second
+            self._tokens = min(self.rate, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+            self._tokens -= count
+            deficit = -self._tokens
+        if deficit > 0:
+            time.sleep(deficit / self.rate)
+
+
+# relays of the running transfers (see "tracked_transfer")
+_active_relays = set()
+_active_relays_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def tracked_transfer(relay):
+    """ include a relay in the progress reports while the transfer is running """
+    with _active_relays_lock:
+        _active_relays.add(relay)
+    try:
+        yield relay
+    finally:
+        with _active_relays_lock:
+            _active_relays.discard(relay)
+
+
+def get_transfer_progress():
+    """ return the progress of all running transfers (e.g. for the status of the daemon) """
+    with _active_relays_lock:
+        relays = list(_active_relays)
+    return [relay.get_progress() for relay in relays]
+
+
+class StreamRelay:
+    """ pass a stream to a target (e.g. the stdin of a process) while counting its bytes
+
+        The data is either written by an in-process producer (file-like interface) or relayed
+        from a file descriptor (e.g. the stdout of a process).  The latter uses "os.splice"
+        (zero-copy between pipes) if it is available.  The throughput may be limited by a token
+        bucket.  The data may be compressed (see "bdsync_manager.compression"): the bandwidth
+        limit applies to the compressed data.  Progress messages are emitted periodically.  They
+        include the percentage and the remaining time, if the expected size of the (uncompressed)
+        data is known.
+        The time spent on passing data to the target (including the delays caused by the
+        bandwidth limit) is accounted separately from the time spent on waiting for data.
+    """
+
+    def __init__(self, target, rate_limit=None, expected_size=None, bucket=None,
+                 compressor=None):
+        self._target = target
+        self._bucket = bucket or TokenBucket(rate_limit)
+        self._expected_size = expected_size
+        self._compressor = compressor
+        # uncompressed and transferred (maybe compressed) bytes
+        self.bytes_received = 0
+        self.bytes_transferred = 0
+        self.compression_time = 0
+        self.transfer_time = 0
+        self.rate = 0
+        self._start_time = time.monotonic()
+        self._finish_time = None
+        self._window_start = self._start_time
+        self._window_bytes = 0
+        self._last_report = self._start_time
+        # the task (and segment) using the relay
+        self.task_name = get_task_name()
+
+    @property
+    def duration(self):
+        """ the time spent on the transfer (until "finish" was called) """
+        return (self._finish_time or time.monotonic()) - self._start_time
+
+    @property
+    def average_rate(self):
+        return self.bytes_transferred / max(self.duration, 0.001)
+
+    def _get_chunk_size(self):
+        if self._bucket.rate is None:
+            return RELAY_CHUNK_SIZE
+        else:
+            # small chunks keep the limited rate smooth
+            return int(max(4096, min(RELAY_CHUNK_SIZE, self._bucket.rate / 10)))
+
+    def get_statistics(self):
+        """ return the sizes and the durations of the transfer
+
+            The remaining time of the transfer ("generate_time") was spent on waiting for data
+            (e.g. while the patch generator compares the source and the target).
+        """
+        duration = self.duration
+        return {"bytes_received": self.bytes_received,
+                "bytes_transferred": self.bytes_transferred,
+                "compression_time": self.compression_time,
+                "transfer_time": self.transfer_time,
+                "generate_time": max(0, duration - self.transfer_time - self.compression_time),
+                "duration": duration}
+
+    def get_progress(self):
+        return {"task": self.task_name,
+                "bytes_received": self.bytes_received,
+                "bytes_transferred": self.bytes_transferred,
+                "expected_size": self._expected_size,
+                "rate": self.rate,
+                "duration": self.duration}
+
+    def _account(self, count):
+        self.bytes_transferred += count
+        self._window_bytes += count
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self.rate = self._window_bytes / (now - self._window_start)
+            self._window_start = now
+            self._window_bytes = 0
+        if now - self._last_report >= PROGRESS_REPORT_INTERVAL:
+            self._last_report = now
+            if self._expected_size:
+                # the expected size may be an estimation
+                done = min(1, self.bytes_received / self._expected_size)
+                remaining = (1 - done) * (now - self._start_time) / done if done > 0 else None
+                log.info("Transfer progress: %s (%.1f%%, remaining: %s) at %s/s",
+                         sizeof_fmt(self.bytes_transferred), 100 * done,
+                         "unknown" if remaining is None
+                         else datetime.timedelta(seconds=round(remaining)),
+                         sizeof_fmt(self.rate))
+            else:
+                log.info("Transfer progress: %s at %s/s",
+                         sizeof_fmt(self.bytes_transferred), sizeof_fmt(self.rate))
+
+    def _write_compressed(self, data):
+        self.bytes_received += len(data)
+        start_time = time.monotonic()
+        compressed = self._compressor.compress(data)
+        self.compression_time += time.monotonic() - start_time
+        self._write_chunks(compressed)
+
+    def _write_chunks(self, data):
+        view = memoryview(data)
+        chunk_size = self._get_chunk_size()
+        for offset in range(0, len(view), chunk_size):
+            chunk = view[offset:offset + chunk_size]
+            start_time = time.monotonic()
+            self._bucket.consume(len(chunk))
+            self._target.write(chunk)
+            self.transfer_time += time.monotonic() - start_time
+            self._account(len(chunk))
+
+    def write(self, data):
+        if self._compressor is None:
+            self.bytes_received += len(data)
+            self._write_chunks(data)
+        else:
+            self._write_compressed(data)
+
+    def flush(self):
+        self._target.flush()
+
+    def finish(self):
+        """ write the remaining compressed data """
+        if self._compressor is not None:
+            self._write_chunks(self._compressor.flush())
+            self._compressor = None
+        self._target.flush()
+        self._finish_time = time.monotonic()
+
+    def _wait_for_data(self, source_fd):
+        """ wait until the source is readable (while watching for abort requests of the task) """
+        while not select.select([source_fd], [], [], ABORT_CHECK_INTERVAL)[0]:
+            check_abort()
+        check_abort()
+
+    def relay_from(self, source_fd):
+        """ copy all data from a file descriptor to the target
+
+            A TaskProcessingError is raised if the task is aborted (see "AbortSignal").
+        """
+        if self._compressor is not None:
+            while True:
+                self._wait_for_data(source_fd)
+                data = os.read(source_fd, RELAY_CHUNK_SIZE)
+                if not data:
+                    break
+                self._write_compressed(data)
+            return
+        self._target.flush()
+        target_fd = self._target.fileno()
+        use_splice = hasattr(os, "splice")
+        while True:
+            chunk_size = self._get_chunk_size()
+            # wait for data: the remaining time is spent on passing it to the target
+            self._wait_for_data(source_fd)
+            start_time = time.monotonic()
+            if use_splice:
+                try:
+                    count = os.splice(source_fd, target_fd, chunk_size)
+                except OSError:
+                    # e.g. EINVAL: neither side is a pipe
+                    use_splice = False
+                    continue
+            else:
+                data = os.read(source_fd, chunk_size)
+                count = len(data)
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(target_fd, view):]
+            if count == 0:
+                break
+            self.bytes_received += count
+            self._bucket.consume(count)
+            self.transfer_time += time.monotonic() - start_time
+            self._account(count)
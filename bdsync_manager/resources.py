@@ -0,0 +1,226 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import stat
+import threading
+import time
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.utils import get_task_name, log, set_task_name, sizeof_fmt
+
+
+# classes of "ionice"
+IO_PRIORITY_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+DEFAULT_CGROUP_DIR = "/sys/fs/cgroup/bdsync-manager"
+# period (microseconds) of the CPU limit ("cpu.max")
+CPU_PERIOD = 100000
+# interval (seconds) between two evaluations of the latency in the adaptive mode
+ADAPTIVE_INTERVAL = 2
+# the read limit is reduced by this factor while the latency is too high
+BACKOFF_FACTOR = 0.5
+# the read limit is raised by this factor while the latency is below its fraction (margin)
+RECOVERY_FACTOR = 1.5
+RECOVERY_MARGIN = 0.5
+MIN_READ_RATE = 1024 * 1024
+SECTOR_SIZE = 512
+
+
+def get_disk_number(path):
+    """ return the device number ("MAJOR:MINOR") of the disk holding a file or a blockdevice
+
+        Partitions are mapped to their disk (cgroup limits apply only to whole disks).
+    """
+    details = os.stat(path)
+    device = details.st_rdev if stat.S_ISBLK(details.st_mode) else details.st_dev
+    number = "{0:d}:{1:d}".format(os.major(device), os.minor(device))
+    sys_path = os.path.join("/sys/dev/block", number)
+    if os.path.exists(os.path.join(sys_path, "partition")):
+        with open(os.path.join(os.path.realpath(sys_path), os.pardir, "dev")) as dev_file:
+            number = dev_file.read().strip()
+    return number
+
+
+def read_disk_statistics(numbers):
+    """ return the completed I/O operations, the time (ms) spent on them and the read sectors
+
+        The result is a dictionary indexed by the device numbers ("MAJOR:MINOR") of the given
+        disks (see "/proc/diskstats").
+    """
+    result = {}
+    with open("/proc/diskstats") as stats_file:
+        for line in stats_file:
+            fields = line.split()
+            number = "{0}:{1}".format(fields[0], fields[1])
+            if number in numbers:
+                values = [int(value) for value in fields[3:11]]
+                result[number] = (values[0] + values[4], values[3] + values[7], values[2])
+    return result
+
+
+class ResourceControl:
+    """ limit the impact of the local processes of a task (bdsync and LVM) on other workloads
+
+        The processes are started with an I/O priority class (see "ionice") and a nice level.
+        Optionally they are placed into a transient cgroup (version 2) limiting their read rate
+        from the source device ("io.max") and their CPU usage ("cpu.max").  In the adaptive
+        mode the read limit is reduced while the average latency of the I/O operations of a
+        device (see "/proc/diskstats") exceeds a threshold and it is raised again when the
+        latency drops.
+    """
+
+    def __init__(self, name, io_class=None, io_level=None, nice=0, cgroup_dir=None,
+                 read_limit=None, cpu_limit=None, latency_threshold=None, latency_device=None):
+        self._name = re.sub(r"[^\w.-]", "_", name)
+        self._io_class = io_class
+        self._io_level = io_level
+        self._nice = nice
+        self._cgroup_dir = cgroup_dir or DEFAULT_CGROUP_DIR
+        self._read_limit = read_limit
+        self._cpu_limit = cpu_limit
+        self._latency_threshold = latency_threshold
+        self._latency_device = latency_device
+        self._cgroup_path = None
+        self._source_number = None
+        self._latency_number = None
+        self._stopped = threading.Event()
+        self._thread = None
+        # the current read limit (None: unlimited)
+        self.read_rate = read_limit
+
+    @property
+    def uses_cgroup(self):
+        return bool(self._read_limit or self._cpu_limit or self._latency_threshold)
+
+    def wrap_tokens(self, tokens):
+        """ prefix a command line with the tools applying the limits """
+        prefix = []
+        if self._cgroup_path is not None:
+            # the shell moves itself into the cgroup before it turns into the command
+            prefix.extend(["sh", "-c", 'echo $$ > "$0" && exec "$@"',
+                           os.path.join(self._cgroup_path, "cgroup.procs")])
+        if self._io_class:
+            prefix.extend(["ionice", "-c", str(IO_PRIORITY_CLASSES[self._io_class])])
+            if (self._io_level is not None) and (self._io_class != "idle"):
+                prefix.extend(["-n", str(self._io_level)])
+        if self._nice:
+            prefix.extend(["nice", "-n", str(self._nice)])
+        return prefix + list(tokens)
+
+    def _write_cgroup_file(self, name, value, path=None):
+        try:
+            with open(os.path.join(path or self._cgroup_path, name), "w") as cgroup_file:
+                cgroup_file.write(value)
+        except OSError as exc:
+            raise TaskProcessingError("Failed to configure the cgroup ({0}): {1}"
+                                      .format(name, exc))
+
+    def start(self):
+        """ create the cgroup (if required) """
+        if not self.uses_cgroup:
+            return
+        path = os.path.join(self._cgroup_dir, "{0}.{1:d}".format(self._name, os.getpid()))
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as exc:
+            raise TaskProcessingError("Failed to create the cgroup '{0}': {1}".format(path, exc))
+        self._cgroup_path = path
+        # the controllers need to be enabled for the children of the common parent
+        self._write_cgroup_file("cgroup.subtree_control", "+io +cpu", self._cgroup_dir)
+        if self._cpu_limit:
+            self._write_cgroup_file("cpu.max", "{0:d} {1:d}".format(
+                int(CPU_PERIOD * self._cpu_limit / 100), CPU_PERIOD))
+        log.debug("Created cgroup: %s", path)
+
+    def set_source(self, source):
+        """ apply the read limit to the device of the source (and watch its latency) """
+        if self._cgroup_path is None:
+            return
+        self._source_number = get_disk_number(source)
+        if self._read_limit:
+            self._set_read_rate(self._read_limit)
+        if self._latency_threshold and (self._thread is None):
+            self._latency_number = get_disk_number(self._latency_device) \
+                if self._latency_device else self._source_number
+            self._thread = threading.Thread(target=self._run, args=(get_task_name(), ),
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ stop the adaptive mode and remove the cgroup """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._cgroup_path is not None:
+            try:
+                os.rmdir(self._cgroup_path)
+            except OSError as exc:
+                # e.g. EBUSY: a process is still running
+                log.warning("Failed to remove the cgroup '%s': %s", self._cgroup_path, exc)
+            self._cgroup_path = None
+
+    def _set_read_rate(self, rate):
+        self.read_rate = rate
+        self._write_cgroup_file("io.max", "{0} rbps={1}".format(
+            self._source_number, "max" if rate is None else "{0:d}".format(int(rate))))
+
+    def _run(self, task_name):
+        set_task_name(task_name)
+        numbers = {self._source_number, self._latency_number}
+        previous, previous_time = read_disk_statistics(numbers), time.monotonic()
+        while not self._stopped.wait(ADAPTIVE_INTERVAL):
+            current, current_time = read_disk_statistics(numbers), time.monotonic()
+            try:
+                self.adapt(previous, current, current_time - previous_time)
+            except TaskProcessingError as exc:
+                log.warning("%s", exc)
+            previous, previous_time = current, current_time
+
+    def adapt(self, previous, current, duration):
+        """ adjust the read limit based on two samples of the disk statistics """
+        if (self._latency_number not in current) or (self._source_number not in current):
+            return
+        operations = current[self._latency_number][0] - previous[self._latency_number][0]
+        latency = (current[self._latency_number][1] - previous[self._latency_number][1]) \
+            / operations if operations > 0 else 0
+        source_rate = SECTOR_SIZE * (current[self._source_number][2]
+                                     - previous[self._source_number][2]) / max(duration, 0.001)
+        if latency > self._latency_threshold:
+            base = self.read_rate or source_rate
+            if not base:
+                # the latency is not caused by reading the source
+                return
+            rate = max(MIN_READ_RATE, base * BACKOFF_FACTOR)
+        elif (latency < self._latency_threshold * RECOVERY_MARGIN) \
+                and (self.read_rate is not None):
+            rate = self.read_rate * RECOVERY_FACTOR
+            if self._read_limit:
+                rate = min(rate, self._read_limit)
+            elif rate > 2 * source_rate:
+                # the limit is not effective anymore
+                rate = None
+        else:
+            return
+        if rate != self.read_rate:
+            log.info("Latency of the disk: %.1f ms - limiting reads to %s", latency,
+                     "unlimited" if rate is None else sizeof_fmt(rate) + "/s")
+            self._set_read_rate(rate)
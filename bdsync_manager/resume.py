@@ -0,0 +1,110 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import shlex
+import threading
+
+from bdsync_manager.utils import load_state, log, remove_state, save_state
+
+
+# the kind of state used for storing the progress of interrupted runs
+STATE_RESUME = "resume"
+# the method of calculating fingerprints (checkpoints using a different method are discarded)
+FINGERPRINT_METHOD = "md5-full"
+
+FINGERPRINT_SCRIPT = """
+dd if={filename} iflag=skip_bytes,count_bytes skip={offset:d} count={size:d} bs=1M status=none \
+    | md5sum
+"""
+
+
+def get_fingerprint(connection, filename, offset, size):
+    """ calculate a checksum of a range of a file or blockdevice
+
+        The complete range is read: every change of its content is detected.
+    """
+    script = FINGERPRINT_SCRIPT.format(filename=shlex.quote(filename), offset=offset,
+                                       size=size)
+    return connection.check_output(script).split()[0]
+
+
+def get_remote_file_size(connection, filename):
+    """ return the size of a (patch) file or None if it does not exist """
+    returncode, output = connection.run("stat -L --format %s {0}".format(shlex.quote(filename)))
+    try:
+        return int(output.strip()) if returncode == 0 else None
+    except ValueError:
+        return None
+
+
+class ResumeCheckpoint:
+    """ the progress of a segmented run, allowing to resume it after an interruption
+
+        Completed segments (synchronized in-place or with a stored patch) are recorded along
+        with the fingerprints (see "get_fingerprint") of the source and the target.  A
+        checkpoint is used only if the layout of the run (source, target, sizes, mode) is
+        unchanged.  Segments with a different fingerprint (or a missing patch file) are
+        processed again.
+    """
+
+    def __init__(self, state_dir, task_name):
+        self._state_dir = state_dir
+        self._task_name = task_name
+        self._lock = threading.Lock()
+        self._state = load_state(state_dir, task_name, STATE_RESUME) or {}
+
+    @property
+    def has_progress(self):
+        return bool(self._state.get("segments"))
+
+    def start(self, layout, is_valid):
+        """ begin a run with the given layout (a dictionary)
+
+            The completed segments of an earlier run with the same layout are returned (a
+            dictionary of segment indexes and their details), if "is_valid(index, details)"
+            confirms them.
+        """
+        completed = {}
+        if self._state.get("layout") == layout:
+            for key, details in self._state.get("segments", {}).items():
+                if is_valid(int(key), details):
+                    completed[int(key)] = details
+                else:
+                    log.warning("Discarding the checkpoint of segment %s: the source or the "
+                                "target changed", key)
+            if completed:
+                log.info("Resuming an interrupted run: %d segments were completed before",
+                         len(completed))
+        elif self.has_progress:
+            log.warning("Discarding the checkpoint of an interrupted run: the settings, the "
+                        "source or the target changed")
+        self._state = {"layout": layout,
+                       "segments": {str(index): details for index, details in completed.items()}}
+        save_state(self._state_dir, self._task_name, STATE_RESUME, self._state)
+        return completed
+
+    def add_segment(self, index, details):
+        with self._lock:
+            self._state["segments"][str(index)] = details
+            save_state(self._state_dir, self._task_name, STATE_RESUME, self._state)
+
+    def remove(self):
+        self._state = {}
+        remove_state(self._state_dir, self._task_name, STATE_RESUME)
@@ -0,0 +1,247 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import datetime
+import re
+import threading
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.utils import get_connection_host, log, set_task_name
+
+
+# names of the resource types that may be limited
+RESOURCE_HOST = "host"
+RESOURCE_VOLUME_GROUP = "volume_group"
+RESOURCE_PATCH_DIR = "patch_dir"
+TIME_WINDOW_REGEX = re.compile(r"^(?P<start>[0-9]{1,2}:[0-9]{2})-(?P<end>[0-9]{1,2}:[0-9]{2})$")
+
+
+def get_task_resources(settings):
+    """ determine the shared resources used by a task
+
+        The result is a list of tuples (resource type, identifier).
+    """
+    host = get_connection_host(settings["connection_command"])
+    resources = [(RESOURCE_HOST, host)]
+    if "lvm" in settings:
+        # late import: plumbum (used by the LVM module) is slow to import
+        import bdsync_manager.lvm
+        group = bdsync_manager.lvm.get_volume_group_from_path(settings["source_path"])
+        # fall back to the source path itself, if the volume group is unknown
+        resources.append((RESOURCE_VOLUME_GROUP, group or settings["source_path"]))
+    if not settings["apply_patch_in_place"]:
+        resources.append((RESOURCE_PATCH_DIR, (host, settings["target_patch_dir"])))
+    return resources
+
+
+def get_group_resources(settings_list):
+    """ determine the shared resources used by a group of tasks (see "TaskGroup") """
+    resources = []
+    for settings in settings_list:
+        resources.extend(resource for resource in get_task_resources(settings)
+                         if resource not in resources)
+    return resources
+
+
+class ScheduleWindow:
+    """ the times of day allowing the start of a task
+
+        The window is a comma separated list of time ranges (e.g. "22:00-06:00").  An empty
+        window allows all times.
+    """
+
+    def __init__(self, text):
+        self._ranges = []
+        for item in (text or "").split(","):
+            item = item.strip()
+            if not item:
+                continue
+            match = TIME_WINDOW_REGEX.match(item)
+            if not match:
+                raise ValueError("invalid time window (expected something like '22:00-06:00'): "
+                                 "{0}".format(item))
+            self._ranges.append((self._parse_time(match.group("start")),
+                                 self._parse_time(match.group("end"))))
+
+    @staticmethod
+    def _parse_time(text):
+        try:
+            return datetime.datetime.strptime(text, "%H:%M").time()
+        except ValueError:
+            raise ValueError("invalid time of day: {0}".format(text))
+
+    @staticmethod
+    def _range_contains(start, end, now):
+        return (start <= now < end) if (start <= end) else (now >= start or now < end)
+
+    def contains(self, timestamp):
+        if not self._ranges:
+            return True
+        now = datetime.datetime.fromtimestamp(timestamp).time()
+        return any(self._range_contains(start, end, now) for start, end in self._ranges)
+
+    def get_remaining(self, timestamp):
+        """ return the number of seconds until the window closes (None: unlimited window)
+
+            Zero is returned if the timestamp is outside of the window.
+        """
+        if not self._ranges:
+            return None
+        now = datetime.datetime.fromtimestamp(timestamp)
+        remaining = 0
+        for start, end in self._ranges:
+            if self._range_contains(start, end, now.time()):
+                closing = datetime.datetime.combine(now.date(), end)
+                if closing <= now:
+                    closing += datetime.timedelta(days=1)
+                remaining = max(remaining, (closing - now).total_seconds())
+        return remaining
+
+
+class _ScheduledTask:
+
+    def __init__(self, name, task, resources):
+        self.name = name
+        self.task = task
+        self.resources = tuple(resources)
+
+
+class Scheduler:
+    """ run tasks in a pool of worker threads
+
+        Every task claims a set of resources (see "get_task_resources").  A task is started only
+        if none of its resources is used by the maximum number of tasks allowed for the type of
+        this resource.  Pending tasks are started in the order of their submission as soon as
+        their resources are available.
+
+        A persistent scheduler keeps its workers waiting for further tasks (e.g. for the daemon)
+        until it is cancelled.  Failures of tasks are reported to the "on_finished" callback
+        instead of stopping the scheduler.
+    """
+
+    def __init__(self, jobs=1, resource_limits=None, persistent=False, on_finished=None):
+        self._jobs = max(1, jobs)
+        # a missing or zero limit for a resource type means: no limit
+        self._resource_limits = dict(resource_limits or {})
+        self._persistent = persistent
+        self._on_finished = on_finished
+        self._pending = []
+        self._resource_usage = collections.Counter()
+        self._condition = threading.Condition()
+        self._failed = []
+        self._fatal_error = None
+        self._cancelled = False
+
+    def add(self, name, task, resources=()):
+        with self._condition:
+            self._pending.append(_ScheduledTask(name, task, resources))
+            self._condition.notify_all()
+
+    def cancel(self):
+        """ do not start any further tasks """
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def _is_available(self, item):
+        for resource in item.resources:
+            limit = self._resource_limits.get(resource[0])
+            if limit and (self._resource_usage[resource] >= limit):
+                return False
+        return True
+
+    def _claim_next(self):
+        """ wait for the next runnable task and claim its resources
+
+            None is returned if there is nothing left to be done.
+        """
+        with self._condition:
+            while not self._cancelled and (self._pending or self._persistent):
+                for index, item in enumerate(self._pending):
+                    if self._is_available(item):
+                        del self._pending[index]
+                        self._resource_usage.update(item.resources)
+                        return item
+                self._condition.wait()
+            return None
+
+    def _release(self, item):
+        with self._condition:
+            self._resource_usage.subtract(item.resources)
+            self._condition.notify_all()
+
+    def _process_tasks(self):
+        while True:
+            item = self._claim_next()
+            if item is None:
+                break
+            set_task_name(item.name)
+            success = False
+            try:
+                item.task.run()
+                success = True
+            except TaskProcessingError as error:
+                log.error(str(error))
+                with self._condition:
+                    self._failed.append(item.name)
+            except BaseException as error:
+                if self._persistent and isinstance(error, Exception):
+                    # a long running scheduler survives unexpected errors of single tasks
+                    log.exception("Unexpected error: %s", error)
+                else:
+                    # unexpected errors are raised again in the main thread
+                    with self._condition:
+                        if self._fatal_error is None:
+                            self._fatal_error = error
+                    self.cancel()
+            finally:
+                set_task_name(None)
+                self._release(item)
+                if self._on_finished is not None:
+                    self._on_finished(item.name, success)
+
+    def run(self):
+        """ process all tasks and return the names of the failed tasks
+
+            The main thread waits for the workers.  If it is interrupted by the user, then no
+            further tasks are started and the running tasks are allowed to finish (releasing
+            their LVM snapshots) before the KeyboardInterrupt is raised again.
+        """
+        workers = [threading.Thread(target=self._process_tasks, daemon=True,
+                                    name="bdsync-worker-{0}".format(index))
+                   for index in range(self._jobs if self._persistent
+                                      else min(self._jobs, len(self._pending)))]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                # a timeout keeps the main thread responsive for KeyboardInterrupt
+                while worker.is_alive():
+                    worker.join(0.5)
+        except KeyboardInterrupt:
+            self.cancel()
+            log.warning("Waiting for running tasks to finish")
+            for worker in workers:
+                worker.join()
+            raise
+        if self._fatal_error is not None:
+            raise self._fatal_error
+        return list(self._failed)
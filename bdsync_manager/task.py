@@ -18,14 +18,115 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import json
 import shlex
+import subprocess
+import sys
 import time
 
 from plumbum import ProcessExecutionError
+from plumbum.commands.base import BaseCommand
+from plumbum.commands.processes import run_proc
 
+import bdsync_manager.lvm
 from bdsync_manager import TaskProcessingError, NotFoundError
-from bdsync_manager.utils import get_command_from_tokens, get_tempfile, log, sizeof_fmt
+from bdsync_manager.archive import PatchArchive
+from bdsync_manager.bandwidth import get_budget
+from bdsync_manager.blocksize import get_link_rate, STATE_BLOCK_SIZE, tune_block_size
+from bdsync_manager.compression import choose_codec, get_compressor, get_decompress_tokens, \
+    is_codec_available, update_statistics
+from bdsync_manager.connection import get_agent_command, get_agent_tokens, get_connection
+from bdsync_manager.dedup import DedupEncoder, DedupSession, get_dedup_index
+from bdsync_manager.engine import LocalDiffEngine
+from bdsync_manager.estimate import compare_sample, DEFAULT_BLOCK_SIZE, DEFAULT_REGION_SIZE, \
+    estimate_changes, estimate_duration, get_tracked_changes
+from bdsync_manager.history import get_recent_rates, record_run, STATUS_DEFERRED, \
+    STATUS_FAILED, STATUS_SUCCESS
+from bdsync_manager.patch import get_data_ranges, get_merged_ranges, write_range_patch
+from bdsync_manager.relay import StreamRelay, tracked_transfer
+from bdsync_manager.resources import ResourceControl
+from bdsync_manager.resume import FINGERPRINT_METHOD, get_fingerprint, get_remote_file_size, \
+    ResumeCheckpoint
+from bdsync_manager.scheduler import ScheduleWindow
+from bdsync_manager.trace import span, TracedCommand
+from bdsync_manager.utils import AbortSignal, get_abort_signal, get_command_from_tokens, \
+    get_file_size, get_resource_control, get_task_name, load_state, log, save_state, \
+    set_abort_signal, set_resource_control, set_task_name, sizeof_fmt, wrap_command_tokens
+
+
+# the kind of state used for storing the checkpoint of changed block tracking
+STATE_CHANGE_TRACKING = "change-tracking"
+# the kind of state used for storing the statistics of the adaptive compression
+STATE_COMPRESSION = "compression"
+# segments are aligned to this size
+SEGMENT_ALIGNMENT = 1024 * 1024
+# loop devices are limited to multiples of the sector size
+SECTOR_SIZE = 512
+
+
+def get_source_volume(settings):
+    """ return the LVM volume of the source (or None if LVM snapshots are not enabled) """
+    if "lvm" not in settings:
+        return None
+    # the volumes of volume group tasks are prepared based on the inventory of the group
+    return settings["lvm"].get("volume") or \
+        settings["lvm"]["caller"].get_volume(settings["source_path"])
+
+
+def get_source_snapshot(settings, volume):
+    """ create the snapshot of the source volume (maybe coordinated with other volumes) """
+    coordinator = settings["lvm"].get("coordinator")
+    with span("create snapshot", volume=volume.name):
+        if coordinator is None:
+            return volume.get_snapshot(settings["lvm"]["snapshot_name"],
+                                       settings["lvm"]["snapshot_size"])
+        else:
+            return coordinator.get_snapshot(volume, settings["lvm"]["snapshot_name"],
+                                            settings["lvm"]["snapshot_size"])
+
+
+def get_snapshot_monitor(settings, volume, abort_signal):
+    """ return a monitor for the snapshot of the source volume (None: monitoring is disabled)
+
+        Thin snapshots (without a fixed size) are not monitored.
+    """
+    lvm_settings = settings["lvm"]
+    if not volume.has_snapshot or not lvm_settings["snapshot_size"] \
+            or not lvm_settings["monitor_interval"]:
+        return None
+    return bdsync_manager.lvm.SnapshotMonitor(
+        volume, abort_signal, lvm_settings["monitor_interval"], lvm_settings["extend_threshold"],
+        lvm_settings["abort_threshold"], lvm_settings["extend_size"], lvm_settings["max_size"])
+
+
+def create_resource_control(settings, name=None):
+    """ return the resource limits of the local processes of a task (None: no limits) """
+    control = ResourceControl(
+        name or settings["name"], settings["io_priority_class"], settings["io_priority_level"],
+        settings["cpu_nice"], settings["cgroup_dir"], settings["cgroup_read_limit"],
+        settings["cgroup_cpu_limit"], settings["io_latency_threshold"],
+        settings["io_latency_device"])
+    if not (settings["io_priority_class"] or settings["cpu_nice"] or control.uses_cgroup):
+        return None
+    return control
+
+
+def release_source_snapshot(settings, volume, keep=False):
+    """ remove the snapshot of the source volume (or just stop managing it) """
+    coordinator = settings["lvm"].get("coordinator")
+    with span("release snapshot", volume=volume.name, keep=keep):
+        if coordinator is None:
+            if not keep:
+                volume.remove_snapshot()
+        elif keep:
+            coordinator.forget_snapshot(volume)
+        else:
+            coordinator.release_snapshot(volume)
 
 
 class Task:
@@ -33,75 +134,551 @@ class Task:
     def __init__(self, config_dict):
         self.settings = dict(config_dict)
 
-    def run(self):
+    def _get_engine(self, block_size=None):
+        if self.settings["diff_engine"] == "native":
+            return LocalDiffEngine(block_size or self.settings["diff_block_size"],
+                                   self.settings["diff_threads"])
+        else:
+            return None
+
+    def _get_compression(self, connection):
+        """ determine the codec and level used for compressing the patch (or None) """
+        codec = self.settings["compression"]
+        if not codec or (codec == "none") or not connection.is_remote:
+            return None
+
+        def is_usable(name):
+            return (name == "none") or (is_codec_available(name) and connection.has_program(
+                get_decompress_tokens(name)[0]))
+
+        if codec == "auto":
+            statistics = load_state(self.settings["state_dir"], self.settings["name"],
+                                    STATE_COMPRESSION) or {}
+            codec, level = choose_codec(statistics, is_usable)
+            log.info("Adaptive compression: using %s", codec if level is None
+                     else "{0} (level {1:d})".format(codec, level))
+            return None if codec == "none" else (codec, level)
+        if not is_usable(codec):
+            raise TaskProcessingError("The compression codec '{0}' is not available locally or "
+                                      "remotely".format(codec))
+        return codec, self.settings["compression_level"]
+
+    def _update_compression_statistics(self, compression, statistics):
+        """ store the measurements of the latest transfer for the adaptive compression """
+        if (self.settings["compression"] != "auto") or not statistics:
+            return
+        state = load_state(self.settings["state_dir"], self.settings["name"],
+                           STATE_COMPRESSION) or {}
+        codec, level = compression or ("none", None)
+        save_state(self.settings["state_dir"], self.settings["name"], STATE_COMPRESSION,
+                   update_statistics(state, codec, level, statistics))
+
+    def _get_block_size(self, source, connection):
+        """ determine the block size used for comparing the source and the target (or None)
+
+            The block size of the "auto" mode is tuned again after the tuning interval (see
+            "bdsync_manager.blocksize").  A failed tuning keeps the previous block size.
+        """
+        block_size = self.settings["block_size"]
+        if block_size != "auto":
+            return block_size
+        state = load_state(self.settings["state_dir"], self.settings["name"],
+                           STATE_BLOCK_SIZE) or {}
+        if state and (time.time() - state["time"] < self.settings["block_size_tuning_interval"]):
+            return state["block_size"]
+        try:
+            with span("tune block size") as details:
+                block_size, estimates = tune_block_size(
+                    source, self.settings["target_path"], connection,
+                    self.settings["block_size_candidates"], self.settings["block_size_sample"],
+                    get_link_rate(self.settings["state_dir"], self.settings["name"]),
+                    self.settings["verify_threads"], self.settings["remote_python_bin"])
+                details["block_size"] = block_size
+        except TaskProcessingError as exc:
+            log.warning("Skipping the block size tuning: %s", exc)
+            return state.get("block_size")
+        save_state(self.settings["state_dir"], self.settings["name"], STATE_BLOCK_SIZE,
+                   {"block_size": block_size, "time": time.time(),
+                    "estimates": {str(key): value for key, value in estimates.items()}})
+        return block_size
+
+    def _estimate_changes(self, source, changed_ranges, block_size, connection):
+        """ estimate the changes to be transferred (or None) before the synchronization """
+        source_size = get_file_size(source)
+        if changed_ranges is not None:
+            return get_tracked_changes(source_size, changed_ranges, block_size)
+        try:
+            with span("estimate changes"):
+                sample = compare_sample(source, self.settings["target_path"], connection,
+                                        block_size or DEFAULT_BLOCK_SIZE, DEFAULT_REGION_SIZE,
+                                        self.settings["change_estimation_sample"],
+                                        self.settings["verify_threads"],
+                                        self.settings["remote_python_bin"])
+        except TaskProcessingError as exc:
+            log.warning("Skipping the change estimation: %s", exc)
+            return None
+        return estimate_changes(sample)
+
+    def _plan_transfer(self, run, estimate, connection):
+        """ check whether the estimated changes fit into the available space and time
+
+            Returns whether the patch is applied in place - or None if the run is deferred.
+            A patch not fitting into "target_patch_dir" is handled according to
+            "patch_space_action".  A run started within its "schedule_window" is deferred if it is
+            not expected to finish before the end of the window (based on the recent runs).
+        """
+        apply_in_place = self.settings["apply_patch_in_place"]
+        if not apply_in_place:
+            free = connection.get_free_space(self.settings["target_patch_dir"])
+            if estimate["patch_size_max"] > free:
+                message = ("The expected patch ({0}) may not fit into the patch directory "
+                           "(free: {1})".format(sizeof_fmt(estimate["patch_size_max"]),
+                                                sizeof_fmt(free)))
+                action = self.settings["patch_space_action"]
+                if action == "fail":
+                    raise TaskProcessingError(message)
+                elif action == "defer":
+                    log.warning("%s: deferring the run", message)
+                    return None
+                else:
+                    log.warning("%s: applying the patch in place", message)
+                    apply_in_place = True
+        remaining = ScheduleWindow(self.settings["schedule_window"]).get_remaining(time.time())
+        if remaining:
+            duration = estimate_duration(
+                run["bytes_read"], estimate["patch_size_max"],
+                get_recent_rates(self.settings["state_dir"], self.settings["name"]))
+            if (duration is not None) and (duration > remaining):
+                log.warning("Deferring the run: its expected duration (%d seconds) exceeds the "
+                            "remaining schedule window (%d seconds)", duration, remaining)
+                return None
+        return apply_in_place
+
+    def _get_sync_options(self, connection, apply_in_place, compression, block_size):
+        """ return the settings of a synchronization (see "SyncOptions") """
+        return SyncOptions(
+            local_bdsync=self.settings["local_bdsync_bin"],
+            remote_bdsync=self.settings["remote_bdsync_bin"],
+            bdsync_args=self.settings["bdsync_args"],
+            target_patch_dir=self.settings["target_patch_dir"],
+            create_if_missing=self.settings["create_target_if_missing"],
+            apply_in_place=apply_in_place, bandwidth_limit=self.settings["bandwidth_limit"],
+            segment_size=self.settings["segment_size"],
+            segment_count=self.settings["segment_count"],
+            segment_jobs=self.settings["segment_jobs"], compression=compression,
+            block_size=block_size, apply_python=self._get_apply_python(connection),
+            preallocation=self.settings["target_preallocation"])
+
+    def _get_apply_python(self, connection):
+        """ return the Python interpreter for applying patches natively (or None) """
+        if self.settings["apply_engine"] != "native":
+            return None
+        return self.settings["remote_python_bin"] if connection.is_remote else sys.executable
+
+    def get_patch_archive(self, connection):
+        """ return the patch archive of the task (or None) """
+        if not self.settings["patch_archive_dir"]:
+            return None
+        return PatchArchive(self.settings["patch_archive_dir"], connection,
+                            self.settings["remote_python_bin"])
+
+    def _get_dedup_session(self, connection):
+        """ return the deduplication of the transferred blocks (or an empty context) """
+        if not self.settings["dedup_store_dir"] or not connection.is_remote:
+            return contextlib.nullcontext()
+        index = get_dedup_index(self.settings["state_dir"], connection.host,
+                                self.settings["dedup_store_dir"],
+                                self.settings["dedup_index_size"])
+        return DedupSession(index, connection, self.settings["remote_python_bin"])
+
+    def _get_change_tracker(self, lvm_volume):
+        if self.settings["change_tracking"] == "era":
+            return bdsync_manager.lvm.EraTracker(
+                self.settings["change_tracking_device"],
+                self.settings["change_tracking_metadata_device"])
+        elif self.settings["change_tracking"] == "thin":
+            return bdsync_manager.lvm.ThinDeltaTracker(lvm_volume,
+                                                       self.settings["lvm"]["snapshot_name"])
+        else:
+            return None
+
+    def _get_changed_ranges(self, tracker):
+        """ determine the changes since the last successful run (None: unknown) """
+        checkpoint = load_state(self.settings["state_dir"], self.settings["name"],
+                                STATE_CHANGE_TRACKING)
+        if checkpoint and (checkpoint.get("target") != self.settings["target_path"]):
+            checkpoint = None
+        with span("get changed ranges"):
+            changed_ranges = tracker.get_changed_ranges(checkpoint)
+        if changed_ranges is None:
+            log.warning("Changed block tracking is not available: synchronizing the full device")
+        else:
+            log.info("Changed block tracking: %d changed ranges (%s)", len(changed_ranges),
+                     sizeof_fmt(sum(length for offset, length in changed_ranges)))
+        return changed_ranges
+
+    def run(self, source=None, source_volume=None):
+        """ synchronize the target with the source
+
+            A source prepared by a group of tasks (see "TaskGroup") may be given instead of the
+            configured one: it is neither snapshotted nor released by this task.
+        """
         if self.settings["disabled"]:
             log.info("Skipping disabled task")
             return
-        if "lvm" in self.settings:
-            lvm_volume = self.settings["lvm"]["caller"].get_volume(self.settings["source_path"])
-            real_source = lvm_volume.get_snapshot(self.settings["lvm"]["snapshot_name"],
-                                                  self.settings["lvm"]["snapshot_size"])
+        # the details of the run are stored in the history (even if it fails)
+        run = {"task": self.settings["name"], "start_time": time.time()}
+        control = create_resource_control(self.settings)
+        try:
+            with span("task", task=self.settings["name"]) as details:
+                if control is not None:
+                    control.start()
+                    set_resource_control(control)
+                self._synchronize(run, source, source_volume)
+                details.update(status=run.get("status", STATUS_SUCCESS),
+                               bytes_read=run.get("bytes_read"),
+                               bytes_transferred=run.get("bytes_transferred"))
+        except BaseException as exc:
+            run["status"] = STATUS_FAILED
+            run["error"] = str(exc) or type(exc).__name__
+            raise
         else:
-            real_source = self.settings["source_path"]
+            run.setdefault("status", STATUS_SUCCESS)
+        finally:
+            if control is not None:
+                set_resource_control(None)
+                control.stop()
+            run["duration"] = time.time() - run["start_time"]
+            record_run(self.settings["state_dir"], run)
+
+    def _synchronize(self, run, source=None, source_volume=None):
+        lvm_volume = get_source_volume(self.settings) if source is None else source_volume
+        tracker = self._get_change_tracker(lvm_volume)
+        resume = None
+        if self.settings["resumable"]:
+            resume = ResumeCheckpoint(self.settings["state_dir"], self.settings["name"])
+            if resume.has_progress and (lvm_volume is not None) and (tracker is None):
+                # the snapshot of the interrupted run is the source for resuming it
+                snapshot_name = self.settings["lvm"]["snapshot_name"]
+                if lvm_volume.get_attribute("lv_name", snapshot_name):
+                    log.info("Reusing the LVM snapshot of the interrupted run: %s",
+                             snapshot_name)
+                    lvm_volume.adopt_snapshot(snapshot_name)
+                else:
+                    log.warning("Discarding the checkpoint of the interrupted run: its LVM "
+                                "snapshot is gone")
+                    resume.remove()
+        real_source = self.settings["source_path"]
+        changed_ranges = None
+        monitor = None
+        connection = get_connection(self.settings["connection_command"],
+                                    self.settings["connection_multiplexing"])
         try:
-            bdsync_run(real_source, self.settings["target_path"],
-                       self.settings["connection_command"], self.settings["local_bdsync_bin"],
-                       self.settings["remote_bdsync_bin"], self.settings["bdsync_args"],
-                       self.settings["target_patch_dir"],
-                       self.settings["create_target_if_missing"],
-                       self.settings["apply_patch_in_place"], self.settings["bandwidth_limit"])
+            if tracker is not None:
+                # the tracker may provide its own snapshot
+                real_source = tracker.start() or real_source
+            if source is not None:
+                real_source = source
+            elif (lvm_volume is not None) and ((tracker is None) or not lvm_volume.has_snapshot):
+                # an adopted snapshot (see above) is used as it is
+                real_source = get_source_snapshot(self.settings, lvm_volume)
+                monitor = get_snapshot_monitor(self.settings, lvm_volume, AbortSignal())
+                if monitor is not None:
+                    # the transfer is aborted early if the snapshot is running out of space
+                    set_abort_signal(monitor.abort_signal)
+                    monitor.start()
+            if tracker is not None:
+                changed_ranges = self._get_changed_ranges(tracker)
+            control = get_resource_control()
+            if control is not None:
+                control.set_source(real_source)
+            run["source_size"] = get_file_size(real_source)
+            run["bytes_read"] = run["source_size"] if changed_ranges is None \
+                else sum(length for offset, length in changed_ranges)
+            compression = self._get_compression(connection)
+            block_size = None
+            if changed_ranges is None:
+                # the block size matters only for comparing the source and the target
+                block_size = self._get_block_size(real_source, connection)
+            run["block_size"] = block_size
+            apply_in_place = self.settings["apply_patch_in_place"]
+            archive = self.get_patch_archive(connection)
+            if self.settings["change_estimation"]:
+                estimate = self._estimate_changes(real_source, changed_ranges, block_size,
+                                                  connection)
+                if estimate is not None:
+                    run["estimated_patch_size"] = estimate["patch_size"]
+                    apply_in_place = self._plan_transfer(run, estimate, connection)
+                    if apply_in_place is None:
+                        run["status"] = STATUS_DEFERRED
+                        return
+            with self._get_dedup_session(connection) as dedup:
+                statistics = bdsync_run(
+                    real_source, self.settings["target_path"], connection,
+                    self._get_sync_options(connection, apply_in_place, compression, block_size),
+                    changed_ranges=changed_ranges, engine=self._get_engine(block_size),
+                    resume=resume, archive=archive, dedup=dedup,
+                    expected_size=run.get("estimated_patch_size"))
+            self._update_compression_statistics(compression, statistics)
+            if (archive is not None) and self.settings["patch_archive_compact_age"]:
+                archive.compact(time.time() - self.settings["patch_archive_compact_age"])
+            if statistics:
+                run.update(patch_size=statistics["bytes_received"],
+                           bytes_transferred=statistics["bytes_transferred"],
+                           generate_time=statistics["generate_time"],
+                           transfer_time=statistics["transfer_time"],
+                           compression_time=statistics["compression_time"],
+                           apply_time=statistics.get("apply_time"))
+            if monitor is not None:
+                monitor.stop()
+                monitor.check()
+                run.update(snapshot_fill=monitor.peak_fill, snapshot_usage=monitor.peak_usage)
+                if monitor.extensions:
+                    log.warning("The LVM snapshot was extended %d time(s): consider increasing "
+                                "'lvm_snapshot_size' (peak usage: %s)", monitor.extensions,
+                                sizeof_fmt(monitor.peak_usage))
+            elif lvm_volume is not None:
+                run["snapshot_fill"] = lvm_volume.get_snapshot_fill()
+            if tracker is not None:
+                checkpoint = tracker.get_checkpoint()
+                checkpoint["target"] = self.settings["target_path"]
+                tracker.commit()
+                save_state(self.settings["state_dir"], self.settings["name"],
+                           STATE_CHANGE_TRACKING, checkpoint)
         except ProcessExecutionError as exc:
             raise TaskProcessingError("Failed to run command: {0}".format(exc))
         finally:
-            if "lvm" in self.settings:
-                lvm_volume.remove_snapshot()
+            if monitor is not None:
+                monitor.stop()
+                if monitor.peak_fill is not None:
+                    run.setdefault("snapshot_fill", monitor.peak_fill)
+                    run.setdefault("snapshot_usage", monitor.peak_usage)
+                set_abort_signal(None)
+            if tracker is not None:
+                tracker.cleanup()
+            if (source is None) and (lvm_volume is not None) and lvm_volume.has_snapshot:
+                if (resume is not None) and resume.has_progress and (tracker is None):
+                    log.warning("Keeping the LVM snapshot for resuming the interrupted run")
+                    release_source_snapshot(self.settings, lvm_volume, keep=True)
+                else:
+                    release_source_snapshot(self.settings, lvm_volume)
+
+
+def get_source_groups(task_settings):
+    """ group the names of tasks synchronizing the same source to different targets
+
+        Tasks are grouped if they share their "source_path" and their use of LVM snapshots.
+        Tasks with changed block tracking, resumable tasks and tasks with disabled
+        "source_sharing" are never grouped: they manage their source on their own.  The result
+        is a list of name lists in the given order (single tasks are lists of one item).
+    """
+    groups = collections.OrderedDict()
+    for name, settings in task_settings.items():
+        if settings["disabled"] or not settings["source_sharing"] \
+                or settings["change_tracking"] or settings["resumable"]:
+            key = (name, )
+        else:
+            key = (settings["source_path"], "lvm" in settings)
+        groups.setdefault(key, []).append(name)
+    return list(groups.values())
+
+
+class TaskGroup:
+    """ synchronize a single source to the targets of multiple tasks
+
+        The tasks share one LVM snapshot (based on the settings of the first task) and their
+        transfers run concurrently.  Every transfer reads and hashes the source on its own: the
+        page cache may serve some of the parallel reads, but the transfers are not kept in step
+        (e.g. with targets behind links of different speed).  Thus the source may be read once
+        per target.  Every task is recorded in the history separately.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self.settings = self.tasks[0].settings
+
+    def run(self):
+        lvm_volume = get_source_volume(self.settings)
+        source = self.settings["source_path"]
+        monitor = None
+        abort_signal = AbortSignal()
+        # the LVM operations of the group are subject to the limits of the first task
+        control = create_resource_control(self.settings, "group-" + self.settings["name"])
+        try:
+            if control is not None:
+                control.start()
+                set_resource_control(control)
+            if lvm_volume is not None:
+                source = get_source_snapshot(self.settings, lvm_volume)
+                monitor = get_snapshot_monitor(self.settings, lvm_volume, abort_signal)
+                if monitor is not None:
+                    monitor.start()
+            with span("task group", tasks=[task.settings["name"] for task in self.tasks]):
+                failed = self._run_tasks(source, lvm_volume, abort_signal)
+        finally:
+            if monitor is not None:
+                monitor.stop()
+            if (lvm_volume is not None) and lvm_volume.has_snapshot:
+                release_source_snapshot(self.settings, lvm_volume)
+            if control is not None:
+                set_resource_control(None)
+                control.stop()
+        if failed:
+            raise TaskProcessingError("Failed to synchronize the shared source to some targets: "
+                                      "{0}".format(", ".join(failed)))
+
+    def _run_tasks(self, source, source_volume, abort_signal):
+        """ run all tasks in parallel and return the names of the failed ones """
+        def run_task(task):
+            set_task_name(task.settings["name"])
+            set_abort_signal(abort_signal)
+            try:
+                task.run(source, source_volume)
+            except TaskProcessingError as exc:
+                log.error(str(exc))
+                return task.settings["name"]
+            finally:
+                set_task_name(None)
+                set_abort_signal(None)
+            return None
+
+        log.info("Synchronizing a shared source to %d targets: %s", len(self.tasks), source)
+        with concurrent.futures.ThreadPoolExecutor(len(self.tasks)) as executor:
+            futures = [executor.submit(run_task, task) for task in self.tasks]
+        # unexpected errors are raised (after all tasks are finished)
+        return [name for name in (future.result() for future in futures) if name is not None]
+
+
+class SyncOptions:
+    """ the settings of a synchronization (see "bdsync_run")
+
+        The compression is given as a codec and a level (None: uncompressed).  Patches are
+        applied by the agent instead of bdsync, if a Python interpreter ("apply_python") for
+        the target host is given.
+    """
+
+    def __init__(self, local_bdsync="bdsync", remote_bdsync="bdsync", bdsync_args="",
+                 target_patch_dir=None, create_if_missing=False, apply_in_place=False,
+                 bandwidth_limit=None, segment_size=None, segment_count=None,
+                 segment_jobs=None, compression=None, block_size=None, apply_python=None,
+                 preallocation="sparse"):
+        self.local_bdsync = local_bdsync
+        self.remote_bdsync = remote_bdsync
+        self.bdsync_args = bdsync_args
+        self.target_patch_dir = target_patch_dir
+        self.create_if_missing = create_if_missing
+        self.apply_in_place = apply_in_place
+        self.bandwidth_limit = bandwidth_limit
+        self.segment_size = segment_size
+        self.segment_count = segment_count
+        self.segment_jobs = segment_jobs
+        self.compression = compression
+        self.block_size = block_size
+        self.apply_python = apply_python
+        self.preallocation = preallocation
+
+    def get_target(self, target_filename, connection, dedup=None):
+        """ return the target of the synchronization on the host of the connection """
+        return SyncTarget(target_filename,
+                          self.remote_bdsync if connection.is_remote else self.local_bdsync,
+                          self.bdsync_args, connection, self.apply_python, dedup)
 
 
 class SyncSource:
 
-    def __init__(self, source_filename, bdsync_bin, bdsync_args):
+    def __init__(self, source_filename, bdsync_bin, bdsync_args, block_size=None):
         self.filename = source_filename
         self._bdsync_bin = bdsync_bin
         self._bdsync_arg_tokens = shlex.split(bdsync_args)
+        if block_size:
+            # the block size is an option of the client (the server must not receive it)
+            self._bdsync_arg_tokens.append("--blocksize={0:d}".format(block_size))
 
     def get_generate_patch_command(self, sync_target):
         bdsync_server_cmd = sync_target.get_bdsync_command("--server")
         # TODO: fix the command -> string conversion is not
         cmd_args = [self._bdsync_bin] + self._bdsync_arg_tokens + \
                    [str(bdsync_server_cmd), self.filename, sync_target.filename]
-        return get_command_from_tokens(cmd_args)
+        # the local bdsync process reads the source: the resource limits of the task apply
+        return get_command_from_tokens(wrap_command_tokens(cmd_args))
+
+
+def get_diffsize_mode(arg_tokens):
+    """ return the handling of different sizes by "bdsync --patch" for the given arguments """
+    mode = "strict"
+    for token in arg_tokens:
+        if token == "--diffsize":
+            mode = "resize"
+        elif token.startswith("--diffsize="):
+            mode = token.split("=", 1)[1]
+    return mode
 
 
 class SyncTarget:
 
-    def __init__(self, target_filename, bdsync_bin, bdsync_args, connection_command=None):
+    def __init__(self, target_filename, bdsync_bin, bdsync_args, connection, apply_python=None,
+                 dedup=None):
+        """ patches are applied by the agent via the given Python interpreter (if given)
+
+            Deduplicated patches (see "bdsync_manager.dedup") are expanded in front of the
+            application, if a dedup session is given.
+        """
         self.filename = target_filename
         self._bdsync_bin = bdsync_bin
         self._bdsync_arg_tokens = shlex.split(bdsync_args)
-        self._connection_tokens = shlex.split(connection_command or "")
+        self._connection = connection
+        self._connection_tokens = connection.tokens
+        self._apply_python = apply_python
+        self._dedup = dedup
 
     def get_bdsync_command(self, arg):
         cmd_args = self._connection_tokens + [self._bdsync_bin] + self._bdsync_arg_tokens + [arg]
         return get_command_from_tokens(cmd_args)
 
-    def exists(self):
-        cmd_args = self._connection_tokens + ["[", "-e", self.filename, "]"]
-        cmd = get_command_from_tokens(cmd_args)
-        log.debug("Testing if target exists: %s", cmd)
-        retcode = cmd.run(retcode=(0, 1))[0]
-        log.debug("Target %s", "exists" if (retcode == 0) else "does not exist")
-        return retcode == 0
-
-    def create_empty(self):
-        cmd_args = self._connection_tokens + ["touch", self.filename]
-        cmd = get_command_from_tokens(cmd_args)
-        log.debug("Creating target: %s", cmd)
-        cmd()
-
-    def get_apply_patch_command(self, patch=None):
+    def preflight(self, patch_dir=None):
+        """ retrieve the state of the target (and create a temporary patch file) at once """
+        return self._connection.preflight(self.filename, patch_dir)
+
+    def create_empty(self, size=0, preallocation="sparse"):
+        """ create the target (consisting of zeros) with the given size
+
+            The space of the target is reserved ("full") or it is left sparse ("sparse").
+        """
+        log.debug("Creating target (%s, %s): %s", sizeof_fmt(size), preallocation,
+                  self.filename)
+        if (preallocation == "full") and (size > 0):
+            command = "fallocate --length {0:d} {1}"
+        else:
+            command = "truncate --size {0:d} {1}"
+        self._connection.check_output(command.format(size, shlex.quote(self.filename)))
+
+    def get_apply_patch_command(self, patch=None, compression=None):
+        if self._dedup is not None:
+            return self._get_expand_patch_command(patch, compression)
+        if self._apply_python:
+            # the agent reads the patch on its own (see "bdsync_manager.agent.run_apply")
+            decompress_tokens = None if compression is None \
+                else get_decompress_tokens(compression[0])
+            return get_agent_command(self._connection, self._apply_python,
+                                     ["apply", "-" if patch is None else patch.filename,
+                                      json.dumps(decompress_tokens), self.filename,
+                                      get_diffsize_mode(self._bdsync_arg_tokens)])
+        patch_tokens = [self._bdsync_bin] + self._bdsync_arg_tokens + ["--patch"]
+        if compression is not None:
+            # decompress the patch in front of bdsync
+            decompress_tokens = get_decompress_tokens(compression[0])
+            if self._connection_tokens:
+                remote_cmd_string = "{0}{1} | {2}".format(
+                    shlex.join(decompress_tokens),
+                    "" if patch is None else " < {0}".format(shlex.quote(patch.filename)),
+                    shlex.join(patch_tokens))
+                return get_command_from_tokens(self._connection_tokens + [remote_cmd_string])
+            decompress_command = get_command_from_tokens(decompress_tokens)
+            if patch is not None:
+                decompress_command = decompress_command < patch.filename
+            return decompress_command | get_command_from_tokens(patch_tokens)
         # by default: read from stdin
-        patch_command = get_command_from_tokens([self._bdsync_bin] + self._bdsync_arg_tokens +
-                                                ["--patch"])
+        patch_command = get_command_from_tokens(patch_tokens)
         if patch is not None:
             patch_command = patch_command < patch.filename
         if self._connection_tokens:
@@ -110,12 +687,28 @@ class SyncTarget:
         else:
             return patch_command
 
+    def _get_expand_patch_command(self, patch=None, compression=None):
+        """ expand a deduplicated patch (see "bdsync_manager.agent.run_expand") and apply it """
+        decompress_tokens = None if compression is None \
+            else get_decompress_tokens(compression[0])
+        if self._apply_python:
+            apply_tokens = get_agent_tokens(self._apply_python,
+                                            ["apply", "-", json.dumps(None), self.filename,
+                                             get_diffsize_mode(self._bdsync_arg_tokens)])
+        else:
+            apply_tokens = [self._bdsync_bin] + self._bdsync_arg_tokens + ["--patch"]
+        return get_agent_command(self._connection, self._dedup.python_bin,
+                                 ["expand", self._dedup.store_dir,
+                                  "-" if patch is None else patch.filename,
+                                  json.dumps(decompress_tokens), json.dumps(apply_tokens)])
+
 
 class SyncPatch:
 
-    def __init__(self, target_patch_dir, connection_command=None):
-        self._connection_tokens = shlex.split(connection_command or "")
-        self.filename = get_tempfile(target_patch_dir, self._connection_tokens)
+    def __init__(self, filename, connection):
+        self._connection = connection
+        self._connection_tokens = connection.tokens
+        self.filename = filename
         log.debug("Using temporary patch file: %s", self.filename)
 
     def get_store_command(self):
@@ -129,65 +722,426 @@ class SyncPatch:
         log.debug("Storing patch file: %s", store_cmd)
         return store_cmd
 
-    def get_size(self):
-        # "stat --format %s" returns the size of the file in bytes
-        cmd_args = self._connection_tokens + ["stat", "--format", "%s", self.filename]
-        cmd = get_command_from_tokens(cmd_args)
-        log.debug("Retrieving the size of the patch: %s", cmd)
-        return int(cmd())
-
     def cleanup(self):
         # remove patch file
-        cmd_args = self._connection_tokens + ["rm", self.filename]
-        cmd = get_command_from_tokens(cmd_args)
-        log.debug("Removing temporary patch file: %s", cmd)
-        cmd()
-
-
-def bdsync_run(source_filename, target_filename, connection_command, local_bdsync,
-               remote_bdsync, bdsync_args, target_patch_dir, create_if_missing, apply_in_place,
-               bandwidth_limit):
-    """ Run bdsync in one or two phases. With one phase changes are applied in-place.
-        With two phases there are separate stages of patch generation / transfer followed
-        by the application of the patch.
+        log.debug("Removing temporary patch file: %s", self.filename)
+        self._connection.check_output("rm {0}".format(shlex.quote(self.filename)))
+
+
+def _run_patch_pipeline(generate_patch, receive_cmd, bandwidth_limit=None, host=None,
+                        compression=None, dedup=None, expected_size=None):
+    """ pass a patch to a command through an in-process relay (see "StreamRelay")
+
+        The patch is generated by a plumbum command or by a function writing the patch into a
+        stream.  The transfer is subject to the run-wide bandwidth budget (see
+        "bdsync_manager.bandwidth") in addition to its own bandwidth limit.  The patch is
+        compressed, if a codec and a level are given.  Repeated blocks are replaced with
+        references, if a dedup session is given (see "bdsync_manager.dedup").  The expected
+        size of the patch (if known) is used for reporting the progress.  The relay is
+        returned (e.g. for retrieving the number of transferred bytes).
+    """
+    log.debug("Piping patch into: %s", receive_cmd)
+    receive_process = receive_cmd.popen(stdin=subprocess.PIPE)
+    budget = get_budget()
+    bucket = budget.get_bucket(host, bandwidth_limit)
+    compressor = None if compression is None else get_compressor(*compression)
+    if dedup is not None:
+        compressor = DedupEncoder(dedup, compressor)
+    relay = StreamRelay(receive_process.stdin, bucket=bucket, compressor=compressor,
+                        expected_size=expected_size)
+    generate_process = None
+    try:
+        with tracked_transfer(relay), span("transfer patch", receive_command=str(receive_cmd),
+                                           receive_pid=receive_process.pid) as details:
+            if isinstance(generate_patch, BaseCommand):
+                log.debug("Generating patch: %s", generate_patch)
+                generate_process = generate_patch.popen(stdout=subprocess.PIPE)
+                details.update(generate_command=str(generate_patch),
+                               generate_pid=generate_process.pid)
+                relay.relay_from(generate_process.stdout.fileno())
+                run_proc(generate_process, 0)
+            else:
+                generate_patch(relay)
+            relay.finish()
+            details.update(bytes_received=relay.bytes_received,
+                           bytes_transferred=relay.bytes_transferred)
+    except BrokenPipeError:
+        # the receiving process failed: its exit code is evaluated below
+        if generate_process is not None:
+            generate_process.kill()
+            generate_process.communicate()
+    except BaseException:
+        # the receiving process must not handle an incomplete patch
+        for process in (generate_process, receive_process):
+            if process is not None:
+                process.kill()
+                process.communicate()
+        raise
+    finally:
+        budget.release(bucket)
+    run_proc(receive_process, 0)
+    if compression is None:
+        log.info("Transferred: %s (%s/s)", sizeof_fmt(relay.bytes_transferred),
+                 sizeof_fmt(relay.average_rate))
+    else:
+        log.info("Transferred: %s (%s/s, compressed from %s via %s)",
+                 sizeof_fmt(relay.bytes_transferred), sizeof_fmt(relay.average_rate),
+                 sizeof_fmt(relay.bytes_received), compression[0])
+    return relay
+
+
+def _get_target_size(target_state, target_filename):
+    """ return the size of the target based on the preflight checks (zero for a missing target)
+
+        The size of an existing target must be known: treating it as empty would discard its
+        content (see "SyncTarget.create_empty").
     """
-    source = SyncSource(source_filename, local_bdsync, bdsync_args)
-    target = SyncTarget(target_filename,
-                        remote_bdsync if connection_command else local_bdsync,
-                        bdsync_args, connection_command)
-    # preparations
-    if not target.exists():
-        if create_if_missing:
+    if not target_state["exists"]:
+        return 0
+    if target_state["size"] is None:
+        raise TaskProcessingError("Failed to determine the size of the target ({0}): is "
+                                  "'blockdev' available on the target host?"
+                                  .format(target_filename))
+    return target_state["size"]
+
+
+def _get_segment_size(source_size, segment_size=None, segment_count=None):
+    """ determine the aligned size of segments based on a maximum size or a number of segments """
+    if segment_count:
+        segment_size = min(segment_size or source_size, -(-source_size // segment_count))
+    # round up to the alignment
+    return max(1, -(-segment_size // SEGMENT_ALIGNMENT)) * SEGMENT_ALIGNMENT
+
+
+def _attach_loop_device(connection, filename, offset, size, read_only=False):
+    """ create a loop device exposing a part of a file or blockdevice """
+    cmd = "losetup --find --show --offset {0:d} --sizelimit {1:d} {2}{3}".format(
+        offset, size, "--read-only " if read_only else "", shlex.quote(filename))
+    # the device name is the last line (preceded by warnings)
+    device = connection.check_output(cmd).strip().splitlines()[-1]
+    log.debug("Attached loop device %s (offset: %d, size: %d) for %s",
+              device, offset, size, filename)
+    return device
+
+
+def _detach_loop_device(connection, device):
+    log.debug("Detaching loop device: %s", device)
+    connection.check_output("losetup --detach {0}".format(shlex.quote(device)))
+
+
+class _Segment:
+
+    def __init__(self, index, offset, size):
+        self.index = index
+        self.offset = offset
+        self.size = size
+        self.source_device = None
+        self.target_device = None
+        self.patch = None
+        # the segment is recorded in the checkpoint of the run
+        self.checkpointed = False
+
+    def __str__(self):
+        return "segment {0:d} (offset: {1}, size: {2})".format(
+            self.index, sizeof_fmt(self.offset), sizeof_fmt(self.size))
+
+
+def _bdsync_segmented_run(source_filename, target_filename, connection, options, segment_size,
+                          resume=None, expected_size=None):
+    """ Run bdsync for separate segments of the source in parallel.
+        Every segment is exposed as a loop device on both sides (this requires root
+        privileges locally and remotely).  In two-phase mode the patches of all segments are
+        applied only after all of them were generated successfully.  The bandwidth limit is
+        shared by all segments.  The combined transfer statistics of all segments are returned.
+        The progress is recorded in a checkpoint (see "bdsync_manager.resume"), if given:
+        segments completed by an interrupted run are skipped (in two-phase mode their stored
+        patches are kept).
+    """
+    local_connection = get_connection(None)
+    apply_in_place = options.apply_in_place
+    compression = options.compression
+    source_size = get_file_size(source_filename)
+    target_state = connection.preflight(target_filename)
+    if not target_state["exists"]:
+        if not options.create_if_missing:
+            raise NotFoundError("The target does not exist (while 'create_target_if_missing' "
+                                "is disabled)")
+        log.warning("Creating missing target file: %s", target_filename)
+    if _get_target_size(target_state, target_filename) < source_size:
+        # all segments of the target need to exist
+        log.info("Extending target to the size of the source: %s", sizeof_fmt(source_size))
+        connection.check_output("truncate --size {0:d} {1}".format(
+            source_size, shlex.quote(target_filename)))
+    segments = [_Segment(index, offset, min(segment_size, source_size - offset))
+                for index, offset in enumerate(range(0, source_size, segment_size))]
+    completed = {}
+    if resume is not None:
+
+        def is_segment_valid(index, details):
+            if index >= len(segments):
+                return False
+            segment = segments[index]
+            if get_fingerprint(local_connection, source_filename, segment.offset,
+                               segment.size) != details["source"]:
+                return False
+            target_fingerprint = get_fingerprint(connection, target_filename, segment.offset,
+                                                 segment.size)
+            if apply_in_place or details.get("applied"):
+                # the target equals the source
+                return target_fingerprint == details["source"]
+            else:
+                # the stored patch applies only to the unchanged target
+                return ((target_fingerprint == details["target"])
+                        and (get_remote_file_size(connection, details["patch"])
+                             == details["patch_size"]))
+
+        completed = resume.start({"source": source_filename, "target": target_filename,
+                                  "source_size": source_size, "segment_size": segment_size,
+                                  "apply_in_place": apply_in_place,
+                                  "fingerprint": FINGERPRINT_METHOD}, is_segment_valid)
+        for index, details in completed.items():
+            segments[index].checkpointed = True
+            if details.get("patch"):
+                segments[index].patch = SyncPatch(details["patch"], connection)
+    bandwidth_limit = options.bandwidth_limit
+    if bandwidth_limit:
+        bandwidth_limit = max(1, bandwidth_limit // len(segments))
+    task_name = get_task_name()
+    abort_signal = get_abort_signal()
+    resource_control = get_resource_control()
+    statistics = []
+
+    def process_segment(segment, operation):
+        # log messages of segments are attributed to the task and the segment
+        set_task_name("{0}:{1:d}".format(task_name, segment.index))
+        set_abort_signal(abort_signal)
+        set_resource_control(resource_control)
+        try:
+            start_time = time.time()
+            with span(operation.__name__ + " segment", segment=segment.index):
+                operation(segment)
+            log.info("Segment processed in %s",
+                     datetime.timedelta(seconds=(time.time() - start_time)))
+        finally:
+            set_task_name(None)
+            set_abort_signal(None)
+            set_resource_control(None)
+
+    def run_parallel(operation):
+        jobs = options.segment_jobs or len(segments)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(process_segment, segment, operation)
+                       for segment in segments]
+        # raise the first error (after all operations are finished)
+        for future in futures:
+            future.result()
+
+    def generate(segment):
+        if segment.index in completed:
+            log.info("Skipping segment: it was completed by an interrupted run")
+            return
+        source = SyncSource(segment.source_device, options.local_bdsync, options.bdsync_args,
+                            options.block_size)
+        target = options.get_target(segment.target_device, connection)
+        receive_cmd = target.get_apply_patch_command(compression=compression)
+        if not apply_in_place:
+            patch_path = connection.preflight(segment.target_device,
+                                              options.target_patch_dir)["patch_path"]
+            segment.patch = SyncPatch(patch_path, connection)
+            receive_cmd = segment.patch.get_store_command()
+        # the expected size of the whole patch is distributed evenly among the segments
+        segment_expected_size = None if expected_size is None \
+            else expected_size * segment.size // source_size
+        relay = _run_patch_pipeline(source.get_generate_patch_command(target), receive_cmd,
+                                    bandwidth_limit, connection.host, compression,
+                                    expected_size=segment_expected_size)
+        statistics.append(relay.get_statistics())
+        if segment.patch is not None:
+            log.info("Patch Size: %s", sizeof_fmt(relay.bytes_transferred))
+        if resume is not None:
+            details = {"source": get_fingerprint(local_connection, segment.source_device, 0,
+                                                 segment.size)}
+            if segment.patch is not None:
+                details.update(target=get_fingerprint(connection, segment.target_device, 0,
+                                                      segment.size),
+                               patch=segment.patch.filename, patch_size=relay.bytes_transferred)
+            resume.add_segment(segment.index, details)
+            segment.checkpointed = True
+
+    def apply(segment):
+        if segment.patch is None:
+            log.info("Skipping segment: its patch was applied by an interrupted run")
+            return
+        target = options.get_target(segment.target_device, connection)
+        TracedCommand(target.get_apply_patch_command(segment.patch, compression))()
+        if resume is not None:
+            # the patch is not needed anymore for resuming
+            fingerprint = get_fingerprint(local_connection, segment.source_device, 0,
+                                          segment.size)
+            resume.add_segment(segment.index, {"source": fingerprint, "applied": True})
+            segment.patch.cleanup()
+            segment.patch = None
+
+    success = False
+    try:
+        for segment in segments:
+            segment.source_device = _attach_loop_device(
+                local_connection, source_filename, segment.offset, segment.size, read_only=True)
+            segment.target_device = _attach_loop_device(
+                connection, target_filename, segment.offset, segment.size)
+        log.info("Synchronizing %d segments of %s", len(segments), sizeof_fmt(segment_size))
+        start_time = time.time()
+        run_parallel(generate)
+        if apply_in_place:
+            log.info("Change Apply Time: %s",
+                     datetime.timedelta(seconds=(time.time() - start_time)))
+        else:
+            log.info("Patch Generate Time: %s",
+                     datetime.timedelta(seconds=(time.time() - start_time)))
+            # all patches were generated successfully: apply them
+            start_time = time.time()
+            run_parallel(apply)
+            apply_time = time.time() - start_time
+            log.info("Patch Apply Time: %s", datetime.timedelta(seconds=apply_time))
+        success = True
+    finally:
+        for segment in segments:
+            # the stored patches of checkpointed segments are kept for resuming
+            if (segment.patch is not None) and (success or not segment.checkpointed):
+                segment.patch.cleanup()
+            if segment.source_device:
+                _detach_loop_device(local_connection, segment.source_device)
+            if segment.target_device:
+                _detach_loop_device(connection, segment.target_device)
+    if resume is not None:
+        resume.remove()
+    if not statistics:
+        # all segments were completed by an interrupted run
+        statistics.append(StreamRelay(None).get_statistics())
+    result = {key: (max if key == "duration" else sum)(item[key] for item in statistics)
+              for key in statistics[0]}
+    if not apply_in_place:
+        result["apply_time"] = apply_time
+    return result
+
+
+def bdsync_run(source_filename, target_filename, connection, options, changed_ranges=None,
+               engine=None, resume=None, archive=None, dedup=None, expected_size=None):
+    """ Run bdsync with the given options (see "SyncOptions") in one or two phases.
+        With one phase changes are applied in-place.  With two phases the patch is stored on
+        the target host before applying it (and moved into the patch archive, if given).
+        The patch consists of the changed ranges of the source or it is generated by a native
+        engine, if given.  Large sources may be split into segments (see
+        "_bdsync_segmented_run").  A missing or empty target is seeded with the data of the
+        source.  The statistics of the transfer are returned (None: nothing was transferred).
+    """
+    apply_in_place = options.apply_in_place
+    compression = options.compression
+    if (options.segment_size or options.segment_count) and (changed_ranges is None) \
+            and (engine is None):
+        source_size = get_file_size(source_filename)
+        segment_size = _get_segment_size(source_size, options.segment_size,
+                                         options.segment_count)
+        if source_size % SECTOR_SIZE != 0:
+            log.warning("Skipping segmentation: the size of the source is not a multiple of "
+                        "%d bytes", SECTOR_SIZE)
+        elif segment_size < source_size:
+            return _bdsync_segmented_run(source_filename, target_filename, connection, options,
+                                         segment_size, resume, expected_size)
+    if resume is not None:
+        # the checkpoint refers to segments: it is useless for this run
+        resume.remove()
+    source = SyncSource(source_filename, options.local_bdsync, options.bdsync_args,
+                        options.block_size)
+    target = options.get_target(target_filename, connection, dedup)
+    # preparations: a single call retrieves the state of the target
+    with span("preflight"):
+        target_state = target.preflight(None if apply_in_place else options.target_patch_dir)
+    patch = None if apply_in_place else SyncPatch(target_state["patch_path"], connection)
+    if target_state["free"] is not None:
+        log.debug("Free space on target: %s", sizeof_fmt(target_state["free"]))
+    if not target_state["exists"]:
+        if options.create_if_missing:
             log.warning("Creating missing target file: %s", target.filename)
-            target.create_empty()
         else:
+            if patch is not None:
+                patch.cleanup()
             raise NotFoundError("The target does not exist (while 'create_target_if_missing' "
                                 "is disabled)")
-    generate_patch_cmd = source.get_generate_patch_command(target)
-    if bandwidth_limit:
-        generate_patch_cmd = generate_patch_cmd | get_command_from_tokens(
-            ["pv", "--rate-limit", str(bandwidth_limit), "--quiet"])
+    source_size = get_file_size(source_filename)
+    try:
+        target_size = _get_target_size(target_state, target_filename)
+    except TaskProcessingError:
+        if patch is not None:
+            patch.cleanup()
+        raise
+    seed_ranges = None
+    if target_size == 0:
+        # the target is missing or empty: it consists of zeros after its creation, thus only
+        # the data of the source needs to be sent
+        target.create_empty(source_size, options.preallocation)
+        seed_ranges = get_data_ranges(source_filename)
+        log.info("Seeding the new target with %s of data (source size: %s)",
+                 sizeof_fmt(sum(length for offset, length in seed_ranges)),
+                 sizeof_fmt(source_size))
+        engine = None
+    elif (changed_ranges is not None) and (target_size < source_size):
+        # only a complete copy of an earlier state of the source can be updated partially
+        log.warning("Ignoring changed block tracking due to a different size of the target")
+        changed_ranges = None
+    if seed_ranges is not None:
+        expected_size = sum(length for offset, length in seed_ranges)
+        generate_patch = functools.partial(write_range_patch, source_filename, target_filename,
+                                           seed_ranges, skip_zero_blocks=True)
+    elif engine is not None:
+        generate_patch = functools.partial(engine.write_patch, source_filename, target_filename,
+                                           ranges=changed_ranges)
+    elif changed_ranges is None:
+        generate_patch = source.get_generate_patch_command(target)
+    else:
+        expected_size = sum(length for offset, length
+                            in get_merged_ranges(changed_ranges, source_size))
+        generate_patch = functools.partial(write_range_patch, source_filename, target_filename,
+                                           changed_ranges)
+
     if apply_in_place:
         start_time = time.time()
-        operation = generate_patch_cmd | target.get_apply_patch_command()
-        log.debug("Applying changes in-place: %s", operation)
-        operation()
+        log.debug("Applying changes in-place")
+        if engine is not None:
+            with span("synchronize locally"):
+                engine.sync(source_filename, target_filename, ranges=changed_ranges)
+            statistics = None
+        else:
+            relay = _run_patch_pipeline(generate_patch, target.get_apply_patch_command(
+                compression=compression), options.bandwidth_limit, connection.host, compression,
+                dedup, expected_size)
+            statistics = relay.get_statistics()
         change_apply_time = datetime.timedelta(seconds=(time.time() - start_time))
         log.info("Change Apply Time: %s", change_apply_time)
     else:
-        patch = SyncPatch(target_patch_dir, connection_command)
         # generate and store the patch
         start_time = time.time()
-        generate_patch_command = generate_patch_cmd | patch.get_store_command()
-        log.debug("Generating Patch: %s", generate_patch_command)
-        generate_patch_command()
+        log.debug("Generating Patch")
+        relay = _run_patch_pipeline(generate_patch, patch.get_store_command(),
+                                    options.bandwidth_limit, connection.host, compression, dedup,
+                                    expected_size)
+        statistics = relay.get_statistics()
         patch_generate_time = datetime.timedelta(seconds=(time.time() - start_time))
         log.info("Patch Generate Time: %s", patch_generate_time)
-        log.info("Patch Size: %s", sizeof_fmt(patch.get_size()))
+        log.info("Patch Size: %s", sizeof_fmt(relay.bytes_transferred))
+        if archive is not None:
+            # the base of a new archive is the target before applying the first patch
+            archive.prepare(target.filename, start_time)
         # apply the new patch
+        archive_time = start_time
         start_time = time.time()
-        apply_patch_command = target.get_apply_patch_command(patch)
-        apply_patch_command()
-        patch_apply_time = datetime.timedelta(seconds=(time.time() - start_time))
-        log.info("Patch Apply Time: %s", patch_apply_time)
-        patch.cleanup()
+        apply_patch_command = target.get_apply_patch_command(patch, compression)
+        TracedCommand(apply_patch_command)()
+        statistics["apply_time"] = time.time() - start_time
+        log.info("Patch Apply Time: %s", datetime.timedelta(seconds=statistics["apply_time"]))
+        if archive is None:
+            patch.cleanup()
+        else:
+            archive.add_patch(patch.filename, compression[0] if compression else None,
+                              archive_time)
+    return statistics
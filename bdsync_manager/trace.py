@@ -0,0 +1,185 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+from bdsync_manager.utils import get_task_name, log
+
+
+# the categories of spans
+CATEGORY_PHASE = "phase"
+CATEGORY_COMMAND = "command"
+
+_tracer = None
+
+
+class Tracer:
+    """ collect nested spans of all threads and store them in the Chrome trace event format
+
+        The resulting file can be inspected via "chrome://tracing" or "ui.perfetto.dev".  Every
+        span is stored as a "complete" event (start and duration).  The threads are labeled with
+        the name of the task processed by them.
+        The Python code may be profiled (cProfile) in addition.  The statistics of all threads
+        are merged into a single file (see "pstats").  Either of both files may be omitted.
+    """
+
+    def __init__(self, filename, profile_filename=None):
+        self.filename = filename
+        self.profile_filename = profile_filename
+        self._events = []
+        self._thread_names = {}
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._start_time = time.perf_counter()
+
+    def start(self):
+        if self.profile_filename:
+            self._add_profile()
+            threading.setprofile(self._start_thread_profile)
+
+    def _start_thread_profile(self, frame, event, arg):
+        sys.setprofile(None)
+        self._add_profile()
+
+    def _add_profile(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # the profile of the main thread covers all threads (Python 3.12 and later)
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def get_timestamp(self):
+        """ return the number of microseconds since the start of the tracer """
+        return (time.perf_counter() - self._start_time) * 1000000
+
+    def add_span(self, name, category, start, end, details):
+        thread_id = threading.get_ident()
+        event = {"name": name, "cat": category, "ph": "X", "ts": start, "dur": end - start,
+                 "pid": self._pid, "tid": thread_id, "args": details}
+        with self._lock:
+            self._events.append(event)
+            self._thread_names[thread_id] = get_task_name() or threading.current_thread().name
+
+    def stop(self):
+        """ store the collected spans (and the profile) """
+        with self._lock:
+            events = list(self._events)
+            events.extend({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": thread_id,
+                           "args": {"name": name}}
+                          for thread_id, name in self._thread_names.items())
+        if self.filename:
+            with open(self.filename, "w") as trace_file:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+            log.info("Stored trace (%d spans): %s", len(self._events), self.filename)
+        if self.profile_filename:
+            threading.setprofile(None)
+            if self._profiles:
+                # the profile of the current thread needs to be disabled first
+                self._profiles[0].disable()
+                stats = pstats.Stats(self._profiles[0])
+                for profile in self._profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(self.profile_filename)
+                log.info("Stored profile: %s", self.profile_filename)
+
+
+def start_tracing(filename, profile_filename=None):
+    """ record spans (see "span") until "stop_tracing" is called """
+    global _tracer
+    _tracer = Tracer(filename, profile_filename)
+    _tracer.start()
+
+
+def stop_tracing():
+    global _tracer
+    if _tracer is not None:
+        tracer, _tracer = _tracer, None
+        tracer.stop()
+
+
+@contextlib.contextmanager
+def span(name, category=CATEGORY_PHASE, **details):
+    """ record the duration of a block (if tracing is enabled)
+
+        The dictionary of details is provided to the block: further details (e.g. the number of
+        transferred bytes) may be added until the block is finished.  A raised exception is
+        recorded as an error.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield details
+        return
+    start = tracer.get_timestamp()
+    try:
+        yield details
+    except BaseException as exc:
+        details["error"] = str(exc) or type(exc).__name__
+        raise
+    finally:
+        tracer.add_span(name, category, start, tracer.get_timestamp(), details)
+
+
+class TracedCommand:
+    """ a plumbum command recording a span for every execution (see "span")
+
+        The span contains the process ID and the exit status of the command.
+    """
+
+    def __init__(self, command):
+        self.command = command
+
+    def __getitem__(self, args):
+        return TracedCommand(self.command[args])
+
+    def __str__(self):
+        return str(self.command)
+
+    def __call__(self, *args):
+        return (self[args] if args else self).run()[1]
+
+    def run(self, retcode=0):
+        """ execute the command and return its exit code, stdout and stderr """
+        if _tracer is None:
+            return self.command.run(retcode=retcode)
+        tokens = str(self.command).split()
+        # e.g. "lvm lvcreate"
+        name = " ".join([os.path.basename(tokens[0])] + tokens[1:2])
+        from plumbum.commands.processes import ProcessExecutionError, run_proc
+        with span(name, CATEGORY_COMMAND, command=str(self.command)) as details:
+            process = self.command.popen()
+            details["pid"] = process.pid
+            try:
+                result = run_proc(process, retcode)
+            except ProcessExecutionError as exc:
+                details["exit_status"] = exc.retcode
+                raise
+            details["exit_status"] = result[0]
+            return result
@@ -18,19 +18,49 @@
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import importlib.util
+import json
 import logging
+import os
 import re
+import shlex
+import threading
 
-try:
-    import plumbum
-except ImportError:
-    # ignore errors: we want to able to run "verify_requirements" in any case
-    pass
-
-from bdsync_manager import RequirementsError
+from bdsync_manager import RequirementsError, TaskProcessingError
 
 
 BANDWITH_REGEX = re.compile(r"^(?P<count>[0-9]+)(?P<unit>[bkmg])?$")
+SIZE_REGEX = re.compile(r"^(?P<count>[0-9]+)(?P<unit>[bkmgt])?$")
+SIZE_UNIT_FACTORS = {None: 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+DURATION_REGEX = re.compile(r"^(?P<count>[0-9]+)(?P<unit>[smhd])?$")
+DURATION_UNIT_FACTORS = {None: 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+# ssh options expecting an argument (see "man ssh")
+SSH_OPTIONS_WITH_ARGUMENT = set("BbcDEeFIiJLlmOopQRSWw")
+
+# the name of the task processed by the current thread (used for log messages)
+_task_context = threading.local()
+
+
+class _TaskLogFormatter(logging.Formatter):
+    """ use a separate format for messages emitted while a thread is processing a task """
+
+    def __init__(self, fmt, task_fmt):
+        super().__init__(fmt)
+        self._task_formatter = logging.Formatter(task_fmt)
+
+    def format(self, record):
+        if getattr(record, "task_name", None):
+            return self._task_formatter.format(record)
+        else:
+            return super().format(record)
+
+
+class _TaskNameFilter(logging.Filter):
+    """ attach the name of the current thread's task to every log record """
+
+    def filter(self, record):
+        record.task_name = get_task_name()
+        return True
 
 
 def _get_logger():
@@ -40,27 +70,145 @@ def _get_logger():
     except NameError:
         new_logger = logging.getLogger("bdsync-manager")
         new_logger.addHandler(logging.StreamHandler())
+        new_logger.addFilter(_TaskNameFilter())
         set_log_format(logger=new_logger)
         return new_logger
 
 
-def set_log_format(fmt=None, logger=None):
-    """ change the logging format (prefix) """
+def set_log_format(fmt=None, logger=None, task_fmt=None):
+    """ change the logging format (prefix)
+
+        The format "task_fmt" is used for messages emitted while processing a task.
+    """
     if fmt is None:
         fmt = "[bdsync-manager] %(asctime)s - %(message)s"
+    if task_fmt is None:
+        task_fmt = "[Task %(task_name)s] %(levelname)s: %(message)s"
     if logger is None:
         logger = _get_logger()
-    logger.handlers[-1].setFormatter(logging.Formatter(fmt))
+    logger.handlers[-1].setFormatter(_TaskLogFormatter(fmt, task_fmt))
+
+
+def set_task_name(name):
+    """ announce the name of the task processed by the current thread (or None) """
+    _task_context.name = name
+
+
+def get_task_name():
+    return getattr(_task_context, "name", None)
+
+
+class AbortSignal:
+    """ a request for aborting a task issued by another thread (e.g. a monitor)
+
+        The threads processing the task check the signal regularly (see "check_abort").
+    """
+
+    def __init__(self):
+        self.reason = None
+
+    def request(self, reason):
+        self.reason = reason
+
+    def check(self):
+        if self.reason is not None:
+            raise TaskProcessingError(self.reason)
+
+
+def set_abort_signal(signal):
+    """ announce the abort signal of the task processed by the current thread (or None) """
+    _task_context.abort_signal = signal
+
+
+def get_abort_signal():
+    return getattr(_task_context, "abort_signal", None)
+
+
+def set_resource_control(control):
+    """ announce the resource limits of the task processed by the current thread (or None)
+
+        See "bdsync_manager.resources.ResourceControl".
+    """
+    _task_context.resource_control = control
+
+
+def get_resource_control():
+    return getattr(_task_context, "resource_control", None)
 
 
-def get_tempfile(directory, connection_tokens):
-    """ create a temporary file on a remote host """
-    mktemp_cmd = get_command_from_tokens(["mktemp", "--tmpdir={0}".format(directory),
-                                          "patch-XXXXXX.bdsync"])
-    if connection_tokens:
-        mktemp_cmd = get_command_from_tokens(connection_tokens + [mktemp_cmd])
-    # remove linebreaks from result
-    return mktemp_cmd().rstrip("\n\r")
+def wrap_command_tokens(tokens):
+    """ apply the resource limits of the current thread's task to a command line """
+    control = get_resource_control()
+    return list(tokens) if control is None else control.wrap_tokens(tokens)
+
+
+def check_abort():
+    """ raise a TaskProcessingError if the task of the current thread should be aborted """
+    signal = get_abort_signal()
+    if signal is not None:
+        signal.check()
+
+
+def get_connection_host(connection_command):
+    """ guess the name of the remote host reached via a connection command
+
+        The destination of "ssh" commands is parsed (ignoring the user name).  Other commands are
+        returned as they are.  An empty command denotes the local host (None).
+    """
+    if not connection_command:
+        return None
+    tokens = shlex.split(connection_command)
+    if os.path.basename(tokens[0]) == "ssh":
+        args = iter(tokens[1:])
+        for arg in args:
+            if arg.startswith("-") and (len(arg) > 1):
+                if (len(arg) == 2) and (arg[1] in SSH_OPTIONS_WITH_ARGUMENT):
+                    # skip the argument of this option
+                    next(args, None)
+            else:
+                return arg.split("@")[-1]
+    return connection_command
+
+
+def get_file_size(filename):
+    """ determine the size of a file or a blockdevice """
+    with open(filename, "rb") as source:
+        return source.seek(0, os.SEEK_END)
+
+
+def _get_state_filename(state_dir, task_name, kind):
+    safe_name = re.sub(r"[^\w.-]", "_", task_name)
+    return os.path.join(state_dir, kind, safe_name + ".json")
+
+
+def load_state(state_dir, task_name, kind):
+    """ read the stored state (a dictionary) of a task
+
+        None is returned if the state is missing or unreadable.
+    """
+    filename = _get_state_filename(state_dir, task_name, kind)
+    try:
+        with open(filename, "r") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(state_dir, task_name, kind, state):
+    """ store the state (a dictionary) of a task atomically """
+    filename = _get_state_filename(state_dir, task_name, kind)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_filename = filename + ".new"
+    with open(temp_filename, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_filename, filename)
+
+
+def remove_state(state_dir, task_name, kind):
+    try:
+        os.unlink(_get_state_filename(state_dir, task_name, kind))
+    except FileNotFoundError:
+        pass
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -77,14 +225,14 @@ def verify_requirements():
     """ check if all requirements are available
         @raises RequirementsError
     """
-    try:
-        import plumbum  # noqa F401
-    except ImportError:
+    # the module is imported only when it is used (it is slow to import)
+    if importlib.util.find_spec("plumbum") is None:
         raise RequirementsError("Failed to import the required python module 'plumbum'")
 
 
 def get_command_from_tokens(tokens):
     """ turn a list of command + arguments into a plumbum command """
+    import plumbum
     return plumbum.local[tokens[0]][tuple(tokens[1:])]
 
 
@@ -92,8 +240,7 @@ def parse_bandwidth_limit(text):
     match = BANDWITH_REGEX.match(text.lower())
     if match:
         data = match.groupdict()
-        unit_factor = {None: 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}[data["unit"]]
-        byte_count = int(data["count"]) * unit_factor
+        byte_count = int(data["count"]) * SIZE_UNIT_FACTORS[data["unit"]]
         if byte_count == 0:
             raise ValueError("the limit must be positive (non-zero)")
         else:
@@ -102,4 +249,30 @@ def parse_bandwidth_limit(text):
         raise ValueError("failed to parse bandwidth limit (expected something like '42m')")
 
 
+def parse_size(text):
+    """ parse a size with an optional binary unit suffix (e.g. "200g") """
+    match = SIZE_REGEX.match(text.lower())
+    if match:
+        data = match.groupdict()
+        byte_count = int(data["count"]) * SIZE_UNIT_FACTORS[data["unit"]]
+        if byte_count == 0:
+            raise ValueError("the size must be positive (non-zero)")
+        else:
+            return byte_count
+    else:
+        raise ValueError("failed to parse size (expected something like '200g')")
+
+
+def parse_duration(text):
+    """ parse a duration (seconds) with an optional unit suffix (e.g. "30m" or "1d") """
+    match = DURATION_REGEX.match(text.strip().lower())
+    if match:
+        seconds = int(match.group("count")) * DURATION_UNIT_FACTORS[match.group("unit")]
+        if seconds == 0:
+            raise ValueError("the duration must be positive (non-zero)")
+        return seconds
+    else:
+        raise ValueError("failed to parse duration (expected something like '30m')")
+
+
 log = _get_logger()
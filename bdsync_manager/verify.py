@@ -0,0 +1,135 @@
+"""
+    bdsync-manager: maintain synchronization tasks for remotely or locally
+    synchronized blockdevices via bdsync
+
+    Copyright (C) 2015-2016 Lars Kruse <devel@sumpfralle.de>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+
+from plumbum import ProcessExecutionError
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.connection import get_agent_command, get_connection
+from bdsync_manager.patch import get_merged_ranges
+from bdsync_manager.task import get_source_snapshot, get_source_volume, release_source_snapshot
+from bdsync_manager.utils import log, sizeof_fmt
+
+
+# number of mismatching ranges listed in the log
+MAX_REPORTED_RANGES = 10
+
+
+def verify_target(source_filename, target_filename, connection, block_size, threads=0,
+                  manifest_filename=None, full=False, remote_python="python3", sample=None):
+    """ compare a source with its (remote) target block by block
+
+        Both sides are hashed at the same time in parallel threads by the agent (see
+        "bdsync_manager.agent").  The digests of the source are streamed to the agent on the
+        target host, which reports mismatching blocks.  The digests of the target are stored
+        in a manifest next to the target: unchanged blocks of the source are not read on the
+        target host again (unless "full" is enabled).
+        Only a sample of the blocks is compared, if "sample" (the number of blocks per region
+        and the step between regions, see "bdsync_manager.agent.get_block_indexes") is given.
+        A dictionary with the sizes, the number of compared, hashed and reused blocks and the
+        list of mismatching ranges (offset and length) is returned.
+    """
+    sample_args = list(sample or ())
+    local_connection = get_connection(None)
+    hash_cmd = get_agent_command(local_connection, sys.executable,
+                                 ["hash", source_filename, block_size, threads] + sample_args)
+    verify_cmd = get_agent_command(
+        connection, remote_python if connection.is_remote else sys.executable,
+        ["verify", target_filename, block_size, threads, manifest_filename or "",
+         "1" if full else "0"] + sample_args)
+    log.debug("Verifying target %s against source %s (block size: %s)",
+              target_filename, source_filename, sizeof_fmt(block_size))
+    try:
+        output = (hash_cmd | verify_cmd)()
+    except ProcessExecutionError as exc:
+        raise TaskProcessingError("Failed to verify the target: {0}".format(exc))
+    mismatches = []
+    result = None
+    for line in output.splitlines():
+        if line.startswith("mismatch "):
+            index = int(line.split()[1])
+            mismatches.append((index * block_size, block_size))
+        elif line.startswith("summary "):
+            result = {key: int(value) for key, value in
+                      (item.split("=", 1) for item in line.split()[1:])}
+    if result is None:
+        raise TaskProcessingError("Failed to verify the target: missing summary")
+    result["mismatching_ranges"] = get_merged_ranges(mismatches, result["size"])
+    return result
+
+
+class TaskVerification:
+    """ verify the target of a task (see "verify_target")
+
+        An LVM snapshot of the source is used, if it is configured for the task.  A
+        TaskProcessingError is raised if the target differs from the source.
+    """
+
+    def __init__(self, settings, full=False):
+        self.settings = dict(settings)
+        self._full = full
+
+    def _get_manifest_filename(self):
+        manifest = self.settings["verify_manifest"]
+        if manifest is None:
+            # blockdevices: the directory of the target is not suitable for the manifest
+            target = self.settings["target_path"]
+            return None if target.startswith("/dev/") else target + ".manifest"
+        return manifest or None
+
+    def run(self):
+        if self.settings["disabled"]:
+            log.info("Skipping disabled task")
+            return
+        connection = get_connection(self.settings["connection_command"],
+                                    self.settings["connection_multiplexing"])
+        source = self.settings["source_path"]
+        lvm_volume = get_source_volume(self.settings)
+        if lvm_volume is not None:
+            source = get_source_snapshot(self.settings, lvm_volume)
+        try:
+            start_time = time.time()
+            result = verify_target(source, self.settings["target_path"], connection,
+                                   self.settings["verify_block_size"],
+                                   self.settings["verify_threads"],
+                                   self._get_manifest_filename(), self._full,
+                                   self.settings["remote_python_bin"])
+        finally:
+            if lvm_volume is not None:
+                release_source_snapshot(self.settings, lvm_volume)
+        log.info("Verified %s in %.1fs (blocks read on the target: %d, reused from the "
+                 "manifest: %d)", sizeof_fmt(result["size"]), time.time() - start_time,
+                 result["hashed"], result["reused"])
+        errors = []
+        if result["size"] != result["source_size"]:
+            errors.append("the size of the target ({0}) differs from the source ({1})".format(
+                result["size"], result["source_size"]))
+        if result["mismatching_ranges"]:
+            ranges = result["mismatching_ranges"]
+            errors.append("{0} differing ranges ({1}): {2}{3}".format(
+                len(ranges), sizeof_fmt(sum(length for offset, length in ranges)),
+                ", ".join("{0:d}+{1:d}".format(offset, length)
+                          for offset, length in ranges[:MAX_REPORTED_RANGES]),
+                ", ..." if len(ranges) > MAX_REPORTED_RANGES else ""))
+        if errors:
+            raise TaskProcessingError("Verification failed: {0}".format("; ".join(errors)))
+        log.info("Verification succeeded")
@@ -0,0 +1,170 @@
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from bdsync_manager.agent import run_apply, run_inspect
+from bdsync_manager.patch import PatchWriter, get_data_ranges
+
+
+def write_patch(filename, size, blocks):
+    with open(filename, "wb") as stream:
+        writer = PatchWriter(stream, "target", size)
+        for offset, data in blocks:
+            writer.write_block(offset, data)
+        writer.finish()
+
+
+def parse_summary(output):
+    fields = output.split()
+    assert fields[0] == "summary"
+    return {key: int(value) for key, value in (field.split("=") for field in fields[1:])}
+
+
+class AgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.patch = os.path.join(directory.name, "patch")
+        self.target = os.path.join(directory.name, "target")
+
+    def _create_target(self, data):
+        with open(self.target, "wb") as target_file:
+            target_file.write(data)
+
+    def _read_target(self):
+        with open(self.target, "rb") as target_file:
+            return target_file.read()
+
+    def _apply(self, decompress_tokens=None, diffsize="strict"):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_apply(self.patch, decompress_tokens, self.target, diffsize)
+        return parse_summary(output.getvalue())
+
+
+class ApplyTest(AgentTestCase):
+
+    def test_ascending_blocks_are_coalesced(self):
+        self._create_target(bytes(4 * 4096))
+        write_patch(self.patch, 4 * 4096, [(0, b"a" * 4096), (4096, b"b" * 4096),
+                                           (3 * 4096, b"c" * 4096)])
+        summary = self._apply()
+        self.assertEqual(self._read_target(),
+                         b"a" * 4096 + b"b" * 4096 + bytes(4096) + b"c" * 4096)
+        self.assertEqual((summary["writes"], summary["bytes"], summary["sorted"]),
+                         (2, 3 * 4096, 0))
+
+    def test_non_ascending_blocks_are_sorted(self):
+        # e.g. merged patches: the later block at the same offset wins
+        self._create_target(bytes(3 * 4096))
+        write_patch(self.patch, 3 * 4096, [(2 * 4096, b"c" * 4096), (0, b"x" * 4096),
+                                           (4096, b"b" * 4096), (0, b"a" * 4096)])
+        summary = self._apply()
+        self.assertEqual(self._read_target(), b"a" * 4096 + b"b" * 4096 + b"c" * 4096)
+        self.assertEqual(summary["sorted"], 1)
+        # the overwritten block and the adjacent blocks
+        self.assertEqual(summary["writes"], 2)
+
+    def test_non_ascending_blocks_are_streamed(self):
+        # a decompressed patch cannot be indexed: the blocks are applied in their order
+        self._create_target(bytes(3 * 4096))
+        write_patch(self.patch, 3 * 4096, [(2 * 4096, b"c" * 4096), (0, b"x" * 4096),
+                                           (4096, b"b" * 4096), (0, b"a" * 4096)])
+        summary = self._apply(decompress_tokens=["cat"])
+        self.assertEqual(self._read_target(), b"a" * 4096 + b"b" * 4096 + b"c" * 4096)
+        self.assertEqual(summary["sorted"], 0)
+
+    @unittest.skipUnless(shutil.which("gzip"), "gzip is missing")
+    def test_compressed_patch_is_detected(self):
+        self._create_target(bytes(2 * 4096))
+        write_patch(self.patch, 2 * 4096, [(4096, b"b" * 4096)])
+        with open(self.patch, "rb") as patch_file:
+            content = gzip.compress(patch_file.read())
+        with open(self.patch, "wb") as patch_file:
+            patch_file.write(content)
+        self._apply()
+        self.assertEqual(self._read_target(), bytes(4096) + b"b" * 4096)
+
+    def test_zero_blocks_are_punched(self):
+        self._create_target(os.urandom(4 * 4096))
+        write_patch(self.patch, 4 * 4096, [(4096, bytes(4096)), (2 * 4096, bytes(4096))])
+        before = self._read_target()
+        summary = self._apply()
+        self.assertEqual(self._read_target(), before[:4096] + bytes(2 * 4096) + before[-4096:])
+        if summary["holes"] == 0:
+            self.skipTest("punching holes is not supported by the filesystem")
+        self.assertEqual((summary["holes"], summary["bytes"]), (2 * 4096, 0))
+        for offset, length in get_data_ranges(self.target):
+            self.assertFalse((offset < 3 * 4096) and (offset + length > 4096))
+
+
+class ApplySizeTest(AgentTestCase):
+    """ the size of the target is handled like "bdsync --patch --diffsize=..." does
+
+        strict: the sizes must match, resize: the target gets the size of the patch, minsize:
+        a smaller target is extended, a larger target is kept.
+    """
+
+    def _apply_to_size(self, target_size, diffsize):
+        self._create_target(b"t" * target_size)
+        write_patch(self.patch, 8192, [(0, b"p" * 4096)])
+        self._apply(diffsize=diffsize)
+        return self._read_target()
+
+    def test_equal_size(self):
+        for diffsize in ("strict", "resize", "minsize"):
+            self.assertEqual(self._apply_to_size(8192, diffsize), b"p" * 4096 + b"t" * 4096)
+
+    def test_strict(self):
+        for target_size in (4096, 12288):
+            with self.assertRaises(ValueError):
+                self._apply_to_size(target_size, "strict")
+            # the target is left untouched
+            self.assertEqual(self._read_target(), b"t" * target_size)
+
+    def test_resize(self):
+        self.assertEqual(self._apply_to_size(12288, "resize"), b"p" * 4096 + b"t" * 4096)
+        self.assertEqual(self._apply_to_size(2048, "resize"), b"p" * 4096 + bytes(4096))
+
+    def test_minsize(self):
+        self.assertEqual(self._apply_to_size(12288, "minsize"), b"p" * 4096 + b"t" * 8192)
+        self.assertEqual(self._apply_to_size(2048, "minsize"), b"p" * 4096 + bytes(4096))
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            self._apply_to_size(8192, "shrink")
+
+
+class InspectTest(AgentTestCase):
+
+    def _inspect(self, buckets):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_inspect(self.patch, None, buckets)
+        return json.loads(output.getvalue())
+
+    def test_statistics(self):
+        write_patch(self.patch, 8 * 4096, [(4 * 4096, b"b" * 4096), (5 * 4096, b"c" * 100),
+                                           (0, b"a" * 4096)])
+        result = self._inspect(4)
+        self.assertEqual((result["device"], result["size"], result["blocks"], result["bytes"]),
+                         ("target", 8 * 4096, 3, 2 * 4096 + 100))
+        self.assertFalse(result["ascending"])
+        self.assertEqual(result["largest_block"], 4096)
+        self.assertEqual(result["bucket_size"], 2 * 4096)
+        self.assertEqual(result["histogram"], [4096, 0, 4096 + 100, 0])
+        self.assertEqual(result["regions"], 2)
+        self.assertEqual(result["region_list"], [[4 * 4096, 4096 + 100], [0, 4096]])
+
+    def test_empty_patch(self):
+        write_patch(self.patch, 0, [])
+        result = self._inspect(4)
+        self.assertEqual((result["blocks"], result["regions"], result["ascending"]),
+                         (0, 0, True))
+        self.assertEqual(result["histogram"], [0, 0, 0, 0])
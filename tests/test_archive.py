@@ -0,0 +1,240 @@
+import contextlib
+import gzip
+import hashlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.agent import RangeSet, run_apply, run_merge
+from bdsync_manager.archive import PatchArchive
+from bdsync_manager.connection import Connection
+from bdsync_manager.patch import PatchWriter
+
+
+SIZE = 16 * 4096
+
+
+def get_patch_content(size, blocks):
+    stream = io.BytesIO()
+    writer = PatchWriter(stream, "target", size)
+    for offset, data in blocks:
+        writer.write_block(offset, data)
+    writer.finish()
+    return stream.getvalue()
+
+
+def get_checksum(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def get_random_blocks(generator, count, size=SIZE):
+    """ return blocks of random positions and lengths in random order
+
+        The blocks of a patch do not overlap (like the blocks written by bdsync), but the
+        blocks of different patches do.
+    """
+    bounds = sorted(generator.sample(range(size + 1), 2 * count))
+    blocks = [(start, bytes(generator.getrandbits(8) for _ in range(end - start)))
+              for start, end in zip(bounds[::2], bounds[1::2])]
+    generator.shuffle(blocks)
+    return blocks
+
+
+def run_agent(function, *args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        function(*args)
+    return dict(item.split("=", 1) for item in output.getvalue().split()[1:])
+
+
+class RangeSetTest(unittest.TestCase):
+
+    def test_add(self):
+        ranges = RangeSet()
+        self.assertEqual(ranges.add(10, 20), [(10, 20)])
+        self.assertEqual(ranges.add(30, 40), [(30, 40)])
+        self.assertEqual(ranges.add(12, 18), [])
+        self.assertEqual(ranges.add(5, 45), [(5, 10), (20, 30), (40, 45)])
+        self.assertEqual(ranges.add(0, 50), [(0, 5), (45, 50)])
+
+    def test_adjacent_ranges(self):
+        ranges = RangeSet()
+        self.assertEqual(ranges.add(0, 10), [(0, 10)])
+        self.assertEqual(ranges.add(10, 20), [(10, 20)])
+        self.assertEqual(ranges.add(0, 20), [])
+        self.assertEqual(ranges.add(15, 25), [(20, 25)])
+
+
+class MergeTest(unittest.TestCase):
+    """ a merged chain of patches writes the same data as applying all patches in order """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.generator = random.Random(42)
+        self.base = bytes(self.generator.getrandbits(8) for _ in range(SIZE))
+
+    def _write_chain(self, sizes):
+        """ store a chain of patches (with overlapping blocks) and return its description """
+        chain = []
+        for index, size in enumerate(sizes):
+            blocks = get_random_blocks(self.generator, 8, size)
+            filename = os.path.join(self.directory, "patch{0:d}".format(index))
+            content = get_patch_content(size, blocks)
+            with open(filename, "wb") as patch_file:
+                patch_file.write(content)
+            chain.append({"filename": filename, "decompress": None,
+                          "checksum": get_checksum(content)})
+        return chain
+
+    def _write_target(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "wb") as target_file:
+            target_file.write(content)
+        return filename
+
+    def _apply_in_order(self, chain):
+        filename = self._write_target("expected", self.base)
+        for patch in chain:
+            run_agent(run_apply, patch["filename"], None, filename, "resize")
+        with open(filename, "rb") as target_file:
+            return target_file.read()
+
+    def test_merged_patch(self):
+        chain = self._write_chain([SIZE] * 4)
+        merged = os.path.join(self.directory, "merged")
+        result = run_agent(run_merge, chain, merged, False)
+        self.assertEqual(int(result["size"]), os.path.getsize(merged))
+        self.assertFalse(os.path.exists(merged + ".new"))
+        with open(merged, "rb") as merged_file:
+            self.assertEqual(result["checksum"], get_checksum(merged_file.read()))
+        # every byte is written only once
+        self.assertLessEqual(int(result["bytes"]), SIZE)
+        target = self._write_target("target", self.base)
+        run_agent(run_apply, merged, None, target, "strict")
+        with open(target, "rb") as target_file:
+            self.assertEqual(target_file.read(), self._apply_in_order(chain))
+
+    def test_merge_apply(self):
+        chain = self._write_chain([SIZE] * 4)
+        target = self._write_target("target", self.base)
+        run_agent(run_merge, chain, target, True)
+        with open(target, "rb") as target_file:
+            self.assertEqual(target_file.read(), self._apply_in_order(chain))
+
+    def test_merge_apply_truncates_files(self):
+        # the newest patch determines the size of the result
+        chain = self._write_chain([SIZE, SIZE // 2])
+        target = self._write_target("target", self.base)
+        run_agent(run_merge, chain, target, True)
+        with open(target, "rb") as target_file:
+            result = target_file.read()
+        self.assertEqual(len(result), SIZE // 2)
+        self.assertEqual(result, self._apply_in_order(chain))
+
+    def test_checksum_mismatch(self):
+        chain = self._write_chain([SIZE] * 2)
+        chain[0]["checksum"] = "0" * 64
+        merged = os.path.join(self.directory, "merged")
+        with self.assertRaises(ValueError):
+            run_agent(run_merge, chain, merged, False)
+        self.assertFalse(os.path.exists(merged))
+        self.assertFalse(os.path.exists(merged + ".new"))
+
+
+class PatchArchiveTest(unittest.TestCase):
+    """ a local shell ("sh -c") stands in for the connection to the target host """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.connection = Connection("sh -c")
+        self.addCleanup(self.connection.close)
+        self.archive = PatchArchive(os.path.join(self.directory, "archive"), self.connection,
+                                    sys.executable)
+        self.target = os.path.join(self.directory, "target")
+        generator = random.Random(23)
+        with open(self.target, "wb") as target_file:
+            target_file.write(bytes(generator.getrandbits(8) for _ in range(SIZE)))
+        # the states of the target after every synchronization (by time)
+        self.states = {}
+        self.archive.prepare(self.target, 1000)
+        self.states[1000] = self._read(self.target)
+        for index in range(1, 5):
+            codec = "zlib" if (index % 2) and shutil.which("gzip") else None
+            self._synchronize(1000 + index, get_random_blocks(generator, 6), codec)
+
+    def _read(self, filename):
+        with open(filename, "rb") as input_file:
+            return input_file.read()
+
+    def _synchronize(self, timestamp, blocks, codec=None):
+        """ apply a patch to the target and archive it (like a two-phase run) """
+        content = get_patch_content(SIZE, blocks)
+        patch = os.path.join(self.directory, "patch")
+        with open(patch, "wb") as patch_file:
+            patch_file.write(gzip.compress(content) if codec else content)
+        run_agent(run_apply, patch, None, self.target, "strict")
+        self.archive.add_patch(patch, codec, timestamp)
+        self.states[timestamp] = self._read(self.target)
+
+    def _check_restore(self, timestamp, expected_time):
+        output = os.path.join(self.directory, "restored")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(output)
+        self.assertEqual(self.archive.restore(timestamp, output), expected_time)
+        self.assertEqual(self._read(output), self.states[expected_time])
+
+    def test_entries(self):
+        entries = self.archive.get_entries()
+        self.assertEqual([entry["time"] for entry in entries], sorted(self.states))
+        self.assertEqual([entry["base"] for entry in entries], [True] + [False] * 4)
+
+    def test_restore(self):
+        for timestamp in sorted(self.states):
+            self._check_restore(timestamp, timestamp)
+        # the latest state before the given time
+        self._check_restore(1002.5, 1002)
+
+    def test_restore_into_larger_file(self):
+        output = os.path.join(self.directory, "restored")
+        with open(output, "wb") as output_file:
+            output_file.write(b"x" * (2 * SIZE))
+        self.archive.restore(1003, output)
+        self.assertEqual(self._read(output), self.states[1003])
+
+    def test_compact(self):
+        self.assertEqual(self.archive.compact(1002), 3)
+        entries = self.archive.get_entries()
+        self.assertEqual([entry["time"] for entry in entries], [1002, 1003, 1004])
+        self.assertTrue(entries[0]["base"])
+        self.assertEqual(sorted(os.listdir(self.archive.directory)),
+                         sorted([entry["filename"] for entry in entries] + ["index.json"]))
+        for timestamp in (1002, 1003, 1004):
+            self._check_restore(timestamp, timestamp)
+        with self.assertRaises(TaskProcessingError):
+            self.archive.restore(1001, os.path.join(self.directory, "restored"))
+        # nothing left to be merged
+        self.assertEqual(self.archive.compact(1002), 0)
+
+    def test_corrupt_patch(self):
+        entry = self.archive.get_entries()[2]
+        self.assertIsNone(entry["codec"])
+        path = os.path.join(self.archive.directory, entry["filename"])
+        content = bytearray(self._read(path))
+        content[-1] ^= 0xFF
+        with open(path, "wb") as patch_file:
+            patch_file.write(content)
+        with self.assertRaises(TaskProcessingError):
+            self.archive.restore(1004, os.path.join(self.directory, "restored"))
+        with self.assertRaises(TaskProcessingError):
+            self.archive.compact(1004)
+        # the failed compaction keeps the archive
+        self.assertEqual(len(self.archive.get_entries()), 5)
@@ -0,0 +1,66 @@
+import datetime
+import os
+import tempfile
+import unittest
+
+from bdsync_manager.bandwidth import BandwidthBudget, BandwidthSchedule, get_fair_shares
+from bdsync_manager.utils import log
+
+
+class FairSharesTest(unittest.TestCase):
+
+    def test_equal_shares(self):
+        self.assertEqual(get_fair_shares(300, {"a": None, "b": None, "c": 500}),
+                         {"a": 100, "b": 100, "c": 100})
+
+    def test_small_demands(self):
+        self.assertEqual(get_fair_shares(300, {"a": 50, "b": None, "c": None}),
+                         {"a": 50, "b": 125, "c": 125})
+        self.assertEqual(get_fair_shares(300, {"a": 50, "b": 100, "c": None}),
+                         {"a": 50, "b": 100, "c": 150})
+
+    def test_no_streams(self):
+        self.assertEqual(get_fair_shares(300, {}), {})
+
+
+class BandwidthScheduleTest(unittest.TestCase):
+
+    def test_constant_limit(self):
+        self.assertEqual(BandwidthSchedule("1k").get_limit(), 1024)
+
+    def test_windows(self):
+        schedule = BandwidthSchedule("08:00-18:00=1m, 22:00-06:00=4m, 2m")
+        limit = lambda hour: schedule.get_limit(datetime.time(hour, 30))
+        self.assertEqual(limit(9), 1024 ** 2)
+        self.assertEqual(limit(23), 4 * 1024 ** 2)
+        self.assertEqual(limit(2), 4 * 1024 ** 2)
+        self.assertEqual(limit(20), 2 * 1024 ** 2)
+
+    def test_unmatched(self):
+        self.assertIsNone(BandwidthSchedule("08:00-18:00=1m").get_limit(datetime.time(19, 0)))
+        self.assertIsNone(BandwidthSchedule("").get_limit())
+
+    def test_invalid(self):
+        for text in ("foo", "08:00-25:00=1m", "0k"):
+            with self.assertRaises(ValueError):
+                BandwidthSchedule(text)
+
+
+class BandwidthBudgetTest(unittest.TestCase):
+
+    def test_local_shares(self):
+        budget = BandwidthBudget(BandwidthSchedule("300"))
+        buckets = [budget.get_bucket("host1"), budget.get_bucket("host2", own_limit=50)]
+        self.assertEqual([bucket.rate for bucket in buckets], [250, 50])
+        budget.release(buckets[1])
+        self.assertEqual(buckets[0].rate, 300)
+
+    def test_inaccessible_coordination_file(self):
+        # the parent of the coordination file is a regular file: it cannot be created
+        with tempfile.NamedTemporaryFile() as blocker:
+            budget = BandwidthBudget(BandwidthSchedule("300"), None,
+                                     os.path.join(blocker.name, "bandwidth.json"))
+            with self.assertLogs(log, "WARNING"):
+                buckets = [budget.get_bucket("host1"), budget.get_bucket("host2")]
+        self.assertEqual([bucket.rate for bucket in buckets], [150, 150])
+        buckets[0].consume(10)
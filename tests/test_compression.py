@@ -0,0 +1,32 @@
+import unittest
+
+from bdsync_manager.compression import choose_codec, update_statistics
+
+MIB = 1024 * 1024
+
+
+class AdaptiveCompressionTest(unittest.TestCase):
+
+    def test_link_rate(self):
+        # the generator needed most of the time: only the transfer time reflects the link
+        statistics = update_statistics({}, "none", None, {
+            "bytes_received": 100 * MIB, "bytes_transferred": 100 * MIB,
+            "compression_time": 0, "transfer_time": 1, "generate_time": 9, "duration": 10})
+        self.assertEqual(statistics["link_rate"], 100 * MIB)
+
+    def test_codec_statistics(self):
+        statistics = update_statistics({}, "zlib", 1, {
+            "bytes_received": 100 * MIB, "bytes_transferred": 25 * MIB,
+            "compression_time": 2, "transfer_time": 1, "generate_time": 5, "duration": 8})
+        self.assertEqual(statistics["link_rate"], 25 * MIB)
+        self.assertEqual(statistics["codecs"]["zlib:1"], {"ratio": 0.25, "speed": 50 * MIB})
+
+    def test_small_transfer(self):
+        self.assertEqual(update_statistics({}, "none", None, {
+            "bytes_received": 1000, "bytes_transferred": 1000, "compression_time": 0,
+            "transfer_time": 1, "generate_time": 0, "duration": 1}), {})
+
+    def test_choose_untested_codec(self):
+        self.assertEqual(choose_codec({}, lambda codec: True), ("none", None))
+        self.assertEqual(choose_codec({"link_rate": MIB}, lambda codec: codec != "lz4"),
+                         ("zstd", 1))
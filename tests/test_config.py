@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from bdsync_manager import TaskSettingsError
+from bdsync_manager.config import Configuration, TaskConfiguration
+
+
+class ConfigurationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.bdsync = self._create_file("bdsync")
+        self.source = self._create_file("source")
+        self.filename = os.path.join(self.directory, "bdsync-manager.conf")
+        with open(self.filename, "w") as config_file:
+            config_file.write("[DEFAULT]\n"
+                              "local_bdsync_bin = {bdsync}\n"
+                              "state_dir = {directory}/state\n"
+                              "apply_patch_in_place = true\n"
+                              "[foo]\n"
+                              "source_path = {source}\n"
+                              "target_path = {directory}/target\n"
+                              "segment_size = 1m\n"
+                              "schedule_interval = 1d\n"
+                              "[broken]\n"
+                              "source_path = {directory}/missing\n"
+                              "target_path = {directory}/target\n"
+                              .format(bdsync=self.bdsync, source=self.source,
+                                      directory=self.directory))
+
+    def _create_file(self, name):
+        filename = os.path.join(self.directory, name)
+        open(filename, "w").close()
+        return filename
+
+    def test_round_trip(self):
+        validated = Configuration(self.filename).get_validated_task("foo")
+        self.assertTrue(validated.is_validated)
+        self.assertEqual(validated["segment_size"], 1024 * 1024)
+        with unittest.mock.patch.object(TaskConfiguration, "validate",
+                                        side_effect=AssertionError("validated again")):
+            cached = Configuration(self.filename).get_validated_task("foo")
+        self.assertTrue(cached.is_validated)
+        self.assertEqual(dict(cached), dict(validated))
+
+    def test_modified_config_file(self):
+        Configuration(self.filename).get_validated_task("foo")
+        with open(self.filename) as config_file:
+            content = config_file.read()
+        with open(self.filename, "w") as config_file:
+            config_file.write(content.replace("[foo]\n", "[foo]\npriority = 3\n"))
+        task = Configuration(self.filename).get_validated_task("foo")
+        self.assertEqual(task["priority"], 3)
+
+    def test_only_selected_tasks_are_validated(self):
+        settings = Configuration(self.filename)
+        self.assertFalse(settings.tasks["broken"].is_validated)
+        settings.get_validated_task("foo")
+        with self.assertRaises(TaskSettingsError):
+            settings.get_validated_task("broken")
+
+    def test_cached_settings_with_missing_source(self):
+        Configuration(self.filename).get_validated_task("foo")
+        os.unlink(self.source)
+        with self.assertRaisesRegex(TaskSettingsError, "source"):
+            Configuration(self.filename).get_validated_task("foo")
+
+    def test_cached_settings_with_missing_bdsync(self):
+        Configuration(self.filename).get_validated_task("foo")
+        os.unlink(self.bdsync)
+        with self.assertRaisesRegex(TaskSettingsError, "bdsync"):
+            Configuration(self.filename).get_validated_task("foo")
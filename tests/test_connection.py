@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.connection import Connection
+
+
+class ConnectionTest(unittest.TestCase):
+    """ a local shell ("sh -c") stands in for the connection to a remote host """
+
+    def setUp(self):
+        self.connection = Connection("sh -c")
+        self.addCleanup(self.connection.close)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_remote(self):
+        self.assertTrue(self.connection.is_remote)
+        self.assertFalse(Connection("").is_remote)
+
+    def test_run(self):
+        self.assertEqual(self.connection.run("echo foo; echo bar >&2"), (0, "foo\nbar\n"))
+        self.assertEqual(self.connection.run("exit 3"), (3, ""))
+
+    def test_run_keeps_shell_state(self):
+        self.connection.run("cd /; foo=bar")
+        self.assertEqual(self.connection.run('pwd; echo "$foo"'), (0, "{0}\n\n".format(
+            os.path.realpath(os.getcwd()))))
+
+    def test_run_reuses_shell(self):
+        first = self.connection.run("echo $PPID")[1]
+        self.assertEqual(self.connection.run("echo $PPID")[1], first)
+
+    def test_check_output(self):
+        self.assertEqual(self.connection.check_output("echo foo"), "foo\n")
+        with self.assertRaises(TaskProcessingError):
+            self.connection.check_output("echo failure; false")
+
+    def test_has_program(self):
+        self.assertTrue(self.connection.has_program("sh"))
+        self.assertFalse(self.connection.has_program("bdsync-manager-missing-program"))
+
+    def test_lost_connection(self):
+        connection = Connection("sh -c 'echo Permission denied >&2; exit 255' --")
+        self.addCleanup(connection.close)
+        with self.assertRaisesRegex(TaskProcessingError, "Permission denied"):
+            connection.run("true")
+
+    def test_preflight_existing_target(self):
+        target = os.path.join(self.directory.name, "target")
+        with open(target, "wb") as target_file:
+            target_file.write(bytes(3000))
+        result = self.connection.preflight(target)
+        self.assertTrue(result["exists"])
+        self.assertEqual(result["size"], 3000)
+        self.assertGreater(result["free"], 0)
+        self.assertIsNone(result["patch_path"])
+
+    def test_preflight_missing_target(self):
+        patch_dir = os.path.join(self.directory.name, "patches")
+        os.mkdir(patch_dir)
+        result = self.connection.preflight(os.path.join(self.directory.name, "missing"),
+                                           patch_dir)
+        self.assertFalse(result["exists"])
+        self.assertIsNone(result["size"])
+        self.assertEqual(os.path.dirname(result["patch_path"]), patch_dir)
+        self.assertTrue(os.path.isfile(result["patch_path"]))
@@ -0,0 +1,111 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+from plumbum import ProcessExecutionError
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.agent import get_dedup_digest
+from bdsync_manager.connection import Connection
+from bdsync_manager.dedup import DedupEncoder, DedupIndex, DedupSession
+from bdsync_manager.patch import PatchWriter
+from bdsync_manager.task import SyncPatch, SyncTarget
+
+
+BLOCK_SIZE = 4096
+
+
+class DedupTest(unittest.TestCase):
+    """ deduplicated patches are expanded and applied by the agent on the (local) target host """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.state_dir = os.path.join(directory.name, "state")
+        self.store_dir = os.path.join(directory.name, "store")
+        self.patch_filename = os.path.join(directory.name, "patch")
+        self.target = os.path.join(directory.name, "target")
+        self.connection = Connection("")
+        self.addCleanup(self.connection.close)
+        self.index = DedupIndex(self.state_dir, "host", self.store_dir, 100)
+        self.first = os.urandom(BLOCK_SIZE)
+        self.second = os.urandom(BLOCK_SIZE)
+
+    def _get_store_path(self, data):
+        name = get_dedup_digest(data).hex()
+        return os.path.join(self.store_dir, name[:2], name)
+
+    def _synchronize(self, blocks, size=4 * BLOCK_SIZE):
+        """ deduplicate a patch, apply it to an empty target and return the session """
+        with open(self.target, "wb") as target_file:
+            target_file.truncate(size)
+        plain = io.BytesIO()
+        writer = PatchWriter(plain, self.target, size)
+        for offset, data in blocks:
+            writer.write_block(offset, data)
+        writer.finish()
+        with DedupSession(self.index, self.connection, sys.executable) as session:
+            encoder = DedupEncoder(session)
+            # the relay passes the patch in arbitrary chunks
+            content = plain.getvalue()
+            with open(self.patch_filename, "wb") as patch_file:
+                for position in range(0, len(content), 1000):
+                    patch_file.write(encoder.compress(content[position:position + 1000]))
+                patch_file.write(encoder.flush())
+            target = SyncTarget(self.target, "bdsync", "", self.connection,
+                                apply_python=sys.executable, dedup=session)
+            target.get_apply_patch_command(SyncPatch(self.patch_filename, self.connection))()
+        return session
+
+    def _read_target(self):
+        with open(self.target, "rb") as target_file:
+            return target_file.read()
+
+    def test_references_within_one_patch(self):
+        session = self._synchronize([(0, self.first), (BLOCK_SIZE, self.second),
+                                     (2 * BLOCK_SIZE, self.first), (3 * BLOCK_SIZE, b"small")])
+        self.assertEqual(self._read_target(), self.first + self.second + self.first + b"small"
+                         + bytes(BLOCK_SIZE - 5))
+        self.assertEqual((session.references, session.bytes_saved), (1, BLOCK_SIZE))
+        self.assertLess(os.path.getsize(self.patch_filename), 3 * BLOCK_SIZE)
+        self.assertEqual(len(self.index), 2)
+        for data in (self.first, self.second):
+            self.assertTrue(os.path.exists(self._get_store_path(data)))
+
+    def test_references_to_the_store(self):
+        self._synchronize([(0, self.first), (BLOCK_SIZE, self.second)])
+        session = self._synchronize([(BLOCK_SIZE, self.first), (2 * BLOCK_SIZE, self.second)])
+        self.assertEqual(self._read_target(),
+                         bytes(BLOCK_SIZE) + self.first + self.second + bytes(BLOCK_SIZE))
+        self.assertEqual(session.references, 2)
+        self.assertLess(os.path.getsize(self.patch_filename), BLOCK_SIZE)
+
+    def _check_incomplete_store(self):
+        with self.assertRaises(ProcessExecutionError):
+            self._synchronize([(0, self.first)])
+        # the index and the store are cleared: the next run sends the complete blocks
+        self.assertEqual(len(self.index), 0)
+        self.assertFalse(os.path.exists(self._get_store_path(self.second)))
+        session = self._synchronize([(0, self.first)])
+        self.assertEqual(session.references, 0)
+        self.assertEqual(self._read_target()[:BLOCK_SIZE], self.first)
+
+    def test_missing_block(self):
+        self._synchronize([(0, self.first), (BLOCK_SIZE, self.second)])
+        os.unlink(self._get_store_path(self.first))
+        self._check_incomplete_store()
+
+    def test_corrupt_block(self):
+        self._synchronize([(0, self.first), (BLOCK_SIZE, self.second)])
+        with open(self._get_store_path(self.first), "wb") as block_file:
+            block_file.write(os.urandom(BLOCK_SIZE))
+        self._check_incomplete_store()
+
+    def test_incomplete_patch(self):
+        with DedupSession(self.index, self.connection, sys.executable) as session:
+            encoder = DedupEncoder(session)
+            encoder.compress(b"BDSYNC 0.3\nDEVICE:target\nSIZE:4096\n\n\x00\x00")
+            with self.assertRaises(TaskProcessingError):
+                encoder.flush()
@@ -0,0 +1,55 @@
+import io
+import os
+import tempfile
+import unittest
+
+from bdsync_manager.agent import iter_patch_blocks, read_patch_header
+from bdsync_manager.engine import LocalDiffEngine
+
+
+class LocalDiffEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, "source")
+        self.target = os.path.join(directory.name, "target")
+        self.engine = LocalDiffEngine(block_size=512, threads=2, chunk_blocks=4,
+                                      max_write_size=4096)
+        data = os.urandom(64 * 1024)
+        with open(self.source, "wb") as source_file:
+            source_file.write(data)
+        changed = bytearray(data)
+        changed[1000:1010] = bytes(10)
+        changed[30000:40000] = bytes(10000)
+        with open(self.target, "wb") as target_file:
+            target_file.write(changed[:60000])
+
+    def _read(self, filename):
+        with open(filename, "rb") as data_file:
+            return data_file.read()
+
+    def test_write_patch(self):
+        stream = io.BytesIO()
+        self.engine.write_patch(self.source, self.target, stream)
+        stream.seek(0)
+        fields = read_patch_header(stream)
+        self.assertEqual(fields["DEVICE"], self.target)
+        self.assertEqual(int(fields["SIZE"]), 64 * 1024)
+        with open(self.target, "r+b") as target_file:
+            for offset, data in iter_patch_blocks(stream):
+                target_file.seek(offset)
+                target_file.write(data)
+        self.assertEqual(self._read(self.target), self._read(self.source))
+
+    def test_sync(self):
+        written = self.engine.sync(self.source, self.target)
+        self.assertEqual(self._read(self.target), self._read(self.source))
+        self.assertLess(written, 64 * 1024)
+        self.assertEqual(self.engine.sync(self.source, self.target), 0)
+
+    def test_sync_ranges(self):
+        self.engine.sync(self.source, self.target, ranges=[(0, 2048)])
+        target = self._read(self.target)
+        self.assertEqual(target[:2048], self._read(self.source)[:2048])
+        self.assertEqual(target[30000:30010], bytes(10))
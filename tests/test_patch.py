@@ -0,0 +1,100 @@
+import io
+import os
+import tempfile
+import unittest
+
+from bdsync_manager.agent import iter_patch_blocks, read_patch_header
+from bdsync_manager.patch import PatchWriter, ZERO_BLOCK_SIZE, get_data_ranges, \
+    get_merged_ranges, write_range_patch
+
+
+def read_patch(data):
+    stream = io.BytesIO(data)
+    return read_patch_header(stream), list(iter_patch_blocks(stream))
+
+
+class PatchWriterTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        stream = io.BytesIO()
+        writer = PatchWriter(stream, "/dev/vg/target", 8192)
+        writer.write_block(0, b"foo")
+        writer.write_block(4096, b"bar" * 100)
+        writer.finish()
+        fields, blocks = read_patch(stream.getvalue())
+        self.assertEqual(fields["DEVICE"], "/dev/vg/target")
+        self.assertEqual(fields["SIZE"], "8192")
+        self.assertEqual(blocks, [(0, b"foo"), (4096, b"bar" * 100)])
+
+    def test_empty_patch(self):
+        stream = io.BytesIO()
+        PatchWriter(stream, "target", 0).finish()
+        self.assertEqual(read_patch(stream.getvalue()), ({"DEVICE": "target", "SIZE": "0"}, []))
+
+    def test_truncated_patch(self):
+        stream = io.BytesIO()
+        writer = PatchWriter(stream, "target", 100)
+        writer.write_block(0, b"foo")
+        with self.assertRaises(ValueError):
+            read_patch(stream.getvalue()[:-1])
+
+
+class RangePatchTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, "source")
+        self.target = os.path.join(directory.name, "target")
+        self.data = os.urandom(3 * ZERO_BLOCK_SIZE) + bytes(2 * ZERO_BLOCK_SIZE) + b"tail"
+        with open(self.source, "wb") as source_file:
+            source_file.write(self.data)
+
+    def _write(self, ranges, **kwargs):
+        stream = io.BytesIO()
+        write_range_patch(self.source, self.target, ranges, stream, **kwargs)
+        return read_patch(stream.getvalue())
+
+    def test_header_names_target(self):
+        fields, blocks = self._write([(0, 10)])
+        self.assertEqual(fields["DEVICE"], self.target)
+        self.assertEqual(int(fields["SIZE"]), len(self.data))
+        self.assertEqual(blocks, [(0, self.data[:10])])
+
+    def test_ranges(self):
+        fields, blocks = self._write([(100, 50), (120, 100), (len(self.data) - 2, 100)])
+        self.assertEqual(blocks, [(100, self.data[100:220]),
+                                  (len(self.data) - 2, self.data[-2:])])
+
+    def test_skip_zero_blocks(self):
+        fields, blocks = self._write([(0, len(self.data))], skip_zero_blocks=True)
+        self.assertEqual(blocks, [(0, self.data[:3 * ZERO_BLOCK_SIZE]),
+                                  (5 * ZERO_BLOCK_SIZE, b"tail")])
+
+
+class RangeTest(unittest.TestCase):
+
+    def test_merged_ranges(self):
+        self.assertEqual(get_merged_ranges([(10, 5), (0, 5), (5, 2), (30, 0), (12, 10)]),
+                         [(0, 7), (10, 12)])
+
+    def test_merged_ranges_limit(self):
+        self.assertEqual(get_merged_ranges([(0, 10), (20, 10), (40, 10)], limit=25),
+                         [(0, 10), (20, 5)])
+
+    def test_data_ranges(self):
+        with tempfile.NamedTemporaryFile() as sparse_file:
+            sparse_file.truncate(16 * 1024 * 1024)
+            sparse_file.seek(8 * 1024 * 1024)
+            sparse_file.write(b"data")
+            sparse_file.flush()
+            ranges = get_data_ranges(sparse_file.name)
+        # filesystems without support for holes report the complete file
+        self.assertTrue(any(offset <= 8 * 1024 * 1024 < offset + length
+                            for offset, length in ranges))
+        self.assertLessEqual(sum(length for offset, length in ranges), 16 * 1024 * 1024)
+        self.assertEqual(ranges, get_merged_ranges(ranges))
+
+    def test_data_ranges_empty_file(self):
+        with tempfile.NamedTemporaryFile() as empty_file:
+            self.assertEqual(get_data_ranges(empty_file.name), [])
@@ -0,0 +1,84 @@
+import unittest
+
+from bdsync_manager.resources import BACKOFF_FACTOR, MIN_READ_RATE, RECOVERY_FACTOR, \
+    SECTOR_SIZE, ResourceControl
+
+SOURCE = "8:0"
+DEVICE = "8:16"
+MIB = 1024 * 1024
+
+
+class AdaptiveControl(ResourceControl):
+    """ record the read limits instead of writing them to a cgroup """
+
+    def __init__(self, **kwargs):
+        super().__init__("test", latency_threshold=10, **kwargs)
+        self._source_number = SOURCE
+        self._latency_number = DEVICE
+        self.written = []
+
+    def _write_cgroup_file(self, name, value, path=None):
+        self.written.append((name, value))
+
+
+def get_statistics(operations, busy_ms, source_mib):
+    return {DEVICE: (operations, busy_ms, 0), SOURCE: (0, 0, source_mib * MIB // SECTOR_SIZE)}
+
+
+class ResourceControlTest(unittest.TestCase):
+
+    def test_backoff(self):
+        control = AdaptiveControl()
+        # 100 operations taking 50 ms each while reading 100 MiB/s from the source
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 5000, 200), 2)
+        self.assertEqual(control.read_rate, 100 * MIB * BACKOFF_FACTOR)
+        self.assertEqual(control.written, [("io.max", "{0} rbps={1:d}".format(
+            SOURCE, int(100 * MIB * BACKOFF_FACTOR)))])
+        # the limit is reduced further while the latency is too high
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 5000, 100), 2)
+        self.assertEqual(control.read_rate, 100 * MIB * BACKOFF_FACTOR ** 2)
+
+    def test_minimum_rate(self):
+        control = AdaptiveControl(read_limit=MIN_READ_RATE)
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 5000, 2), 2)
+        self.assertEqual(control.read_rate, MIN_READ_RATE)
+        self.assertEqual(control.written, [])
+
+    def test_recovery(self):
+        control = AdaptiveControl()
+        control.read_rate = 10 * MIB
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 100, 20), 2)
+        self.assertEqual(control.read_rate, 10 * MIB * RECOVERY_FACTOR)
+        # the limit is removed as soon as it is not effective anymore
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 100, 2), 2)
+        self.assertIsNone(control.read_rate)
+        self.assertEqual(control.written[-1], ("io.max", "{0} rbps=max".format(SOURCE)))
+
+    def test_recovery_up_to_configured_limit(self):
+        control = AdaptiveControl(read_limit=12 * MIB)
+        control.read_rate = 10 * MIB
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 100, 2), 2)
+        self.assertEqual(control.read_rate, 12 * MIB)
+
+    def test_moderate_latency(self):
+        control = AdaptiveControl()
+        control.read_rate = 10 * MIB
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 700, 20), 2)
+        self.assertEqual(control.read_rate, 10 * MIB)
+        self.assertEqual(control.written, [])
+
+    def test_latency_unrelated_to_source(self):
+        control = AdaptiveControl()
+        control.adapt(get_statistics(0, 0, 0), get_statistics(100, 5000, 0), 2)
+        self.assertIsNone(control.read_rate)
+
+    def test_missing_statistics(self):
+        control = AdaptiveControl()
+        control.adapt({}, {}, 2)
+        self.assertIsNone(control.read_rate)
+
+    def test_wrap_tokens(self):
+        control = ResourceControl("test", io_class="idle", io_level=4, nice=10)
+        self.assertEqual(control.wrap_tokens(["bdsync", "--help"]),
+                         ["ionice", "-c", "3", "nice", "-n", "10", "bdsync", "--help"])
+        self.assertEqual(ResourceControl("test").wrap_tokens(["bdsync"]), ["bdsync"])
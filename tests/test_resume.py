@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from bdsync_manager.connection import Connection
+from bdsync_manager.resume import get_fingerprint, ResumeCheckpoint
+
+SEGMENT_SIZE = 1024 * 1024
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.filename = os.path.join(self.directory, "source")
+        with open(self.filename, "wb") as source:
+            source.write(os.urandom(3 * SEGMENT_SIZE))
+        self.connection = Connection("")
+        self.addCleanup(self.connection.close)
+
+    def _get_fingerprint(self, index):
+        return get_fingerprint(self.connection, self.filename, index * SEGMENT_SIZE,
+                               SEGMENT_SIZE)
+
+    def _modify(self, offset):
+        with open(self.filename, "r+b") as source:
+            source.seek(offset)
+            data = source.read(1)
+            source.seek(offset)
+            source.write(bytes([data[0] ^ 0xff]))
+
+    def test_change_in_the_middle_of_a_segment(self):
+        before = [self._get_fingerprint(index) for index in range(3)]
+        self._modify(SEGMENT_SIZE + SEGMENT_SIZE // 2)
+        after = [self._get_fingerprint(index) for index in range(3)]
+        self.assertEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+        self.assertEqual(before[2], after[2])
+
+    def test_checkpoint_discards_changed_segments(self):
+        state_dir = os.path.join(self.directory, "state")
+        layout = {"source": self.filename, "segment_size": SEGMENT_SIZE}
+        checkpoint = ResumeCheckpoint(state_dir, "task")
+        checkpoint.start(layout, lambda index, details: True)
+        for index in range(3):
+            checkpoint.add_segment(index, {"source": self._get_fingerprint(index)})
+        self._modify(SEGMENT_SIZE + 12345)
+
+        def is_valid(index, details):
+            return self._get_fingerprint(index) == details["source"]
+
+        completed = ResumeCheckpoint(state_dir, "task").start(layout, is_valid)
+        self.assertEqual(sorted(completed), [0, 2])
+        # a different layout discards the complete checkpoint
+        self.assertEqual(ResumeCheckpoint(state_dir, "task").start(
+            dict(layout, fingerprint="other"), is_valid), {})
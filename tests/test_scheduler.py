@@ -0,0 +1,35 @@
+import datetime
+import unittest
+
+from bdsync_manager.scheduler import ScheduleWindow
+
+
+def get_timestamp(hour, minute=0):
+    return datetime.datetime(2024, 5, 1, hour, minute).timestamp()
+
+
+class ScheduleWindowTest(unittest.TestCase):
+
+    def test_empty(self):
+        window = ScheduleWindow("")
+        self.assertTrue(window.contains(get_timestamp(12)))
+        self.assertIsNone(window.get_remaining(get_timestamp(12)))
+
+    def test_contains(self):
+        window = ScheduleWindow("22:00-06:00, 12:00-13:00")
+        self.assertTrue(window.contains(get_timestamp(23)))
+        self.assertTrue(window.contains(get_timestamp(5, 59)))
+        self.assertTrue(window.contains(get_timestamp(12, 30)))
+        self.assertFalse(window.contains(get_timestamp(6)))
+        self.assertFalse(window.contains(get_timestamp(13)))
+
+    def test_remaining(self):
+        window = ScheduleWindow("22:00-06:00")
+        self.assertEqual(window.get_remaining(get_timestamp(23)), 7 * 3600)
+        self.assertEqual(window.get_remaining(get_timestamp(5, 30)), 1800)
+        self.assertEqual(window.get_remaining(get_timestamp(12)), 0)
+
+    def test_invalid(self):
+        for text in ("22:00", "22:00-6", "25:00-06:00"):
+            with self.assertRaises(ValueError):
+                ScheduleWindow(text)
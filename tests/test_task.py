@@ -0,0 +1,31 @@
+import unittest
+
+from bdsync_manager import TaskProcessingError
+from bdsync_manager.task import _get_target_size, get_diffsize_mode
+
+
+class TargetSizeTest(unittest.TestCase):
+
+    def test_missing_target(self):
+        self.assertEqual(_get_target_size({"exists": False, "size": None}, "target"), 0)
+
+    def test_existing_target(self):
+        self.assertEqual(_get_target_size({"exists": True, "size": 0}, "target"), 0)
+        self.assertEqual(_get_target_size({"exists": True, "size": 4096}, "target"), 4096)
+
+    def test_unknown_size(self):
+        # e.g. "blockdev" is missing on the target host: the target must not be overwritten
+        with self.assertRaises(TaskProcessingError):
+            _get_target_size({"exists": True, "size": None}, "target")
+
+
+class DiffsizeModeTest(unittest.TestCase):
+
+    def test_modes(self):
+        self.assertEqual(get_diffsize_mode([]), "strict")
+        self.assertEqual(get_diffsize_mode(["--twopass"]), "strict")
+        self.assertEqual(get_diffsize_mode(["--diffsize"]), "resize")
+        self.assertEqual(get_diffsize_mode(["--diffsize=minsize"]), "minsize")
+        # the last argument wins
+        self.assertEqual(get_diffsize_mode(["--diffsize=minsize", "--diffsize=strict"]),
+                         "strict")